@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 13:52:18 2026
+
+@author: kl001
+
+Array backends of the fringe analysis functions in nstep_fringe. A backend bundles an array module with the
+numpy/scipy compatible API used by the phase pipeline (e.g. numpy + scipy.ndimage or cupy + cupyx.scipy.ndimage),
+host transfer functions and tuning hints. Functions dispatch on the type of their input arrays, so the same code
+runs on every registered backend and a new accelerated array library is added with register_backend only.
+Backends are loaded on first use, numpy is always available.
+"""
+import numpy as np
+
+# processing types used by Calibration and Reconstruction
+PROCESSING_ALIASES = {'cpu': 'numpy', 'gpu': 'cupy'}
+
+
+class Backend:
+    """
+    Array library used by the fringe analysis functions.
+    """
+    def __init__(self,
+                 name,
+                 xp,
+                 ndimage,
+                 asnumpy=np.asarray,
+                 asarray=None,
+                 free_memory=None,
+                 pool_bytes=None,
+                 block_bytes=None,
+                 synchronize=None):
+        """
+        Parameters
+        ----------
+        name: str.
+              Backend name.
+        xp: module.
+            Array module with numpy API (numpy, cupy, ...).
+        ndimage: module.
+                 scipy.ndimage compatible module for xp arrays (median_filter is used).
+        asnumpy: callable.
+                 Function copying a backend array to a numpy array.
+        asarray: callable.
+                 Function copying a numpy array to the backend. Default xp.asarray.
+        free_memory: callable.
+                     Function releasing cached device memory between poses/scans, if any.
+        pool_bytes: callable.
+                    Function returning the bytes held by the device memory pool, reported by instrumentation spans.
+        block_bytes: int.
+                     Size of row blocks used by cache blocked loops (median_filter_1d). None processes whole images
+                     at once, which is preferred by devices with many cores.
+        synchronize: callable.
+                     Function waiting for queued device work to finish, used by instrumentation spans to time
+                     asynchronous kernels. Default does nothing (synchronous libraries).
+        """
+        self.name = name
+        self.xp = xp
+        self.ndimage = ndimage
+        self.asnumpy = asnumpy
+        self.asarray = asarray if asarray is not None else xp.asarray
+        self.free_memory = free_memory if free_memory is not None else (lambda: None)
+        self.pool_bytes = pool_bytes
+        self.block_bytes = block_bytes
+        self.synchronize = synchronize if synchronize is not None else (lambda: None)
+
+    def __repr__(self):
+        return "Backend('%s')" % self.name
+
+
+def _numpy_backend():
+    import scipy.ndimage
+    return Backend('numpy', np, scipy.ndimage, block_bytes=2**17)
+
+def _cupy_backend():
+    import cupy
+    from cupyx.scipy import ndimage
+    pool = cupy.get_default_memory_pool()
+    return Backend('cupy', cupy, ndimage, asnumpy=cupy.asnumpy, asarray=cupy.asarray,
+                   free_memory=pool.free_all_blocks, pool_bytes=pool.total_bytes,
+                   synchronize=lambda: cupy.cuda.get_current_stream().synchronize())
+
+# backend name: loader, top level module name of backend arrays: backend name
+_loaders = {}
+_modules = {}
+_backends = {}
+
+def register_backend(name, loader, module=None):
+    """
+    Function to register an array backend.
+    Parameters
+    ----------
+    name: str.
+          Backend name used by get_backend and as processing type.
+    loader: callable.
+            Function without arguments returning the Backend. It is called on first use, so the array library is
+            only imported when needed.
+    module: str.
+            Top level module name of the backend array type, used to dispatch on arrays. Default is name.
+    """
+    _loaders[name] = loader
+    _modules[module if module is not None else name] = name
+    _backends.pop(name, None)
+
+def get_backend(name=None):
+    """
+    Function to get a backend by name.
+    Parameters
+    ----------
+    name: str/Backend.
+          Backend name or processing type ('cpu', 'gpu'). Default is 'numpy'.
+    Returns
+    -------
+    backend: Backend.
+    """
+    if isinstance(name, Backend):
+        return name
+    name = PROCESSING_ALIASES.get(name, name) if name is not None else 'numpy'
+    if name not in _backends:
+        if name not in _loaders:
+            raise ValueError("Unknown backend '%s', registered backends are %s" % (name, sorted(_loaders)))
+        _backends[name] = _loaders[name]()
+    return _backends[name]
+
+def backend_available(name):
+    """
+    Function to check if a backend is registered and its array library can be imported.
+    """
+    try:
+        get_backend(name)
+    except (ValueError, ImportError):
+        return False
+    return True
+
+def available_backends():
+    """
+    Names of registered backends that can be loaded.
+    """
+    return [name for name in sorted(_loaders) if backend_available(name)]
+
+def backend_of(arr):
+    """
+    Function to get the backend of an array from its type. Non array values (lists, scalars) belong to numpy.
+    """
+    name = _modules.get(type(arr).__module__.split('.')[0], 'numpy')
+    if name in _backends:
+        return _backends[name]
+    return get_backend(name)
+
+def to_numpy(arr):
+    """
+    Host (numpy) copy of an array of any backend, None stays None.
+    """
+    if arr is None:
+        return None
+    return backend_of(arr).asnumpy(arr)
+
+
+register_backend('numpy', _numpy_backend)
+register_backend('cupy', _cupy_backend)
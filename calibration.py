@@ -2,24 +2,31 @@
 # coding: utf-8
 
 import numpy as np
-import cupy as cp
 import nstep_fringe as nstep
-import nstep_fringe_cp as nstep_cp
+from backend import backend_available, get_backend, to_numpy
 import cv2
 import os
 import glob
-import pandas as pd
-from tqdm import tqdm
-import matplotlib.pyplot as plt
-from matplotlib.ticker import MaxNLocator
-import seaborn as sns
 import reconstruction as rc
-from plyfile import PlyData, PlyElement
-from scipy.optimize import leastsq
-from scipy.spatial import distance
+from capture_loader import CaptureLoader
+from scan_archive import ScanArchive, SCAN_ARCHIVE
+from pose_cache import PoseCache, POSE_CACHE
 import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from lazy_modules import LazyModule, tqdm
+from instrumentation import NULL_TRACER, span
+
+# plotting and data frame packages are only imported by the analysis functions using them
+pd = LazyModule('pandas')
+plt = LazyModule('matplotlib.pyplot')
+ticker = LazyModule('matplotlib.ticker')
+sns = LazyModule('seaborn')
+distance = LazyModule('scipy.spatial.distance')
+
 EPSILON = -0.5
 TAU = 5.5
+# outputs of multifreq_analysis, the stacks of wrapped phase maps and modulation of all levels are not cached per pose
+POSE_FIELDS = ('unwrap_v', 'unwrap_h', 'phase_v', 'phase_h', 'white', 'modulation', 'mask_v', 'mask_h', 'sigma_sqphi_v', 'sigma_sqphi_h')
 
 #TODO: Fix calibration reconstruction
 class Calibration:
@@ -46,7 +53,8 @@ class Calibration:
                  path,
                  data_type,
                  processing,
-                 dark_bias_path):
+                 dark_bias_path,
+                 tracer=None):
         """
         Parameters
         ----------
@@ -83,9 +91,14 @@ class Calibration:
         path: str.
               Path to read captured calibration images and save calibration results.
         data_type:str
-                  Calibration image data can be either .tiff or .npy.
+                  Calibration image data can be either .tiff, .npy or 'archive' (single scan archive file in path).
         processing:str.
-                   Type of data processing. Use 'cpu' for desktop computation and 'gpu' for gpu.
+                   Type of data processing. Use 'cpu' for desktop computation and 'gpu' for gpu, or the name of any
+                   registered array backend (see backend.py).
+        dark_bias_path: str.
+                        Path of dark bias image.
+        tracer: instrumentation.Tracer.
+                Tracer recording the timing and memory of calibration stages. Default is no tracing.
 
         """
         self.proj_width = proj_width
@@ -104,6 +117,7 @@ class Calibration:
         self.bobdetect_convexity = bobdetect_convexity
         self.kernel_v = kernel_v
         self.kernel_h = kernel_h
+        self.tracer = tracer if tracer is not None else NULL_TRACER
         
         if (self.type_unwrap == 'multifreq') or (self.type_unwrap == 'multiwave'):
             self.phase_st = 0
@@ -112,14 +126,19 @@ class Calibration:
             return
         if not os.path.exists(self.path):
             print('ERROR: %s does not exist' % self.path)
-        if (data_type != 'tiff') and (data_type != 'npy'):
-            print('ERROR: Invalid data type. Data type should be \'tiff\' or \'npy\'')
+        if (data_type != 'tiff') and (data_type != 'npy') and (data_type != 'archive'):
+            print('ERROR: Invalid data type. Data type should be \'tiff\', \'npy\' or \'archive\'')
         else:
             self.data_type = data_type
-        if (processing != 'cpu') and (processing != 'gpu'):
-            print('ERROR: Invalid processing type. Processing type should be \'cpu\' or \'gpu\'')
+        self.archive = None
+        # per pose artifacts are cached in path/pose_cache and shared by calib, sub_calibration and bootstrapping
+        self.pose_cache = PoseCache(os.path.join(self.path, POSE_CACHE))
+        self._content_hashes = {}
+        if not backend_available(processing):
+            print('ERROR: Invalid processing type. Processing type should be \'cpu\', \'gpu\' or an available backend')
         else:
             self.processing = processing
+            self.backend = get_backend(processing)
         if not os.path.exists(dark_bias_path):
              print('ERROR:Path for dark bias  %s does not exist' % self.calib_path)
         else:
@@ -139,7 +158,7 @@ class Calibration:
                   List of true images for each calibration pose.
         mod_lst: list.
                  List of modulation intensity images for each calibration pose for intensity
-                 varying both horizontally and vertically.
+                 varying both horizontally and vertically. None for poses read from the pose cache.
         proj_img_lst: list.
                       List of projector images.
         cam_objpts: list.
@@ -163,29 +182,43 @@ class Calibration:
         proj_df1: pandas dataframe.
                   Dataframe of projector absolute error in x and y directions of all poses.
         """
+        with self.tracer.scan(self.path, backend=getattr(self, 'backend', None), type_unwrap=self.type_unwrap,
+                              N_list=list(self.N), pitch_list=list(self.pitch)):
+            return self._calib(fx, fy, model)
+
+    def _calib(self, fx, fy, model):
+        """
+        Body of calib, stages are recorded as spans of the calibration trace.
+        """
         objp = self.world_points()
+        pose_keys = None
         if self.type_unwrap == 'multiwave':
             unwrapv_lst, unwraph_lst, white_lst, mod_lst, wrapped_phase_lst, mask_lst = self.projcam_calib_img_multiwave()
         else:
             if self.type_unwrap != 'multifreq':
                 print("phase unwrapping type is not recognized, use 'multifreq'")
             unwrapv_lst, unwraph_lst, white_lst, mod_lst, wrapped_phase_lst, maskv_lst, maskh_lst, sigma_sqphi_lst = self.projcam_calib_img_multifreq(model)
+            pose_keys = self.pose_keys(self.acquisition_indices(), model)
         
             
         unwrapv_lst = [nstep.recover_image(u, maskv_lst[i], self.cam_height, self.cam_width) for i,u in enumerate(unwrapv_lst)]
         unwraph_lst = [nstep.recover_image(u, maskh_lst[i], self.cam_height, self.cam_width) for i,u in enumerate(unwraph_lst)]
             
         # Projector images
-        proj_img_lst = self.projector_img(unwrapv_lst, unwraph_lst, white_lst, fx, fy)
+        with span('projector_img'):
+            proj_img_lst = self.projector_img(unwrapv_lst, unwraph_lst, white_lst, fx, fy)
         # Camera calibration
-        camr_error, cam_objpts, cam_imgpts, cam_mtx, cam_dist, cam_rvecs, cam_tvecs = self.camera_calib(objp, white_lst)
+        with span('camera_calib'):
+            camr_error, cam_objpts, cam_imgpts, cam_mtx, cam_dist, cam_rvecs, cam_tvecs = self.camera_calib(objp, white_lst, pose_keys=pose_keys)
         
         # Projector calibration
-        proj_ret, proj_imgpts, proj_mtx, proj_dist, proj_rvecs, proj_tvecs = self.proj_calib(cam_objpts,
-                                                                                             cam_imgpts,
-                                                                                             unwrapv_lst,
-                                                                                             unwraph_lst,
-                                                                                             proj_img_lst)
+        with span('proj_calib'):
+            proj_ret, proj_imgpts, proj_mtx, proj_dist, proj_rvecs, proj_tvecs = self.proj_calib(cam_objpts,
+                                                                                                 cam_imgpts,
+                                                                                                 unwrapv_lst,
+                                                                                                 unwraph_lst,
+                                                                                                 proj_img_lst,
+                                                                                                 pose_keys=pose_keys)
         # Camera calibration error analysis
         cam_mean_error, cam_delta = self.intrinsic_error_analysis(cam_objpts, 
                                                                   cam_imgpts, 
@@ -201,44 +234,46 @@ class Calibration:
                                                                     proj_rvecs,
                                                                     proj_tvecs)
         # Stereo calibration
-        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 40, 0.0001)
-        stereocalibration_flags = cv2.CALIB_FIX_INTRINSIC+cv2.CALIB_ZERO_TANGENT_DIST+cv2.CALIB_FIX_K3+cv2.CALIB_FIX_K4+cv2.CALIB_FIX_K5+cv2.CALIB_FIX_K6
+        with span('stereo_calib'):
+            criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 40, 0.0001)
+            stereocalibration_flags = cv2.CALIB_FIX_INTRINSIC+cv2.CALIB_ZERO_TANGENT_DIST+cv2.CALIB_FIX_K3+cv2.CALIB_FIX_K4+cv2.CALIB_FIX_K5+cv2.CALIB_FIX_K6
 
-        st_retu, st_cam_mtx, st_cam_dist, st_proj_mtx, st_proj_dist, st_cam_proj_rmat, st_cam_proj_tvec, E, F = cv2.stereoCalibrate(cam_objpts,
-                                                                                                                                    cam_imgpts,
-                                                                                                                                    proj_imgpts,
-                                                                                                                                    cam_mtx,
-                                                                                                                                    cam_dist,
-                                                                                                                                    proj_mtx,
-                                                                                                                                    proj_dist,
-                                                                                                                                    white_lst[0].shape[::-1],
-                                                                                                                                    flags=stereocalibration_flags,
-                                                                                                                                    criteria=criteria)
-        project_mat = np.hstack((st_cam_proj_rmat, st_cam_proj_tvec))
-        _, _, _, _, _, _, euler_angles = cv2.decomposeProjectionMatrix(project_mat)
-        proj_h_mtx = np.dot(st_proj_mtx, np.hstack((st_cam_proj_rmat, st_cam_proj_tvec)))
-        cam_h_mtx = np.dot(st_cam_mtx, np.hstack((np.identity(3), np.zeros((3, 1)))))
-        u = np.arange(0, self.cam_width)
-        v = np.arange(0, self.cam_height)
-        uc_grid, vc_grid = np.meshgrid(u, v)
-        cordinates = np.stack((vc_grid.ravel(),uc_grid.ravel()),axis=1).astype("float64")
-        uv = cv2.undistortPoints(cordinates, st_cam_mtx, st_cam_dist, None, cam_mtx).reshape((self.cam_width * self.cam_height,2))
-        uc = uv[:,1]
-        vc = uv[:,0]
-        uc = uc.reshape(self.cam_height, self.cam_width)
-        vc = vc.reshape(self.cam_height, self.cam_width)
-        np.save(os.path.join(self.path,"uc_img.npy"), uc)
-        np.save(os.path.join(self.path,"vc_img.npy"), vc)
-        np.savez(os.path.join(self.path, '{}_mean_calibration_param.npz'.format(self.type_unwrap)), 
-                  cam_mtx_mean=st_cam_mtx, 
-                  cam_dist_mean=st_cam_dist, 
-                  proj_mtx_mean=st_proj_mtx, 
-                  proj_dist_mean=st_proj_dist,
-                  st_rmat_mean=st_cam_proj_rmat, 
-                  st_tvec_mean=st_cam_proj_tvec,
-                  cam_h_mtx_mean=cam_h_mtx,
-                  proj_h_mtx_mean=proj_h_mtx)
-        np.savez(os.path.join(self.path, '{}_cam_rot_tvecs.npz'.format(self.type_unwrap)), cam_rvecs, cam_tvecs)
+            st_retu, st_cam_mtx, st_cam_dist, st_proj_mtx, st_proj_dist, st_cam_proj_rmat, st_cam_proj_tvec, E, F = cv2.stereoCalibrate(cam_objpts,
+                                                                                                                                        cam_imgpts,
+                                                                                                                                        proj_imgpts,
+                                                                                                                                        cam_mtx,
+                                                                                                                                        cam_dist,
+                                                                                                                                        proj_mtx,
+                                                                                                                                        proj_dist,
+                                                                                                                                        white_lst[0].shape[::-1],
+                                                                                                                                        flags=stereocalibration_flags,
+                                                                                                                                        criteria=criteria)
+            project_mat = np.hstack((st_cam_proj_rmat, st_cam_proj_tvec))
+            _, _, _, _, _, _, euler_angles = cv2.decomposeProjectionMatrix(project_mat)
+            proj_h_mtx = np.dot(st_proj_mtx, np.hstack((st_cam_proj_rmat, st_cam_proj_tvec)))
+            cam_h_mtx = np.dot(st_cam_mtx, np.hstack((np.identity(3), np.zeros((3, 1)))))
+        with span('save'):
+            u = np.arange(0, self.cam_width)
+            v = np.arange(0, self.cam_height)
+            uc_grid, vc_grid = np.meshgrid(u, v)
+            cordinates = np.stack((vc_grid.ravel(),uc_grid.ravel()),axis=1).astype("float64")
+            uv = cv2.undistortPoints(cordinates, st_cam_mtx, st_cam_dist, None, cam_mtx).reshape((self.cam_width * self.cam_height,2))
+            uc = uv[:,1]
+            vc = uv[:,0]
+            uc = uc.reshape(self.cam_height, self.cam_width)
+            vc = vc.reshape(self.cam_height, self.cam_width)
+            np.save(os.path.join(self.path,"uc_img.npy"), uc)
+            np.save(os.path.join(self.path,"vc_img.npy"), vc)
+            np.savez(os.path.join(self.path, '{}_mean_calibration_param.npz'.format(self.type_unwrap)), 
+                      cam_mtx_mean=st_cam_mtx, 
+                      cam_dist_mean=st_cam_dist, 
+                      proj_mtx_mean=st_proj_mtx, 
+                      proj_dist_mean=st_proj_dist,
+                      st_rmat_mean=st_cam_proj_rmat, 
+                      st_tvec_mean=st_cam_proj_tvec,
+                      cam_h_mtx_mean=cam_h_mtx,
+                      proj_h_mtx_mean=proj_h_mtx)
+            np.savez(os.path.join(self.path, '{}_cam_rot_tvecs.npz'.format(self.type_unwrap)), cam_rvecs, cam_tvecs)
         self.cam_mtx = st_cam_mtx
         self.cam_dist = st_cam_dist
         self.proj_mtx = st_proj_mtx
@@ -384,7 +419,7 @@ class Calibration:
         np.savez(os.path.join(self.path, '{}_cam_rot_tvecs.npz'.format(self.type_unwrap)), cam_rvecs, cam_tvecs)
         return up_unwrapv_lst, up_unwraph_lst, up_white_lst, up_mod_lst, up_proj_img_lst, cam_objpts, cam_imgpts, proj_imgpts, euler_angles, cam_mean_error, cam_delta, proj_mean_error, proj_delta 
 
-    def calib_center_reconstruction(self, cam_imgpts, unwrap_phase, mask_lst, sigma_sqphi_lst, dark_bias_path, model_path):
+    def calib_center_reconstruction(self, cam_imgpts, unwrap_phase, mask_lst, sigma_sqphi_lst, dark_bias_path, model_path, plot=True):
         """
         This function is a wrapper function to reconstruct circle centers for each camera pose and compute error 
         with computed world projective coordinates in camera coordinate system.
@@ -395,6 +430,8 @@ class Calibration:
                     List of detected circle centers in camera images.
         unwrap_phase: np.ndarray.
                       Unwrapped phase map
+        plot: bool.
+              If set error plots are saved.
 
         Returns
         -------
@@ -404,6 +441,10 @@ class Calibration:
                       Data frame of absolute error for each pose all circle centers.
         center_cordi_lst: list.
                           List of x,y,z coordinates of detected circle centers in each calibration pose.
+        center_cordisigma_lst: list.
+                               List of standard deviations of x,y,z coordinates of the circle centers.
+        stats: dict.
+               Error statistics of the circle centers (center_err_statistics).
 
         """
         vectors = np.load(os.path.join(self.path, '{}_cam_rot_tvecs.npz'.format(self.type_unwrap)))
@@ -421,9 +462,9 @@ class Calibration:
         # Function call to get projective xyz for each pose
         proj_xyz_arr = self.project_validation(rvec, tvec, true_coordinates)
         # Error dataframes
-        delta_df, abs_delta_df = self.center_err_analysis(center_cordi_lst, proj_xyz_arr)
+        delta_df, abs_delta_df, stats = self.center_err_analysis(center_cordi_lst, proj_xyz_arr, plot)
         
-        return delta_df, abs_delta_df, center_cordi_lst, center_cordisigma_lst
+        return delta_df, abs_delta_df, center_cordi_lst, center_cordisigma_lst, stats
 
     def world_points(self):
         """
@@ -443,10 +484,11 @@ class Calibration:
     
     def multifreq_analysis(self, data_array, model):
         """
-        Helper function to compute unwrapped phase maps using multi frequency unwrapping on CPU.
+        Helper function to compute unwrapped phase maps using multi frequency unwrapping. The computation runs on the
+        backend of data_array, all arrays are returned as numpy.
         Parameters
         ----------
-        data_array: np.ndarray:float64.
+        data_array: np.ndarray/cp.ndarray:float64.
                     Array of images used in 4 level phase unwrapping.
         Returns
         -------
@@ -465,100 +507,49 @@ class Calibration:
         flag: np.ndarray.
               Flag to recover image from vector 
         """
-        modulation, orig_img, phase_map, mask = nstep.phase_cal(data_array, self.limit, self.N, True )
+        with span('phase_cal'):
+            modulation, orig_img, phase_map, mask = nstep.phase_cal(data_array, self.limit, self.N, True )
         phase_v = phase_map[::2]
         phase_h = phase_map[1::2]
-        phase_v[0][phase_v[0] < EPSILON] = phase_v[0][phase_v[0] < EPSILON] + 2 * np.pi
-        phase_h[0][phase_h[0] < EPSILON] = phase_h[0][phase_h[0] < EPSILON] + 2 * np.pi
-        unwrap_v, k_arr_v, mask_v = nstep.multifreq_unwrap(self.pitch, 
-                                                           phase_v, 
-                                                           self.kernel_v, 
-                                                           'v', 
-                                                           mask, 
-                                                           self.cam_width, 
-                                                           self.cam_height)
-        unwrap_h, k_arr_h, mask_h = nstep.multifreq_unwrap(self.pitch, 
-                                                           phase_h, 
-                                                           self.kernel_h, 
-                                                           'h', 
-                                                           mask,
-                                                           self.cam_width, 
-                                                           self.cam_height)
+        with span('unwrap'):
+            phase_v[0][phase_v[0] < EPSILON] = phase_v[0][phase_v[0] < EPSILON] + 2 * np.pi
+            phase_h[0][phase_h[0] < EPSILON] = phase_h[0][phase_h[0] < EPSILON] + 2 * np.pi
+            unwrap_v, k_arr_v, mask_v = nstep.multifreq_unwrap(self.pitch, 
+                                                               phase_v, 
+                                                               self.kernel_v, 
+                                                               'v', 
+                                                               mask, 
+                                                               self.cam_width, 
+                                                               self.cam_height)
+            unwrap_h, k_arr_h, mask_h = nstep.multifreq_unwrap(self.pitch, 
+                                                               phase_h, 
+                                                               self.kernel_h, 
+                                                               'h', 
+                                                               mask,
+                                                               self.cam_width, 
+                                                               self.cam_height)
         if model is not None:
-            cov_arr_v,_ = nstep.pred_var_fn(data_array[-2*self.N[-1]:-self.N[-1]], model)
-            sigma_sqphi_v = nstep.var_func(data_array[-2*self.N[-1]:-self.N[-1]],
-                                           mask_v,
-                                           self.N[-1],
-                                           cov_arr_v)
-            cov_arr_h,_ = nstep.pred_var_fn(data_array[-self.N[-1]:], model)
-            sigma_sqphi_h = nstep.var_func(data_array[-self.N[-1]:],
-                                           mask_v,
-                                           self.N[-1],
-                                           cov_arr_v)
+            with span('sigma'):
+                sigma_sqphi_v = nstep.var_func(data_array[-2*self.N[-1]:-self.N[-1]],
+                                               mask_v,
+                                               self.N[-1],
+                                               model)
+                sigma_sqphi_h = nstep.var_func(data_array[-self.N[-1]:],
+                                               mask_v,
+                                               self.N[-1],
+                                               model)
         else:
             sigma_sqphi_v = None
-            sigma_sqphi_h - None
-        return unwrap_v, unwrap_h, phase_v, phase_h, orig_img[-1], modulation, mask_v, mask_h, sigma_sqphi_v, sigma_sqphi_h
-    
+            sigma_sqphi_h = None
+        return tuple(to_numpy(a) for a in (unwrap_v, unwrap_h, phase_v, phase_h, orig_img[-1], modulation, mask_v,
+                                           mask_h, sigma_sqphi_v, sigma_sqphi_h))
+
     def multifreq_analysis_cupy(self, data_array, model):
         """
-        Helper function to compute unwrapped phase maps using multi frequency unwrapping on GPU.
-        After computation all arrays are returned as numpy.
-        Parameters
-        ----------
-        data_array: cp.ndarray:float64.
-                    Cupy array of images used in 4 level phase unwrapping.
-        Returns
-        -------
-        unwrap_v: cp.ndarray.
-                  Unwrapped phase map for vertical fringes.
-        unwrap_h: cp.ndarray.
-                  Unwrapped phase map for horizontal fringes.
-        phase_v: cp.ndarray.
-                 Wrapped phase maps for each pitch in vertical direction.
-        phase_h: cp.ndarray.
-                 Wrapped phase maps for each pitch in horizontal direction.
-        orig_img: cp.ndarray.
-                  True image without fringes.
-        modulation: cp.ndarray.
-                    Modulation intensity image of each pitch.
-        flag: cp.ndarray.
-              Flag to recover image from vector 
+        Helper function to compute unwrapped phase maps using multi frequency unwrapping on GPU, data_array is a cupy
+        array. Same as multifreq_analysis, which dispatches on the array backend.
         """
-        modulation, orig_img, phase_map, mask = nstep_cp.phase_cal_cp(data_array, self.limit, self.N, True )
-        phase_v = phase_map[::2]
-        phase_h = phase_map[1::2]
-        phase_v[0][phase_v[0] < EPSILON] = phase_v[0][phase_v[0] < EPSILON] + 2 * np.pi
-        phase_h[0][phase_h[0] < EPSILON] = phase_h[0][phase_h[0] < EPSILON] + 2 * np.pi
-        unwrap_v, k_arr_v,mask_v = nstep_cp.multifreq_unwrap_cp(self.pitch, 
-                                                                phase_v, 
-                                                                self.kernel_v, 
-                                                                'v',
-                                                                mask, 
-                                                                self.cam_width, 
-                                                                self.cam_height)
-        unwrap_h, k_arr_h,mask_h = nstep_cp.multifreq_unwrap_cp(self.pitch, 
-                                                                phase_h, 
-                                                                self.kernel_h, 
-                                                                'h',
-                                                                mask, 
-                                                                self.cam_width, 
-                                                                self.cam_height)
-        if model is not None:
-            cov_arr_v,_ = nstep_cp.pred_var_fn(data_array[-2*self.N[-1]:-self.N[-1]], model)
-            sigma_sqphi_v = nstep_cp.var_func(data_array[-2*self.N[-1]:-self.N[-1]],
-                                              mask_v,
-                                              self.N[-1],
-                                              cov_arr_v)
-            cov_arr_h,_ = nstep_cp.pred_var_fn(data_array[-self.N[-1]:], model)
-            sigma_sqphi_h = nstep_cp.var_func(data_array[-self.N[-1]:],
-                                              mask_v,
-                                              self.N[-1],
-                                              cov_arr_h)
-        else:
-            sigma_sqphi_v = None
-            sigma_sqphi_h - None
-        return cp.asnumpy(unwrap_v), cp.asnumpy(unwrap_h), cp.asnumpy(phase_v), cp.asnumpy(phase_h), cp.asnumpy(orig_img[-1]), cp.asnumpy(modulation), cp.asnumpy(mask_v), cp.asnumpy(mask_h), cp.asnumpy(sigma_sqphi_v), cp.asnumpy(sigma_sqphi_h)
+        return self.multifreq_analysis(data_array, model)
 
     def projcam_calib_img_multifreq(self, model):
         """
@@ -579,73 +570,135 @@ class Calibration:
                            List of vertical and horizontal phase maps
 
         """
-        maskv_lst = []
-        maskh_lst = []
-        mod_lst = []
-        white_lst = []
-        wrapv_lst = []
-        wraph_lst = []
-        unwrapv_lst = []
-        unwraph_lst = []
-        sigma_sqphi_lst = []
-        all_img_paths = sorted(glob.glob(os.path.join(self.path, 'capt_*')), key=os.path.getmtime)
-        acquisition_index_list = [int(i[-14:-11]) for i in all_img_paths]
-        for x in tqdm(acquisition_index_list,
-                      desc='generating unwrapped phases map for {} poses'.format(len(acquisition_index_list))):
-
-            if self.data_type == 'tiff':
-                if os.path.exists(os.path.join(self.path, 'capt_%03d_000000.tiff' % x)):
-                    img_path = sorted(glob.glob(os.path.join(self.path, 'capt_%03d*.tiff' % x)), key=os.path.getmtime)
-                    images_arr = np.array([cv2.imread(file, 0) for file in img_path]).astype(np.float64) - self.dark_bias
-                else:
-                    print("ERROR: path is not exist! None item appended to the result")
-                    images_arr = None
-            elif self.data_type == 'npy':
-                if os.path.exists(os.path.join(self.path, 'capt_%03d_000000.npy' % x)):
-                    images_arr = np.load(os.path.join(self.path, 'capt_%03d_000000.npy' % x)).astype(np.float64) - self.dark_bias
-                else:
-                    print("ERROR: path is not exist! None item appended to the result")
-                    images_arr = None
-            else:
-                print("ERROR: data type is not supported, must be '.tiff' or '.npy'.")
-                images_arr = None
+        pose_lst = self.multifreq_pose_lst(self.acquisition_indices(), model)
+        field = lambda name: [p[name] if p is not None else None for p in pose_lst]
+        if model is not None:
+            sigma_sqphi_lst = [list(i) for i in zip(field('sigma_sqphi_v'), field('sigma_sqphi_h'))]
+        else:
+            sigma_sqphi_lst = None
+        wrapped_phase_lst = {"wrapv": field('phase_v'),
+                             "wraph": field('phase_h')}
+        return field('unwrap_v'), field('unwrap_h'), field('white'), field('modulation'), wrapped_phase_lst, field('mask_v'), field('mask_h'), sigma_sqphi_lst
+
+    def pose_keys(self, index_list, model):
+        """
+        Function to get pose cache keys of calibration poses. A key depends on the content of captured images and on
+        dark bias, mask limit, N, pitch, kernels and noise model. Content of each pose is hashed once per instance.
+        Parameters
+        ----------
+        index_list: list.
+                    Acquisition indices of poses.
+        model: list/None.
+               Intensity noise model.
+        Returns
+        -------
+        keys: list.
+              Cache key of each pose, None if pose data does not exist.
+        """
+        params = PoseCache.key(self.type_unwrap,
+                               self.dark_bias,
+                               self.limit,
+                               list(self.N),
+                               list(self.pitch),
+                               self.kernel_v,
+                               self.kernel_h,
+                               to_numpy(model))
+        keys = []
+        for x in index_list:
+            if x not in self._content_hashes:
+                source = self.pose_source(x)
+                self._content_hashes[x] = PoseCache.content_hash(source) if source is not None else None
+            keys.append(PoseCache.key(self._content_hashes[x], params) if self._content_hashes[x] is not None else None)
+        return keys
 
+    def multifreq_pose_lst(self, index_list, model):
+        """
+        Function to get multi frequency analysis of each pose from the pose cache. Poses not in the cache are loaded,
+        analysed with multifreq_analysis and added to the cache.
+        Parameters
+        ----------
+        index_list: list.
+                    Acquisition indices of poses.
+        model: list/None.
+               Intensity noise model.
+        Returns
+        -------
+        pose_lst: list.
+                  Dictionary of unwrap_v, unwrap_h, phase_v, phase_h, white, modulation, mask_v, mask_h, sigma_sqphi_v 
+                  and sigma_sqphi_h for each pose, None if pose data does not exist. All fields are cached, so the
+                  result does not depend on the cache state.
+        """
+        keys = self.pose_keys(index_list, model)
+        pose_lst = [self.pose_cache.load(k) if k is not None else None for k in keys]
+        sources = [self.pose_source(x) if (k is not None) and (p is None) else None
+                   for x, k, p in zip(index_list, keys, pose_lst)]
+        reused = len(pose_lst) - pose_lst.count(None)
+        loader = CaptureLoader(self.dark_bias)
+        frames = loader.prefetch(sources)
+        for i in tqdm(range(len(sources)), desc='generating unwrapped phases map for {} poses'.format(len(sources))):
+            # waiting time for the prefetched pose
+            with span('load'):
+                images_arr = next(frames)
             if images_arr is not None:
-                if self.processing == 'cpu':
-                   unwrap_v, unwrap_h, phase_v, phase_h, orig_img, modulation, mask_v, mask_h, sigma_sqphi_v, sigma_sqphi_h = self.multifreq_analysis(images_arr, model)
-                else:
-                    if self.processing != 'gpu':
-                        print("WARNING: processing type is not recognized, use 'gpu'")
-                    images_arr = cp.asarray(images_arr)
-                    unwrap_v, unwrap_h, phase_v, phase_h, orig_img, modulation, mask_v, mask_h, sigma_sqphi_v, sigma_sqphi_h = self.multifreq_analysis_cupy(images_arr, model)
-                    cp._default_memory_pool.free_all_blocks()
-                    
-            else:
-                unwrap_v = None
-                unwrap_h = None
-                phase_v = None
-                phase_h = None
-                orig_img = None
-                modulation = None
-                mask_v = None
-                mask_h = None
-                sigma_sqphi_lst = None
-            maskv_lst.append(mask_v)
-            maskh_lst.append(mask_h)
-            mod_lst.append(modulation)
-            white_lst.append(orig_img)
-            wrapv_lst.append(phase_v)
-            wraph_lst.append(phase_h)
-            unwrapv_lst.append(unwrap_v)
-            unwraph_lst.append(unwrap_h)
-            if model is not None:
-                sigma_sqphi_lst.append([sigma_sqphi_v,sigma_sqphi_h])
-            else:
-                sigma_sqphi_lst = None
+                result = self.multifreq_analysis(self.backend.asarray(images_arr), model)
+                self.backend.free_memory()
+                pose_lst[i] = dict(zip(POSE_FIELDS, result))
+                self.pose_cache.save(keys[i], **pose_lst[i])
+            elif pose_lst[i] is not None:
+                pose_lst[i] = {f: pose_lst[i].get(f) for f in POSE_FIELDS}
+        loader.report()
+        loader.close()
+        print(" Pose cache: %d of %d poses reused" % (reused, len(index_list)))
+        return pose_lst
 
-        wrapped_phase_lst = {"wrapv": wrapv_lst,
-                             "wraph": wraph_lst}
-        return unwrapv_lst, unwraph_lst, white_lst, mod_lst, wrapped_phase_lst, maskv_lst, maskh_lst, sigma_sqphi_lst
+    def acquisition_indices(self):
+        """
+        Function to get acquisition indices of captured calibration poses.
+        Returns
+        -------
+        acquisition_index_list: list.
+                                Indices from the scan archive index, otherwise from capture file names sorted by 
+                                modification time.
+        """
+        if self.data_type == 'archive':
+            return self.scan_archive().poses
+        all_img_paths = sorted(glob.glob(os.path.join(self.path, 'capt_*')), key=os.path.getmtime)
+        return [int(i[-14:-11]) for i in all_img_paths]
+
+    def scan_archive(self):
+        """
+        Scan archive of calibration session, opened once.
+        """
+        if self.archive is None:
+            self.archive = ScanArchive(os.path.join(self.path, SCAN_ARCHIVE))
+        return self.archive
+
+    def pose_source(self, x):
+        """
+        Function to get the captured image source of a calibration pose for CaptureLoader.
+        Parameters
+        ----------
+        x: int.
+           Acquisition index of pose.
+        Returns
+        -------
+        source: list/str.
+                Sorted list of tiff frame paths, .npy stack path or scan archive memory map, None if data does not exist.
+        """
+        if self.data_type == 'tiff':
+            if os.path.exists(os.path.join(self.path, 'capt_%03d_000000.tiff' % x)):
+                return sorted(glob.glob(os.path.join(self.path, 'capt_%03d*.tiff' % x)), key=os.path.getmtime)
+        elif self.data_type == 'npy':
+            if os.path.exists(os.path.join(self.path, 'capt_%03d_000000.npy' % x)):
+                return os.path.join(self.path, 'capt_%03d_000000.npy' % x)
+        elif self.data_type == 'archive':
+            if x in self.scan_archive():
+                return self.scan_archive().open(x)
+        else:
+            print("ERROR: data type is not supported, must be '.tiff', '.npy' or 'archive'.")
+            return None
+        print("ERROR: path is not exist! None item appended to the result")
+        return None
 
     def projcam_calib_img_multiwave(self):
         """
@@ -683,8 +736,7 @@ class Calibration:
         
         pitch_arr = np.insert(pitch_arr, 0, eq_wav123)
         pitch_arr = np.insert(pitch_arr, 2, eq_wav12)
-        all_img_paths = sorted(glob.glob(os.path.join(self.path, 'capt_*')), key=os.path.getmtime)
-        acquisition_index_list = [int(i[-14:-11]) for i in all_img_paths]
+        acquisition_index_list = self.acquisition_indices()
         for x in tqdm(acquisition_index_list, desc='generating unwrapped phases map for {} images'.format(len(acquisition_index_list))):
             if os.path.exists(os.path.join(self.path, 'capt_%03d_000000.tiff' % x)):
                 img_path = sorted(glob.glob(os.path.join(self.path, 'capt_%3d*.tiff' % x)), key=os.path.getmtime)
@@ -744,7 +796,7 @@ class Calibration:
                 resize_img_lst.append(cv2.resize(i, None, fx=fx, fy=fy))
         return resize_img_lst
 
-    def projector_img(self, unwrap_v_lst, unwrap_h_lst, white_lst, fx, fy):
+    def projector_img(self, unwrap_v_lst, unwrap_h_lst, white_lst, fx, fy, workers=None):
         """
         Function to generate projector image using absolute phase maps from horizontally and vertically varying patterns.
         Parameters
@@ -759,6 +811,8 @@ class Calibration:
             Scale factor along the horizontal axis.
         fy: float.
             Scale factor along the vertical axis
+        workers: int.
+                 Number of threads computing projector images of poses. Default is number of cpus, up to 8.
         Returns
         -------
         proj_img: list.
@@ -768,40 +822,158 @@ class Calibration:
         unwrap_v_lst = Calibration._image_resize(unwrap_v_lst, fx, fy)
         unwrap_h_lst = Calibration._image_resize(unwrap_h_lst, fx, fy)
         white_lst = Calibration._image_resize(white_lst, fx, fy)
-        proj_img = []
-        for i in tqdm(range(0, len(unwrap_v_lst)), desc='projector images'):
-            # Convert phase map to coordinates
-            if white_lst[i] is not None:
-                unwrap_proj_u = (unwrap_v_lst[i] - self.phase_st) * self.pitch[-1] / (2 * np.pi)
-                unwrap_proj_v = (unwrap_h_lst[i] - self.phase_st) * self.pitch[-1] / (2 * np.pi)
-                unwrap_proj_u = unwrap_proj_u.astype(int)
-                unwrap_proj_v = unwrap_proj_v.astype(int)
-                
-                orig_u = unwrap_proj_u.ravel()
-                orig_v = unwrap_proj_v.ravel()
-                orig_int = white_lst[i].ravel()
-                orig_data = np.column_stack((orig_u, orig_v, orig_int))
-                orig_df = pd.DataFrame(orig_data, columns=['u', 'v', 'int'])
-                orig_new = orig_df.groupby(['u', 'v'])['int'].mean().reset_index()
-                
-                proj_y = np.arange(0, self.proj_height)
-                proj_x = np.arange(0, self.proj_width)
-                proj_u, proj_v = np.meshgrid(proj_x, proj_y)
-                proj_data = np.column_stack((proj_u.ravel(), proj_v.ravel()))
-                proj_df = pd.DataFrame(proj_data, columns=['u', 'v'])
-        
-                proj_df_merge = pd.merge(proj_df, orig_new, how='left', on=['u', 'v'])
-                proj_df_merge['int'] = proj_df_merge['int'].fillna(0)
-        
-                proj_mean_img = proj_df_merge['int'].to_numpy()
-                proj_mean_img = proj_mean_img.reshape(self.proj_height, self.proj_width)
-                proj_mean_img = cv2.normalize(proj_mean_img, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
-                proj_img.append(proj_mean_img)
-            else:
-                proj_img.append(None)        
+        index = range(0, len(unwrap_v_lst))
+        pose_img = lambda i: self.projector_image(unwrap_v_lst[i], unwrap_h_lst[i], white_lst[i]) if white_lst[i] is not None else None
+        workers = workers if workers else min(8, os.cpu_count() or 1)
+        if workers == 1:
+            proj_img = [pose_img(i) for i in tqdm(index, desc='projector images')]
+        else:
+            with ThreadPoolExecutor(workers) as pool:
+                proj_img = list(tqdm(pool.map(pose_img, index), total=len(index), desc='projector images'))
         return proj_img
+
+    def projector_image(self, unwrap_v, unwrap_h, white):
+        """
+        Function to generate projector image of one pose. Camera intensities are accumulated at the projector pixel
+        given by the absolute phase maps and averaged, projector pixels without camera pixels are 0.
+        Parameters
+        ----------
+        unwrap_v: np.ndarray.
+                  Unwrapped absolute phase map from horizontally varying pattern.
+        unwrap_h: np.ndarray.
+                  Unwrapped absolute phase map from vertically varying pattern.
+        white: np.ndarray.
+               True object image (without patterns).
+        Returns
+        -------
+        proj_mean_img: np.ndarray:uint8.
+                       Projector image.
+        """
+        # Convert phase map to coordinates
+        unwrap_proj_u = ((unwrap_v - self.phase_st) * self.pitch[-1] / (2 * np.pi)).ravel()
+        unwrap_proj_v = ((unwrap_h - self.phase_st) * self.pitch[-1] / (2 * np.pi)).ravel()
+        orig_int = white.ravel()
+        # nan phase or intensity and coordinates outside projector do not contribute, truncation as astype(int)
+        valid = ((unwrap_proj_u > -1) & (unwrap_proj_u < self.proj_width) &
+                 (unwrap_proj_v > -1) & (unwrap_proj_v < self.proj_height) & ~np.isnan(orig_int))
+        proj_idx = unwrap_proj_v[valid].astype(int) * self.proj_width + unwrap_proj_u[valid].astype(int)
+        int_sum = np.bincount(proj_idx, weights=orig_int[valid], minlength=self.proj_width * self.proj_height)
+        int_count = np.bincount(proj_idx, minlength=self.proj_width * self.proj_height)
+        proj_mean_img = np.zeros(self.proj_width * self.proj_height)
+        np.divide(int_sum, int_count, out=proj_mean_img, where=int_count > 0)
+        proj_mean_img = proj_mean_img.reshape(self.proj_height, self.proj_width)
+        return cv2.normalize(proj_mean_img, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
     
-    def camera_calib(self, objp, white_lst, display=True):
+    def detection_key(self, pose_key):
+        """
+        Function to get the pose cache key of circle detections and projector image points of a pose.
+        Parameters
+        ----------
+        pose_key: str/None.
+                  Pose cache key from pose_keys.
+        Returns
+        -------
+        key: str.
+             Cache key depending on pose key and detection parameters, None if pose_key is None.
+        """
+        if pose_key is None:
+            return None
+        return PoseCache.key(pose_key,
+                             'circles',
+                             self.board_gridrows,
+                             self.board_gridcolumns,
+                             self.bobdetect_areamin,
+                             self.bobdetect_convexity)
+
+    def blob_detector(self):
+        """
+        Function to create OpenCV blob detector used to detect circle centers.
+        """
+        # Set bob detector properties
+        blobParams = cv2.SimpleBlobDetector_Params()
+        
+        # color
+        blobParams.filterByColor = True
+        blobParams.blobColor = 255
+    
+        # Filter by Area.
+        blobParams.filterByArea = True
+        blobParams.minArea = self.bobdetect_areamin  # 2000
+        
+        # Convexity
+        blobParams.filterByConvexity = True
+        blobParams.minConvexity = self.bobdetect_convexity
+        
+        return cv2.SimpleBlobDetector_create(blobParams)
+
+    def circle_centers(self, white, blobDetector, det_key=None):
+        """
+        Function to detect circle grid centers in true image of a pose.
+        Parameters
+        ----------
+        white: np.ndarray:uint8.
+               True image of pose.
+        blobDetector: cv2.SimpleBlobDetector.
+                      Blob detector from blob_detector.
+        det_key: str/None.
+                 Detection cache key. If given detection is read from and saved to the pose cache.
+        Returns
+        -------
+        ret: bool.
+             True if circle grid is found.
+        corners: np.ndarray.
+                 Circle center grid coordinates, None if grid is not found.
+        """
+        detection = self.pose_cache.load(det_key) if det_key is not None else None
+        if detection is not None:
+            return bool(detection['ret']), detection.get('corners')
+        white_color = cv2.cvtColor(white, cv2.COLOR_GRAY2RGB)
+        keypoints = blobDetector.detect(white)  # Detect blobs.
+      
+        # Draw detected blobs as green circles. This helps cv2.findCirclesGrid() .
+        im_with_keypoints = cv2.drawKeypoints(white_color, keypoints, np.array([]), (0, 255, 0),
+                                              cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS,
+                                              )
+        im_with_keypoints_gray = cv2.cvtColor(im_with_keypoints, cv2.COLOR_BGR2GRAY)
+        
+        ret, corners = cv2.findCirclesGrid(im_with_keypoints_gray, (self.board_gridrows, self.board_gridcolumns), None, 
+                                           flags=cv2.CALIB_CB_ASYMMETRIC_GRID+cv2.CALIB_CB_CLUSTERING,
+                                           blobDetector=blobDetector)  # Find the circle grid
+        if det_key is not None:
+            self.pose_cache.save(det_key, ret=np.array(ret), corners=corners if ret else None)
+        return ret, corners
+
+    def projector_points(self, unwrap_v, unwrap_h, centers, det_key=None):
+        """
+        Function to map circle centers to projector image coordinates using absolute phase maps.
+        Parameters
+        ----------
+        unwrap_v: np.ndarray.
+                  Absolute phase map for horizontally varying patterns.
+        unwrap_h: np.ndarray.
+                  Absolute phase map for vertically varying patterns.
+        centers: np.ndarray.
+                 Circle centers (no. of circles x 2).
+        det_key: str/None.
+                 Detection cache key. If given projector points are read from and saved to the pose cache together 
+                 with the centers they were computed from.
+        Returns
+        -------
+        coordi: np.ndarray:float32.
+                Projector image coordinates of circle centers (no. of circles x 1 x 2).
+        """
+        detection = self.pose_cache.load(det_key) if det_key is not None else None
+        if (detection is not None) and ('proj_imgpts' in detection) and np.array_equal(detection['proj_centers'], centers):
+            return detection['proj_imgpts']
+        # Phase to coordinate conversion
+        u = (nstep.bilinear_interpolate(unwrap_v, centers[:,0], centers[:,1])[0] - self.phase_st) * self.pitch[-1] / (2*np.pi)
+        v = (nstep.bilinear_interpolate(unwrap_h, centers[:,0], centers[:,1])[0] - self.phase_st) * self.pitch[-1] / (2*np.pi)
+        coordi = np.column_stack((u, v)).reshape(centers.shape[0], 1, 2).astype(np.float32)
+        if det_key is not None:
+            self.pose_cache.update(det_key, proj_centers=centers, proj_imgpts=coordi)
+        return coordi
+
+    def camera_calib(self, objp, white_lst, display=True, pose_keys=None):
         """
         Function to calibrate camera using asymmetric circle pattern. 
         OpenCV bob detector is used to detect circle centers which is used for calibration.
@@ -814,6 +986,9 @@ class Calibration:
                    List of calibration poses used for calibrations.
         display: bool.
                  If set each calibration drawings are displayed.
+        pose_keys: list/None.
+                   Pose cache keys of poses in white_lst. If given circle detections are read from and saved to the 
+                   pose cache.
         Returns
         -------
         r_error: float.
@@ -832,23 +1007,8 @@ class Calibration:
                    Array of translational vectors for each calibration pose.
     
         """
-        # Set bob detector properties
         criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
-        blobParams = cv2.SimpleBlobDetector_Params()
-        
-        # color
-        blobParams.filterByColor = True
-        blobParams.blobColor = 255
-    
-        # Filter by Area.
-        blobParams.filterByArea = True
-        blobParams.minArea = self.bobdetect_areamin  # 2000
-        
-        # Convexity
-        blobParams.filterByConvexity = True
-        blobParams.minConvexity = self.bobdetect_convexity
-        
-        blobDetector = cv2.SimpleBlobDetector_create(blobParams)
+        blobDetector = self.blob_detector()
         objpoints = []  # 3d point in real world space
         cam_imgpoints = []  # 2d points in image plane.
         found = 0
@@ -857,22 +1017,13 @@ class Calibration:
         count_lst = []
         ret_lst = []
         
-        for white in white_lst:
+        for i, white in enumerate(white_lst):
             # Convert float image to uint8 type image.
             if white is not None:
                 white = cv2.normalize(white, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U) 
                 white_color = cv2.cvtColor(white, cv2.COLOR_GRAY2RGB)  # only for drawing purpose
-                keypoints = blobDetector.detect(white)  # Detect blobs.
-              
-                # Draw detected blobs as green circles. This helps cv2.findCirclesGrid() .
-                im_with_keypoints = cv2.drawKeypoints(white_color, keypoints, np.array([]), (0, 255, 0),
-                                                      cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS,
-                                                      )
-                im_with_keypoints_gray = cv2.cvtColor(im_with_keypoints, cv2.COLOR_BGR2GRAY)
-                
-                ret, corners = cv2.findCirclesGrid(im_with_keypoints_gray, (self.board_gridrows, self.board_gridcolumns), None, 
-                                                   flags=cv2.CALIB_CB_ASYMMETRIC_GRID+cv2.CALIB_CB_CLUSTERING,
-                                                   blobDetector=blobDetector)  # Find the circle grid
+                det_key = self.detection_key(pose_keys[i]) if pose_keys is not None else None
+                ret, corners = self.circle_centers(white, blobDetector, det_key)
                 ret_lst.append(ret)
                 
                 if ret:
@@ -921,7 +1072,8 @@ class Calibration:
                    cam_imgpts, 
                    unwrap_v_lst, 
                    unwrap_h_lst, 
-                   proj_img_lst=None):
+                   proj_img_lst=None,
+                   pose_keys=None):
         """
         Function to calibrate projector by using absolute phase maps. 
         Circle centers detected using OpenCV is mapped to the absolute phase maps and the corresponding projector image coordinate for the centers are calculated.
@@ -941,6 +1093,9 @@ class Calibration:
         proj_img_lst: list/None.
                       List of computed projector image for each calibration pose.
                       If it is None calibration drawing is not diaplayed.
+        pose_keys: list/None.
+                   Pose cache keys of poses. If given projector image points are read from and saved to the pose cache
+                   together with the circle centers they were computed from.
         Returns
         -------
         r_error: float.
@@ -960,10 +1115,8 @@ class Calibration:
         centers = [i.reshape(cam_objpts[0].shape[0], 2) for i in cam_imgpts]
         proj_imgpts = []
         for x, c in enumerate(centers):
-            # Phase to coordinate conversion for each pose
-            u = (nstep.bilinear_interpolate(unwrap_v_lst[x], c[:,0], c[:,1])[0] - self.phase_st) * self.pitch[-1] / (2*np.pi)
-            v = (nstep.bilinear_interpolate(unwrap_h_lst[x], c[:,0], c[:,1])[0] - self.phase_st) * self.pitch[-1] / (2*np.pi)
-            coordi = np.column_stack((u, v)).reshape(cam_objpts[0].shape[0], 1, 2).astype(np.float32)
+            det_key = self.detection_key(pose_keys[x]) if pose_keys is not None else None
+            coordi = self.projector_points(unwrap_v_lst[x], unwrap_h_lst[x], c, det_key)
             proj_imgpts.append(coordi)
             if proj_img_lst is not None:
                 proj_color = cv2.cvtColor(proj_img_lst[x], cv2.COLOR_GRAY2RGB)  # only for drawing
@@ -1121,7 +1274,7 @@ class Calibration:
         """
         xaxis = np.arange(0, len(mean_error), dtype=int)
         ax = plt.figure().gca()
-        ax.xaxis.set_major_locator(MaxNLocator(integer=True))
+        ax.xaxis.set_major_locator(ticker.MaxNLocator(integer=True))
         ax.bar(xaxis, mean_error)
         ax.set_title("{} mean error per pose ".format(dev), fontsize=30)
         ax.set_xlabel('Pose', fontsize=20)
@@ -1170,11 +1323,13 @@ class Calibration:
                       Camera projector translational matrix.
         Returns
         -------
-        center_cordi_lst: list.
-                          Array of x,y,z coordinates of detected circle centers in each calibration pose.
-
+        center_cordi_lst: np.ndarray.
+                          Array of x,y,z coordinates of detected circle centers in each calibration pose 
+                          (no. of poses x no. of circles x 3).
+        center_sigma_lst: np.ndarray.
+                          Standard deviation of coordinates, same shape as center_cordi_lst. None if sigma_sqphi_lst 
+                          is None.
         """
-        center_cordi_lst = []; center_sigma_lst = []
         reconst_instance = rc.Reconstruction(proj_width=self.proj_width,
                                               proj_height=self.proj_height,
                                               cam_width=self.cam_width,
@@ -1186,7 +1341,7 @@ class Calibration:
                                               fringe_direc='v',
                                               kernel=7,
                                               data_type='tiff',
-                                              processing='gpu',
+                                              processing=self.processing,
                                               dark_bias_path=dark_bias_path,
                                               calib_path=self.path,
                                               object_path=self.path,
@@ -1194,14 +1349,13 @@ class Calibration:
                                               temp=False,
                                               save_ply=True,
                                               probability=False)
-        for i in tqdm(range(0, len(center_pts)), desc='building camera centers 3d coordinates'):
-            # undistort points
-            reconst_instance.mask = mask_lst[i]
-            unwrap_vect = unwrap_phase[i][mask_lst[i]]
-            cordi, cord_sigma = reconst_instance.reconstruction_pts(center_pts[i], unwrap_vect,  sigma_sqphi_lst[i])
-            center_cordi_lst.append(cordi)
-            center_sigma_lst.append(cord_sigma)
-        return np.array(center_cordi_lst), np.array(center_sigma_lst)
+        # phase variance of vertical fringes, the direction of unwrap_phase
+        sigmasq_lst = [s[0] for s in sigma_sqphi_lst] if sigma_sqphi_lst is not None else None
+        center_cordi_arr, center_sigma_arr = reconst_instance.reconstruction_pts(center_pts,
+                                                                                 unwrap_phase,
+                                                                                 sigmasq_lst,
+                                                                                 mask_lst)
+        return center_cordi_arr, center_sigma_arr
 
     # Projective coordinates based on camera - projector extrinsics
     def project_validation(self, rvec, tvec, true_coordinates):
@@ -1219,24 +1373,17 @@ class Calibration:
                          Defined world coordinates of circle centers.
         Returns
         -------
-        proj_xyz_lst: list.
-                      Array of projective coordinates each calibration poses.
+        proj_xyz_lst: np.ndarray.
+                      Array of projective coordinates each calibration poses (no. of poses x no. of circles x 3).
         """
         t = np.ones((true_coordinates.shape[0], 1))
         homo_true_cordi = np.hstack((true_coordinates, t))
-        homo_true_cordi = homo_true_cordi.reshape((homo_true_cordi.shape[0], homo_true_cordi.shape[1], 1))
-        proj_xyz_lst = []
-        for i in tqdm(range(0, len(tvec)), desc='projective centers'):
-            rvec_mtx = cv2.Rodrigues(rvec[i])[0]
-            h_vecs = np.hstack((rvec_mtx, tvec[i]))
-            updated_hvecs = np.repeat(h_vecs[np.newaxis, :, :], true_coordinates.shape[0], axis=0)
-            proj_xyz = updated_hvecs @ homo_true_cordi
-            proj_xyz = proj_xyz.reshape((proj_xyz.shape[0], proj_xyz.shape[1]))
-            proj_xyz_lst.append(proj_xyz)
-        return np.array(proj_xyz_lst)
+        # pose extrinsics [R|t] stacked as no. of poses x 3 x 4
+        h_vecs = np.array([np.hstack((cv2.Rodrigues(r)[0], np.reshape(tv, (3, 1)))) for r, tv in zip(rvec, tvec)])
+        return np.einsum('pij,nj->pni', h_vecs, homo_true_cordi)
 
     # Calculate error = center reconstruction - projector coordinates
-    def center_err_analysis(self, cordi_arr, proj_xyz_arr):
+    def center_err_analysis(self, cordi_arr, proj_xyz_arr, plot=True):
         """
         Function to compute error of 3d coordinates of detected circle centers from projective coordinates 
         in camera coordinate.
@@ -1247,39 +1394,77 @@ class Calibration:
                   Array of x,y,z coordinates of detected circle centers in each calibration pose.
         proj_xyz_arr: np.array.
                       Array of projective coordinates for each calibration poses.
+        plot: bool.
+              If set error plots are saved (center_err_plot).
         Returns
         -------
         delta_df: pandas dataframe.
                   Data frame of error for each pose all circle centers.
         abs_delta_df: pandas dataframe.
                       Data frame of absolute error for each pose all circle centers.
+        stats: dict.
+               Error statistics of the circle centers (center_err_statistics).
         """
-        delta = cordi_arr-proj_xyz_arr
-        abs_delta = abs(cordi_arr-proj_xyz_arr)
+        delta = np.asarray(cordi_arr) - np.asarray(proj_xyz_arr)
+        poses = pd.Index(np.repeat(np.arange(delta.shape[0]), delta.shape[1]), name='Poses')
+        delta_df = pd.DataFrame(delta.reshape(-1, 3), index=poses, columns=['delta_x', 'delta_y', 'delta_z'])
+        abs_delta_df = pd.DataFrame(np.abs(delta).reshape(-1, 3), index=poses, 
+                                    columns=['abs$(\Delta x)$', 'abs$(\Delta y)$', 'abs$(\Delta z)$'])
+        stats = Calibration.center_err_statistics(cordi_arr, proj_xyz_arr)
+        if plot:
+            self.center_err_plot(delta, abs_delta_df, stats)
+        return delta_df, abs_delta_df, stats
 
-        delta_df = pd.DataFrame([list(l) for l in delta]).stack().apply(pd.Series).reset_index(1, drop=True)
-        delta_df.index.name = 'Poses'
-        delta_df.columns = ['delta_x', 'delta_y', 'delta_z']
+    @staticmethod
+    def center_err_statistics(cordi_arr, proj_xyz_arr):
+        """
+        Function to compute error statistics of reconstructed circle centers w.r.t. projective coordinates.
+        Nan coordinates (centers that could not be reconstructed) are ignored.
 
-        abs_delta_df = pd.DataFrame([list(l) for l in abs_delta]).stack().apply(pd.Series).reset_index(1, drop=True)
-        abs_delta_df.index.name = 'Poses'
-        abs_delta_df.columns = ['abs$(\Delta x)$', 'abs$(\Delta y)$', 'abs$(\Delta z)$']
+        Parameters
+        ----------
+        cordi_arr: np.array.
+                   Array of x,y,z coordinates of detected circle centers (no. of poses x no. of circles x 3).
+        proj_xyz_arr: np.array.
+                      Array of projective coordinates, same shape as cordi_arr.
+        Returns
+        -------
+        stats: dict.
+               mean_abs, std_abs (sample std), rms and max_abs of x, y, z error over all centers (3,),
+               pose_mean_abs and pose_rms of each pose (no. of poses x 3).
+        """
+        delta = np.asarray(cordi_arr) - np.asarray(proj_xyz_arr)
+        abs_delta = np.abs(delta)
+        all_abs = abs_delta.reshape(-1, 3)
+        return {'mean_abs': np.nanmean(all_abs, axis=0),
+                'std_abs': np.nanstd(all_abs, axis=0, ddof=1),
+                'rms': np.sqrt(np.nanmean(all_abs**2, axis=0)),
+                'max_abs': np.nanmax(all_abs, axis=0),
+                'pose_mean_abs': np.nanmean(abs_delta, axis=1),
+                'pose_rms': np.sqrt(np.nanmean(abs_delta**2, axis=1))}
 
-        g_delta = delta_df.groupby(delta_df.index)
-        delta_group = [g_delta.get_group(x) for x in g_delta.groups]
+    def center_err_plot(self, delta, abs_delta_df, stats):
+        """
+        Function to plot errors of reconstructed circle centers, plots are saved as error.png and abs_err.png in path.
 
-        n_colors = len(delta_group)  # no. of poses
+        Parameters
+        ----------
+        delta: np.array.
+               Error of x,y,z coordinates of circle centers (no. of poses x no. of circles x 3).
+        abs_delta_df: pandas dataframe.
+                      Data frame of absolute error for each pose all circle centers.
+        stats: dict.
+               Error statistics of the circle centers (center_err_statistics), mean and std are shown in the histogram.
+        """
+        n_colors = len(delta)  # no. of poses
         cm = plt.get_cmap('gist_rainbow')
         fig = plt.figure(figsize=(16, 15))
         fig.suptitle(' Error in reconstructed coordinates compared to true coordinates ', fontsize=20)
         ax = plt.axes(projection='3d')
         ax.set_prop_cycle(color=[cm(1.*i/n_colors) for i in range(n_colors)])
         # cm = plt.get_cmap('gist_rainbow')
-        for i in range(0, len(delta_group)):
-            x1 = delta_group[i]['delta_x']
-            y1 = delta_group[i]['delta_y']
-            z1 = delta_group[i]['delta_z']
-            ax.scatter(x1, y1, z1, label='Pose %d' % i)
+        for i in range(0, len(delta)):
+            ax.scatter(delta[i, :, 0], delta[i, :, 1], delta[i, :, 2], label='Pose %d' % i)
         ax.set_xlabel('$\Delta x$ (mm)', fontsize=20, labelpad=10)
         ax.set_ylabel('$\Delta y$ (mm)', fontsize=20, labelpad=10)
         ax.set_zlabel('$\Delta z$ (mm)', fontsize=20, labelpad=10)
@@ -1293,8 +1478,8 @@ class Calibration:
         fig.suptitle('Abs error histogram of all poses compared to true coordinates', fontsize=20)
         abs_plot = sns.histplot(abs_delta_df, multiple="layer")
         labels = ['$\Delta x$', '$\Delta y$', '$\Delta z$']
-        mean_deltas = abs_delta_df.mean()
-        std_deltas = abs_delta_df.std()
+        mean_deltas = stats['mean_abs']
+        std_deltas = stats['std_abs']
         ax.text(0.7, 0.8, 'Mean', fontsize=20, horizontalalignment='center',
                 verticalalignment='center', transform=ax.transAxes)
         ax.text(0.85, 0.8, 'Std', fontsize=20, horizontalalignment='center',
@@ -1321,7 +1506,7 @@ class Calibration:
         plt.setp(abs_plot.get_legend().get_texts(), fontsize='20') 
         plt.savefig(os.path.join(self.path, 'abs_err.png'), bbox_inches="tight")
         
-        return delta_df, abs_delta_df
+        return
     
     def recon_xyz(self,
                   unwrap_phase,  
@@ -1381,20 +1566,14 @@ class Calibration:
             else:
                 w = w[m]
                 point_cloud_dir = os.path.join(self.path, 'modulation_mask') 
-            xyz = list(map(tuple, cordi)) 
             inte_img = (w/ np.nanmax(w)).ravel()
             inte_rgb = np.stack((inte_img, inte_img, inte_img), axis=-1)
-            color = list(map(tuple, inte_rgb))
             cordi_lst.append(cordi)
             color_lst.append(inte_rgb)
             if not os.path.exists(point_cloud_dir):
                 os.makedirs(point_cloud_dir)
                 
-            PlyData(
-                [
-                    PlyElement.describe(np.array(xyz, dtype=[('x', 'f4'), ('y', 'f4'), ('z', 'f4')]), 'points'),
-                    PlyElement.describe(np.array(color, dtype=[('r', 'f4'), ('g', 'f4'), ('b', 'f4')]), 'color'),
-                ]).write(os.path.join(point_cloud_dir, 'obj_%d.ply' % i))
+            rc.write_ply(os.path.join(point_cloud_dir, 'obj_%d.ply' % i), cordi, color=inte_rgb)
         
             
         if resid_outlier_limit:
@@ -1403,7 +1582,7 @@ class Calibration:
         else:
             return cordi_lst, color_lst
     
-    def white_center_planefit(self, cordi_lst, resid_outlier_limit):
+    def white_center_planefit(self, cordi_lst, resid_outlier_limit, trim_iterations=0, plot=True):
         """
         Function to fit plane to extracted white region of calibration board. The function computes the plane and 
         calculates distance of points to the plane (residue) for each calibration pose.
@@ -1415,6 +1594,10 @@ class Calibration:
                    List of 3d coordinates of white points.
         resid_outlier_limit: float.
                              This parameter is used to eliminate outlier points (points too far).
+        trim_iterations: int.
+                         Number of plane refits excluding outlier points. With 0 the plane is fitted to all points.
+        plot: bool.
+              If set histogram of residue is plotted.
 
         Returns
         -------
@@ -1426,19 +1609,14 @@ class Calibration:
         """
         residual_lst = []
         outlier_lst = []
-        for i in tqdm(cordi_lst, desc='residual calculation for each pose'):
-            xcord = i[:, 0]
-            xcord = xcord[~np.isnan(xcord)]
-            ycord = i[:, 1]
-            ycord = ycord[~np.isnan(ycord)]
-            zcord = i[:, 2]
-            zcord = zcord[~np.isnan(zcord)]
-            fit, residual = plane_fit(xcord, ycord, zcord)
+        fit, residuals = plane_fit_batch(cordi_lst, resid_outlier_limit, trim_iterations)
+        for residual in residuals:
             outliers = residual[(residual < -resid_outlier_limit) | (residual > resid_outlier_limit)]
             updated_resid = residual[(residual > -resid_outlier_limit) & (residual < resid_outlier_limit)]
             residual_lst.append(updated_resid)
             outlier_lst.append(outliers)
-        plane_resid_plot(residual_lst)
+        if plot:
+            plane_resid_plot(residual_lst)
         return residual_lst, outlier_lst
     
     def pp_distance_analysis(self, center_cordi_lst, val_label):
@@ -1492,24 +1670,49 @@ class Calibration:
     
     
     @staticmethod
-    def sample_indices(delta_pose, pool_size_list, no_sample_sets):
+    def sample_index(delta_pose, pool_size, rng=np.random):
+        """
+        Function to draw one bootstrap sample set of poses. Equal number of poses are drawn from each of the 4 
+        directions, remaining poses are drawn from all poses.
+        Parameters
+        ----------
+        delta_pose: int.
+                    Number of poses in each of the 4 directions.
+        pool_size: int.
+                   Number of poses in sample set.
+        rng: np.random.Generator.
+             Random generator. Default is global numpy random state.
+        Returns
+        -------
+        sample_index: np.ndarray.
+                      Sorted acquisition indices of sample set.
+        """
+        sub_sample_size = int(pool_size/4) # no of poses from each delta_pose
+        left = np.arange(0, delta_pose)
+        right = np.arange(delta_pose, 2*delta_pose)
+        down = np.arange(2*delta_pose, 3*delta_pose)
+        up = np.arange(3*delta_pose, 4*delta_pose)
+        sample_index = np.sort(np.concatenate((rng.choice(left, size = sub_sample_size, replace = False),
+                                               rng.choice(right, size = sub_sample_size, replace = False),
+                                               rng.choice(down, size = sub_sample_size, replace = False),
+                                               rng.choice(up, size = sub_sample_size, replace = False))))
+        if len(sample_index) < pool_size:
+            total = np.arange(0,4*delta_pose)
+            extras = rng.choice(total, size = pool_size - len(sample_index), replace = False)
+            sample_index = np.sort(np.append(sample_index, extras))
+        return sample_index
+
+    @staticmethod
+    def sample_indices(delta_pose, pool_size_list, no_sample_sets, seed=None):
+        """
+        Function to draw no_sample_sets sample sets for each pool size. If seed is given sample set i is drawn with
+        its own generator spawned from seed, the same sets are drawn by bootstrap_intrinsics_extrinsics workers.
+        """
+        seeds = np.random.SeedSequence(seed).spawn(len(pool_size_list) * no_sample_sets) if seed is not None else None
         sample_indices_list = []
-        for p in pool_size_list:
-            for i in range (no_sample_sets):
-                sub_sample_size = int(p/4) # no of poses from each delta_pose
-                left = np.arange(0, delta_pose)
-                right = np.arange(delta_pose, 2*delta_pose)
-                down = np.arange(2*delta_pose, 3*delta_pose)
-                up = np.arange(3*delta_pose, 4*delta_pose)
-                sample_index = np.sort(np.concatenate((np.random.choice(left, size = sub_sample_size, replace = False),
-                                                      np.random.choice(right, size = sub_sample_size, replace = False),
-                                                      np.random.choice(down, size = sub_sample_size, replace = False),
-                                                      np.random.choice(up, size = sub_sample_size, replace = False))))
-                if len(sample_index) < p:
-                    total = np.arange(0,4*delta_pose)
-                    extras = np.random.choice(total, size = p - len(sample_index), replace = False)
-                    sample_index = np.sort(np.append(sample_index, extras))
-                sample_indices_list.append(sample_index)
+        for i, p in enumerate(np.repeat(pool_size_list, no_sample_sets)):
+            rng = np.random.default_rng(seeds[i]) if seeds is not None else np.random
+            sample_indices_list.append(Calibration.sample_index(delta_pose, p, rng))
         return sample_indices_list
     
     @staticmethod
@@ -1519,103 +1722,88 @@ class Calibration:
         std = np.std(sample, axis=1)
         return mean, std, sample
     def sub_phase_map_gen(self, sample_index, model):
-        maskv_lst = []
-        maskh_lst = []
-        mod_lst = []
-        white_lst = []
-        wrapv_lst = []
-        wraph_lst = []
-        unwrapv_lst = []
-        unwraph_lst = []
-        for x in tqdm(sample_index,
-                      desc='generating unwrapped phases map for {} poses'.format(len(sample_index))):
-            if self.data_type == 'tiff':
-                if os.path.exists(os.path.join(self.path, 'capt_%03d_000000.tiff' % x)):
-                    img_path = sorted(glob.glob(os.path.join(self.path, 'capt_%03d*.tiff' % x)), key=os.path.getmtime)
-                    images_arr = np.array([cv2.imread(file, 0) for file in img_path]).astype(np.float64) - self.dark_bias
-                else:
-                    print("ERROR: path is not exist! None item appended to the result")
-                    images_arr = None
-            elif self.data_type == 'npy':
-                if os.path.exists(os.path.join(self.path, 'capt_%03d_000000.npy' % x)):
-                    images_arr = np.load(os.path.join(self.path, 'capt_%03d_000000.npy' % x)).astype(np.float64)- self.dark_bias
-                else:
-                    print("ERROR: path is not exist! None item appended to the result")
-                    images_arr = None
-            else:
-                print("ERROR: data type is not supported, must be '.tiff' or '.npy'.")
-                images_arr = None
+        """
+        Function to get unwrapped phase maps of a bootstrap sample set of poses. Poses are read from the pose cache,
+        hence each pose is analysed only once for all sample sets.
+        """
+        pose_lst = self.multifreq_pose_lst(sample_index, model)
+        field = lambda name: [p[name] if p is not None else None for p in pose_lst]
+        wrapped_phase_lst = {"wrapv": field('phase_v'),
+                             "wraph": field('phase_h')}
+        return field('unwrap_v'), field('unwrap_h'), field('white'), field('modulation'), wrapped_phase_lst, field('mask_v'), field('mask_h')
 
-            if images_arr is not None:
-                if self.processing == 'cpu':
-                   unwrap_v, unwrap_h, phase_v, phase_h, orig_img, modulation, mask_v, mask_h,_ = self.multifreq_analysis(images_arr, model)
-                else:
-                    if self.processing != 'gpu':
-                        print("WARNING: processing type is not recognized, use 'gpu'")
-                    images_arr = cp.asarray(images_arr)
-                    unwrap_v, unwrap_h, phase_v, phase_h, orig_img, modulation, mask_v, mask_h,_ = self.multifreq_analysis_cupy(images_arr, model)
-                    cp._default_memory_pool.free_all_blocks()
+    def pose_correspondences(self, index_list, model, chunk=8):
+        """
+        Function to get circle centers and their projector image points for poses. Points are read from the pose 
+        cache, poses without cached points are analysed chunk poses at a time, detected and added to the cache.
+        Parameters
+        ----------
+        index_list: list.
+                    Acquisition indices of poses.
+        model: list/None.
+               Intensity noise model.
+        chunk: int.
+               Number of poses analysed at a time.
+        Returns
+        -------
+        correspondences: dict.
+                         Acquisition index: (cam_imgpts, proj_imgpts) for poses with detected circle grid.
+        """
+        n_points = self.board_gridrows * self.board_gridcolumns
+        correspondences = {}
+        todo = []
+        for x, k in zip(index_list, self.pose_keys(index_list, model)):
+            if k is None:
+                continue
+            detection = self.pose_cache.load(self.detection_key(k))
+            if detection is not None and not bool(detection['ret']):
+                continue
+            if (detection is not None) and ('proj_imgpts' in detection) and np.array_equal(detection['proj_centers'], detection['corners'].reshape(n_points, 2)):
+                correspondences[x] = (detection['corners'], detection['proj_imgpts'])
             else:
-                unwrap_v = None
-                unwrap_h = None
-                phase_v = None
-                phase_h = None
-                orig_img = None
-                modulation = None
-                mask_v = None
-                mask_h = None
-            maskv_lst.append(mask_v)
-            maskh_lst.append(mask_h)
-            mod_lst.append(modulation)
-            white_lst.append(orig_img)
-            wrapv_lst.append(phase_v)
-            wraph_lst.append(phase_h)
-            unwrapv_lst.append(unwrap_v)
-            unwraph_lst.append(unwrap_h)
-
-        wrapped_phase_lst = {"wrapv": wrapv_lst,
-                             "wraph": wraph_lst}
-        return unwrapv_lst, unwraph_lst, white_lst, mod_lst, wrapped_phase_lst, maskv_lst, maskh_lst
-            
+                todo.append(x)
+        blobDetector = self.blob_detector()
+        for i in range(0, len(todo), chunk):
+            sub_index = todo[i:i + chunk]
+            for x, k, pose in zip(sub_index, self.pose_keys(sub_index, model), self.multifreq_pose_lst(sub_index, model)):
+                det_key = self.detection_key(k)
+                white = cv2.normalize(pose['white'], None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+                ret, corners = self.circle_centers(white, blobDetector, det_key)
+                if ret:
+                    unwrap_v = nstep.recover_image(pose['unwrap_v'], pose['mask_v'], self.cam_height, self.cam_width)
+                    unwrap_h = nstep.recover_image(pose['unwrap_h'], pose['mask_h'], self.cam_height, self.cam_width)
+                    correspondences[x] = (corners, self.projector_points(unwrap_v, unwrap_h, corners.reshape(n_points, 2), det_key))
+        missing = [x for x in index_list if x not in correspondences]
+        if missing:
+            print('Warning: Centers are not detected for poses', missing)
+        return correspondences
    
     def sub_calibration(self,sample_index, model, no):
-        
-        unwrapv_lst, unwraph_lst, white_lst, mod_lst, wrapped_phase_lst, maskv_lst, maskh_lst = self.sub_phase_map_gen(sample_index, model)
-        unwrapv_lst = [nstep.recover_image(u, maskv_lst[i], self.cam_height, self.cam_width) for i,u in enumerate(unwrapv_lst)]
-        unwraph_lst = [nstep.recover_image(u, maskh_lst[i], self.cam_height, self.cam_width) for i,u in enumerate(unwraph_lst)]
-        objp = self.world_points()
-        camr_error, cam_objpts, cam_imgpts, cam_mtx, cam_dist, cam_rvecs, cam_tvecs = self.camera_calib(objp, white_lst, display=False)
-        # Projector calibration
-        proj_ret, proj_imgpts, proj_mtx, proj_dist, proj_rvecs, proj_tvecs = self.proj_calib(cam_objpts,
-                                                                                             cam_imgpts,
-                                                                                             unwrapv_lst,
-                                                                                             unwraph_lst,
-                                                                                             proj_img_lst=None)
-        # Stereo calibration
-        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 40, 0.0001)
-        stereocalibration_flags = cv2.CALIB_FIX_INTRINSIC+cv2.CALIB_ZERO_TANGENT_DIST+cv2.CALIB_FIX_K3+cv2.CALIB_FIX_K4+cv2.CALIB_FIX_K5+cv2.CALIB_FIX_K6
-
-        st_retu, st_cam_mtx, st_cam_dist, st_proj_mtx, st_proj_dist, st_cam_proj_rmat, st_cam_proj_tvec, E, F = cv2.stereoCalibrate(cam_objpts,
-                                                                                                                                    cam_imgpts,
-                                                                                                                                    proj_imgpts,
-                                                                                                                                    cam_mtx,
-                                                                                                                                    cam_dist,
-                                                                                                                                    proj_mtx,
-                                                                                                                                    proj_dist,
-                                                                                                                                    white_lst[0].shape[::-1],
-                                                                                                                                    flags=stereocalibration_flags,
-                                                                                                                                    criteria=criteria)
-        proj_h_mtx = np.dot(proj_mtx, np.hstack((st_cam_proj_rmat, st_cam_proj_tvec)))
-        cam_h_mtx = np.dot(cam_mtx, np.hstack((np.identity(3), np.zeros((3, 1)))))
-        return st_cam_mtx, st_cam_dist, st_proj_mtx, st_proj_dist, st_cam_proj_rmat, st_cam_proj_tvec, cam_h_mtx, proj_h_mtx
+        """
+        Function to calibrate camera, projector and extrinsics of one bootstrap sample set of poses from the circle 
+        center correspondences in the pose cache.
+        """
+        correspondences = self.pose_correspondences(sample_index, model)
+        return stereo_calibration(self.world_points(),
+                                  [correspondences[x][0] for x in sample_index if x in correspondences],
+                                  [correspondences[x][1] for x in sample_index if x in correspondences],
+                                  (self.cam_width, self.cam_height),
+                                  (self.proj_width, self.proj_height))
 
     def bootstrap_intrinsics_extrinsics(self, 
                                         delta_pose, 
                                         pool_size_list, 
                                         no_sample_sets,
-                                        model):
+                                        model,
+                                        seed=0,
+                                        workers=None,
+                                        checkpoint=50):
         """
         Function to apply bootstrapping and system intrinsics and extrinsics.
+        Circle centers and projector points of all poses are computed once (or read from the pose cache), sample sets
+        are then calibrated from these correspondences in a process pool. Sample set i is drawn in the worker with 
+        its own generator spawned from seed, hence results do not depend on number of workers. Results are written 
+        to the sample, mean and std files in path/bootstrap every checkpoint sample sets.
         Parameters
         ----------
         delta_pose: int.
@@ -1625,65 +1813,148 @@ class Calibration:
                         list of no. of poses.
         no_sample_parameters:int.
                              Total number of samples of intrinsics and extrinsics parameters.(Iterations per pool size) 
+        model: list/None.
+               Intensity noise model.
+        seed: int.
+              Seed of sample set generators.
+        workers: int.
+                 Number of worker processes. Default is number of cpus. If 1 sample sets are calibrated in this process.
+        checkpoint: int.
+                    Number of sample sets between writes of result files.
         """
-        sample_indices_list = Calibration.sample_indices(delta_pose, pool_size_list, no_sample_sets) 
-        cam_mtx_sample = []
-        cam_dist_sample = []
-        proj_mtx_sample = []
-        proj_dist_sample = []
-        st_rmat_sample = []
-        st_tvec_sample = []
-        proj_h_mtx_sample = []
-        cam_h_mtx_sample = []
-        for no, s in enumerate(sample_indices_list):
-            print(no)
-            cam_mtx, cam_dist, proj_mtx, proj_dist, st_cam_proj_rmat, st_cam_proj_tvec, cam_h_mtx, proj_h_mtx = self.sub_calibration(s, model, no)
-            cam_mtx_sample.append(cam_mtx)
-            cam_dist_sample.append(cam_dist)
-            proj_mtx_sample.append(proj_mtx)
-            proj_dist_sample.append(proj_dist)
-            st_rmat_sample.append(st_cam_proj_rmat)
-            st_tvec_sample.append(st_cam_proj_tvec)
-            cam_h_mtx_sample.append(cam_h_mtx)
-            proj_h_mtx_sample.append(proj_h_mtx)
-        
-        cam_mtx_mean, cam_mtx_std, cam_mtx_sample  = Calibration.sample_statistics(np.array(cam_mtx_sample), len(pool_size_list))
-        cam_dist_mean, cam_dist_std, cam_dist_sample = Calibration.sample_statistics(np.array(cam_dist_sample), len(pool_size_list))
-        proj_mtx_mean, proj_mtx_std, proj_mtx_sample = Calibration.sample_statistics(np.array(proj_mtx_sample), len(pool_size_list))
-        proj_dist_mean, proj_dist_std, proj_dist_sample = Calibration.sample_statistics(np.array(proj_dist_sample), len(pool_size_list))
-        st_rmat_mean, st_rmat_std, st_rmat_sample = Calibration.sample_statistics(np.array(st_rmat_sample), len(pool_size_list))
-        st_tvec_mean, st_tvec_std, st_tvec_sample = Calibration.sample_statistics(np.array(st_tvec_sample), len(pool_size_list))
-        proj_h_mtx_mean, proj_h_mtx_std, proj_h_mtx_sample = Calibration.sample_statistics(np.array(proj_h_mtx_sample), len(pool_size_list))
-        cam_h_mtx_mean, cam_h_mtx_std, cam_h_mtx_sample = Calibration.sample_statistics(np.array(cam_h_mtx_sample), len(pool_size_list))
-        np.save(os.path.join(self.path,'bootstrap\{}_sample_index_lst.npy'.format(self.type_unwrap)),sample_indices_list)
-        np.savez(os.path.join(self.path, 'bootstrap\{}_sample_calibration_param.npz'.format(self.type_unwrap)), 
-                 cam_mtx_sample=cam_mtx_sample, 
-                 cam_dist_sample=cam_dist_sample, 
-                 proj_mtx_sample=proj_mtx_sample, 
-                 proj_dist_sample=proj_dist_sample, 
-                 st_rmat_sample=st_rmat_sample, 
-                 st_tvec_sample=st_tvec_sample, 
-                 proj_h_mtx_sample=proj_h_mtx_sample, 
-                 cam_h_mtx_sample=cam_h_mtx_sample)
-        np.savez(os.path.join(self.path, 'bootstrap\{}_mean_calibration_param.npz'.format(self.type_unwrap)), 
-                 cam_mtx_mean=cam_mtx_mean, 
-                 cam_dist_mean=cam_dist_mean, 
-                 proj_mtx_mean=proj_mtx_mean, 
-                 proj_dist_mean=proj_dist_mean, 
-                 st_rmat_mean=st_rmat_mean, 
-                 st_tvec_mean=st_tvec_mean, 
-                 cam_h_mtx_mean=cam_h_mtx_mean,
-                 proj_h_mtx_mean=proj_h_mtx_mean)
-        np.savez(os.path.join(self.path, 'bootstrap\{}_std_calibration_param.npz'.format(self.type_unwrap)),
-                 cam_mtx_std=cam_mtx_std, 
-                 cam_dist_std=cam_dist_std, 
-                 proj_mtx_std=proj_mtx_std, 
-                 proj_dist_std=proj_mtx_std, 
-                 st_rmat_std=st_rmat_std, 
-                 st_tvec_std=st_tvec_std, 
-                 cam_h_mtx_std=cam_h_mtx_std, 
-                 proj_h_mtx_std=proj_h_mtx_std)
-        return cam_mtx_sample, cam_dist_sample, proj_mtx_sample, proj_dist_sample, st_rmat_sample, st_tvec_sample, cam_h_mtx_sample, proj_h_mtx_sample
+        correspondences = self.pose_correspondences(list(range(4 * delta_pose)), model)
+        seeds = np.random.SeedSequence(seed).spawn(len(pool_size_list) * no_sample_sets)
+        tasks = [(delta_pose, p, seeds[i]) for i, p in enumerate(np.repeat(pool_size_list, no_sample_sets))]
+        initargs = (self.world_points(), correspondences, (self.cam_width, self.cam_height), (self.proj_width, self.proj_height))
+        results = BootstrapResults(os.path.join(self.path, 'bootstrap'), self.type_unwrap, len(pool_size_list), no_sample_sets, max(pool_size_list))
+        workers = workers if workers else (os.cpu_count() or 1)
+        if workers == 1:
+            _bootstrap_init(*initargs)
+            result_iter = map(_bootstrap_sample, tasks)
+            pool = None
+        else:
+            pool = ProcessPoolExecutor(workers, initializer=_bootstrap_init, initargs=initargs)
+            result_iter = pool.map(_bootstrap_sample, tasks, chunksize=max(1, min(16, len(tasks) // (4 * workers))))
+        for no, (sample_index, params) in enumerate(tqdm(result_iter, total=len(tasks), desc='bootstrap sample sets')):
+            results.add(no, sample_index, params)
+            if (no + 1) % checkpoint == 0:
+                results.save()
+        if pool is not None:
+            pool.shutdown()
+        results.save()
+        return tuple(results.samples[name] for name in BOOTSTRAP_PARAMS)
+
+
+# names of bootstrap parameters in order of stereo_calibration output
+BOOTSTRAP_PARAMS = ('cam_mtx', 'cam_dist', 'proj_mtx', 'proj_dist', 'st_rmat', 'st_tvec', 'cam_h_mtx', 'proj_h_mtx')
+
+def stereo_calibration(objp, cam_imgpts, proj_imgpts, cam_size, proj_size):
+    """
+    Function to calibrate camera, projector and camera projector extrinsics from circle center correspondences.
+    Parameters
+    ----------
+    objp: np.ndarray.
+          World coordinates of circle centers.
+    cam_imgpts: list.
+                Circle center grid coordinates of each pose in camera image.
+    proj_imgpts: list.
+                 Circle center grid coordinates of each pose in projector image.
+    cam_size: tuple.
+              Camera (width, height).
+    proj_size: tuple.
+               Projector (width, height).
+    Returns
+    -------
+    st_cam_mtx, st_cam_dist, st_proj_mtx, st_proj_dist, st_cam_proj_rmat, st_cam_proj_tvec, cam_h_mtx, proj_h_mtx
+    """
+    cam_objpts = [objp] * len(cam_imgpts)
+    # camera calibration: tangential distortion = 0, k3 = 0, k4 = 0, k5 = 0, k6 = 0
+    flags = cv2.CALIB_ZERO_TANGENT_DIST + cv2.CALIB_FIX_K3 + cv2.CALIB_FIX_K4 + cv2.CALIB_FIX_K5 + cv2.CALIB_FIX_K6
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+    _, cam_mtx, cam_dist, _, _ = cv2.calibrateCamera(cam_objpts, cam_imgpts, cam_size, None, None, flags=flags, criteria=criteria)
+    # projector calibration: all distortion = 0. linear model assumption
+    flags = cv2.CALIB_ZERO_TANGENT_DIST + cv2.CALIB_FIX_K1 + cv2.CALIB_FIX_K2 + cv2.CALIB_FIX_K3 + cv2.CALIB_FIX_K4 + cv2.CALIB_FIX_K5 + cv2.CALIB_FIX_K6
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 2e-16)
+    _, proj_mtx, proj_dist, _, _ = cv2.calibrateCamera(cam_objpts, proj_imgpts, proj_size, None, None, flags=flags, criteria=criteria)
+    # Stereo calibration
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 40, 0.0001)
+    stereocalibration_flags = cv2.CALIB_FIX_INTRINSIC+cv2.CALIB_ZERO_TANGENT_DIST+cv2.CALIB_FIX_K3+cv2.CALIB_FIX_K4+cv2.CALIB_FIX_K5+cv2.CALIB_FIX_K6
+    st_retu, st_cam_mtx, st_cam_dist, st_proj_mtx, st_proj_dist, st_cam_proj_rmat, st_cam_proj_tvec, E, F = cv2.stereoCalibrate(cam_objpts,
+                                                                                                                                cam_imgpts,
+                                                                                                                                proj_imgpts,
+                                                                                                                                cam_mtx,
+                                                                                                                                cam_dist,
+                                                                                                                                proj_mtx,
+                                                                                                                                proj_dist,
+                                                                                                                                cam_size,
+                                                                                                                                flags=stereocalibration_flags,
+                                                                                                                                criteria=criteria)
+    proj_h_mtx = np.dot(proj_mtx, np.hstack((st_cam_proj_rmat, st_cam_proj_tvec)))
+    cam_h_mtx = np.dot(cam_mtx, np.hstack((np.identity(3), np.zeros((3, 1)))))
+    return st_cam_mtx, st_cam_dist, st_proj_mtx, st_proj_dist, st_cam_proj_rmat, st_cam_proj_tvec, cam_h_mtx, proj_h_mtx
+
+# correspondences of bootstrap worker process, set once by _bootstrap_init
+_bootstrap_data = {}
+
+def _bootstrap_init(objp, correspondences, cam_size, proj_size):
+    # sample sets are parallel over processes, opencv threads would oversubscribe the cpus
+    cv2.setNumThreads(1)
+    _bootstrap_data.update(objp=objp, correspondences=correspondences, cam_size=cam_size, proj_size=proj_size)
+
+def _bootstrap_sample(task):
+    delta_pose, pool_size, seed = task
+    sample_index = Calibration.sample_index(delta_pose, pool_size, np.random.default_rng(seed))
+    correspondences = _bootstrap_data['correspondences']
+    valid = [x for x in sample_index if x in correspondences]
+    params = stereo_calibration(_bootstrap_data['objp'],
+                                [correspondences[x][0] for x in valid],
+                                [correspondences[x][1] for x in valid],
+                                _bootstrap_data['cam_size'],
+                                _bootstrap_data['proj_size'])
+    return sample_index, params
+
+
+class BootstrapResults:
+    """
+    Bootstrap results written incrementally. Sample sets arrive in order, means and standard deviations are computed 
+    over the sample sets received so far for each pool size.
+    """
+    def __init__(self, path, type_unwrap, no_pools, no_sample_sets, max_pool_size):
+        self.path = path
+        self.type_unwrap = type_unwrap
+        self.no_sample_sets = no_sample_sets
+        self.count = 0
+        self.samples = {}
+        # sample indices padded with -1 for smaller pool sizes
+        self.sample_indices = np.full((no_pools * no_sample_sets, max_pool_size), -1, dtype=int)
+        self.shape = (no_pools, no_sample_sets)
+        os.makedirs(path, exist_ok=True)
+
+    def add(self, no, sample_index, params):
+        for name, param in zip(BOOTSTRAP_PARAMS, params):
+            if name not in self.samples:
+                self.samples[name] = np.full(self.shape + param.shape, np.nan)
+            self.samples[name][no // self.no_sample_sets, no % self.no_sample_sets] = param
+        self.sample_indices[no, :len(sample_index)] = sample_index
+        self.count = no + 1
+
+    def statistics(self, sample):
+        full, partial = divmod(self.count, self.no_sample_sets)
+        done = [sample[i] for i in range(full)] + ([sample[full, :partial]] if partial else [])
+        return np.array([np.mean(i, axis=0) for i in done]), np.array([np.std(i, axis=0) for i in done])
+
+    def save(self):
+        if self.count == 0:
+            return
+        stats = {name: self.statistics(sample) for name, sample in self.samples.items()}
+        np.save(os.path.join(self.path, '{}_sample_index_lst.npy'.format(self.type_unwrap)), self.sample_indices[:self.count])
+        np.savez(os.path.join(self.path, '{}_sample_calibration_param.npz'.format(self.type_unwrap)),
+                 **{'%s_sample' % name: sample for name, sample in self.samples.items()})
+        np.savez(os.path.join(self.path, '{}_mean_calibration_param.npz'.format(self.type_unwrap)),
+                 **{'%s_mean' % name: stats[name][0] for name in self.samples})
+        np.savez(os.path.join(self.path, '{}_std_calibration_param.npz'.format(self.type_unwrap)),
+                 **{'%s_std' % name: stats[name][1] for name in self.samples})
+
       
 def dist_l(center_cordi_lst, true_val):
     """
@@ -1714,39 +1985,6 @@ def dist_l(center_cordi_lst, true_val):
     dist_df.columns = true_val
     return dist_df
 
-def obj(X, p):
-    """
-    Objective function for plane fitting. Used to calculate distance of a point from a plane.
-    Parameters
-    ----------
-    X: list.
-       3d coordinates array.
-    p: list.
-       List of plane parameters.
-    Returns
-    -------
-    distances: pandas dataframe.
-               Dataframe of distance calculated for each calibration pose.
-    """
-    plane_xyz = p[0:3]
-    distance_pp = (plane_xyz * X.T).sum(axis=1) + p[3]
-    return distance_pp / np.linalg.norm(plane_xyz)
-
-def residuals(p, X):
-    """
-    Function to compute residuals for optimization.
-    Parameters
-    ----------
-    p: np.array.
-       Plane parameters.
-    X: np.array.
-       3d coordinates.
-    Returns
-    -------
-    Distance of point from plane.
-    """
-    return obj(X, p)
-
 def plane_fit(xcord, ycord, zcord):
     """
     Function to get optimized plane solution and calculate residue of each point with respect to the fitted plane.
@@ -1766,11 +2004,84 @@ def plane_fit(xcord, ycord, zcord):
            Residue of each point from plane.
 
     """
-    p0 = np.array([1, 1, 1, 1])
-    xyz = np.vstack((xcord, ycord, zcord))
-    coeff = leastsq(residuals, p0, args=xyz)[0]
-    resid = obj(xyz, coeff)
-    return coeff, resid  
+    coeff, resid = plane_fit_batch([np.column_stack((xcord, ycord, zcord))])
+    return coeff[0], resid[0]
+
+def plane_fit_batch(cordi_lst, trim_limit=None, trim_iterations=0, chunk_size=2**20):
+    """
+    Function to fit a plane to the points of each pose in closed form. The plane minimizing the sum of squared 
+    point to plane distances passes through the centroid, its normal is the eigenvector of the smallest eigenvalue
+    of the point covariance. Centroid and covariance of each pose are accumulated over chunks of its points, so no
+    array larger than a chunk is built besides the residues, and all poses are solved with one batched eigh.
+    Parameters
+    ----------
+    cordi_lst: list.
+               List of (no. of points x 3) x, y, z coordinates of each pose. Points with nan are ignored.
+    trim_limit: float.
+                If given, the plane is refitted trim_iterations times to points with residue within the limit.
+                A pose whose points would all be trimmed keeps the plane of the previous fit.
+    trim_iterations: int.
+                     Number of refits with outlier points trimmed.
+    chunk_size: int.
+                Number of points processed at a time.
+    Returns
+    -------
+    coeff: np.ndarray.
+           (no. of poses x 4) plane coefficients a, b, c, d of ax + by + cz + d = 0 with unit normal (a, b, c),
+           oriented such that a + b + c > 0. Coefficients of a pose without valid points are nan.
+    resid: list.
+           Signed residue (distance from plane) of each valid point of each pose.
+    """
+    points = [np.asarray(c, dtype=np.float64).reshape(-1, 3) for c in cordi_lst]
+    no_poses = len(points)
+    coeff = np.full((no_poses, 4), np.nan)
+    # residue of every point, nan for invalid points
+    resid = [np.full(len(c), np.nan) for c in points]
+
+    def chunks(i, trim):
+        c = points[i]
+        for start in range(0, len(c), chunk_size):
+            sl = slice(start, start + chunk_size)
+            if trim:
+                # nan residue of invalid points is never within the limit
+                keep = np.abs(resid[i][sl]) < trim_limit
+            else:
+                keep = np.isfinite(c[sl]).all(axis=1)
+            yield c[sl][keep]
+
+    for iteration in range((trim_iterations if trim_limit is not None else 0) + 1):
+        trim = iteration > 0
+        count = np.zeros(no_poses)
+        centroid = np.zeros((no_poses, 3))
+        for i in range(no_poses):
+            for chunk in chunks(i, trim):
+                count[i] += len(chunk)
+                centroid[i] += chunk.sum(axis=0)
+        fit = count > 0
+        for i in np.flatnonzero(~fit):
+            if trim and np.isfinite(coeff[i]).all():
+                print('WARNING: all points of pose %d are outside the residue limit, plane is not refitted' % i)
+            elif not trim:
+                print('WARNING: pose %d has no valid points, plane coefficients are nan' % i)
+        centroid[fit] /= count[fit, None]
+        # covariance of centered points to avoid cancellation
+        cov = np.zeros((no_poses, 3, 3))
+        for i in np.flatnonzero(fit):
+            for chunk in chunks(i, trim):
+                centered = chunk - centroid[i]
+                cov[i] += centered.T @ centered
+        normal = np.linalg.eigh(cov)[1][:, :, 0]
+        normal[normal.sum(axis=1) < 0] *= -1
+        d = -np.einsum('ij,ij->i', normal, centroid)
+        for i in np.flatnonzero(fit):
+            coeff[i] = np.append(normal[i], d[i])
+            c = points[i]
+            r = np.empty(len(c))
+            for start in range(0, len(c), chunk_size):
+                sl = slice(start, start + chunk_size)
+                r[sl] = c[sl] @ normal[i] + d[i]
+            resid[i] = r
+    return coeff, [r[np.isfinite(c).all(axis=1)] for c, r in zip(points, resid)]
 
 def plane_resid_plot(residual_lst):
     """
@@ -1832,7 +2143,7 @@ def main():
     dark_bias_path =  r"C:\Users\kl001\Documents\pyfringe_test\mean_pixel_std\exp_30_fp_42_retake\black_bias\avg_dark.npy"
     #model_path = r"C:\Users\kl001\Documents\pyfringe_test\mean_pixel_std\exp_30_fp_42_retake\const_tiff\calib_fringes\variance_model.npy"
     model_path = r"E:\review_data\intensity_calib\variance_model.npy"
-    model = cp.load(model_path)
+    model = np.load(model_path)
     # multi wavelength unwrapping parameters
     if type_unwrap == 'multiwave':
         pitch_list = [139, 21, 18]
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 17:41:26 2026
+
+@author: kl001
+
+Capture engine of the projector camera acquisition loop. Frames are copied from the camera straight into a
+preallocated uint8 ring buffer and handed to a background writer thread, which saves them as npy sections, tiff
+frames and/or scan archive pose and passes them to an optional frame consumer. The capture thread never waits for
+the disk: if the writer falls behind and the ring is full, the frame goes to a freshly allocated overflow buffer
+and the backpressure is counted instead of stalling the camera.
+"""
+import os
+import queue
+import threading
+from time import perf_counter, time
+import numpy as np
+import cv2
+from scan_archive import ScanArchiveWriter, SCAN_ARCHIVE
+
+
+class FrameRing:
+    """
+    Preallocated ring of frame buffers.
+    """
+    def __init__(self, capacity, frame_shape, dtype=np.uint8):
+        """
+        Parameters
+        ----------
+        capacity: int.
+                  Number of frame buffers.
+        frame_shape: tuple.
+                     Frame shape (height, width).
+        dtype: np.dtype.
+               Frame type.
+        """
+        self.buffer = np.empty((capacity,) + tuple(frame_shape), dtype=dtype)
+        # touch all pages now, not at first use in the capture loop
+        self.buffer.fill(0)
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = dtype
+        self._free = queue.SimpleQueue()
+        for slot in range(capacity):
+            self._free.put(slot)
+        self.max_in_use = 0
+        self.overflow = 0
+
+    @property
+    def capacity(self):
+        return len(self.buffer)
+
+    @property
+    def in_use(self):
+        # derived from the free queue, slots are acquired and released on different threads
+        return self.capacity - self._free.qsize()
+
+    def acquire(self):
+        """
+        Function to get a free frame buffer.
+        Returns
+        -------
+        slot: int.
+              Slot of buffer in ring, None for an overflow buffer (ring full).
+        frame: np.ndarray.
+               Frame buffer.
+        """
+        try:
+            slot = self._free.get_nowait()
+        except queue.Empty:
+            self.overflow += 1
+            return None, np.empty(self.frame_shape, dtype=self.dtype)
+        self.max_in_use = max(self.max_in_use, self.in_use)
+        return slot, self.buffer[slot]
+
+    def release(self, slot):
+        """
+        Function to return a frame buffer to the ring.
+        """
+        if slot is not None:
+            self._free.put(slot)
+        return
+
+
+class CaptureEngine:
+    """
+    Ring buffer and background writer of one acquisition.
+    """
+    def __init__(self,
+                 savedir,
+                 acquisition_index,
+                 frame_shape,
+                 image_section_size,
+                 save_npy=True,
+                 save_tiff=False,
+                 save_archive=False,
+                 scan_info=None,
+                 frame_consumer=None,
+                 ring_size=64,
+                 dtype=np.uint8):
+        """
+        Parameters
+        ----------
+        savedir: str.
+                 Directory to save images.
+        acquisition_index: int.
+                           Index number of the acquisition.
+        frame_shape: tuple.
+                     Camera frame shape (height, width).
+        image_section_size: int.
+                            Number of images packed into a single npy file.
+        save_npy: bool.
+                  Save images as npy sections capt_{acquisition_index}_{section}.npy.
+        save_tiff: bool.
+                   Save images as tiff frames capt_{acquisition_index}_{frame}.tiff.
+        save_archive: bool.
+                      Append images as pose acquisition_index of the scan archive in savedir.
+        scan_info: dict.
+                   Information about the pattern sequence stored in the archive index.
+        frame_consumer: callable.
+                        Function called on the writer thread with a copy of each frame in capture order.
+        ring_size: int.
+                   Number of frame buffers in the ring.
+        dtype: np.dtype.
+               Frame type of the camera pixel format (np.uint8 for Mono8, np.uint16 for 12 and 16 bit formats).
+        """
+        self.savedir = savedir
+        self.acquisition_index = acquisition_index
+        self.image_section_size = image_section_size
+        self.save_npy = save_npy
+        self.save_tiff = save_tiff
+        self.save_archive = save_archive
+        self.scan_info = scan_info or {}
+        self.frame_consumer = frame_consumer
+        self.ring = FrameRing(ring_size, frame_shape, dtype)
+        self.frames = 0
+        self._written = 0
+        self.write_time = 0.0
+        self.max_write_time = 0.0
+        self.max_backlog = 0
+        self.error = None
+        self.consumer_error = None
+        self._section = None
+        self._section_count = 0
+        self._archive = ScanArchiveWriter(os.path.join(savedir, SCAN_ARCHIVE)) if save_archive else None
+        self._queue = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._run, daemon=True)
+        self._writer.start()
+
+    def frame(self):
+        """
+        Buffer (slot, array) for the next frame, pass it to commit once the frame is copied into it.
+        """
+        return self.ring.acquire()
+
+    def commit(self, slot, frame, timestamp=None):
+        """
+        Function hands a captured frame to the writer.
+        """
+        self._queue.put((slot, frame, timestamp if timestamp is not None else time()))
+        self.frames += 1
+        self.max_backlog = max(self.max_backlog, self.frames - self._written)
+        return
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            slot, frame, timestamp = item
+            start = perf_counter()
+            # the consumer (e.g. streaming reconstruction) gets the frame before it waits for the disk
+            if (self.frame_consumer is not None) and (self.consumer_error is None):
+                try:
+                    self.frame_consumer(frame.copy())
+                except Exception as ex:
+                    # reported by close, later frames are only saved
+                    self.consumer_error = ex
+            if self.error is None:
+                try:
+                    self._write(frame, timestamp)
+                except Exception as ex:
+                    # reported by close, frames are no longer saved
+                    self.error = ex
+            self.ring.release(slot)
+            write_time = perf_counter() - start
+            self.write_time += write_time
+            self.max_write_time = max(self.max_write_time, write_time)
+            self._written += 1
+
+    def _write(self, frame, timestamp):
+        count = self._written
+        if self.save_archive:
+            if count == 0:
+                self._archive.begin_pose(self.acquisition_index, frame.shape, frame.dtype, **self.scan_info)
+            self._archive.add_frame(frame, timestamp)
+        if self.save_tiff:
+            cv2.imwrite(os.path.join(self.savedir, 'capt_%03d_%06d.tiff' % (self.acquisition_index, count)), frame)
+        if self.save_npy:
+            # save one section when the counter reaches the section size
+            if self._section is None:
+                self._section = np.empty((self.image_section_size,) + frame.shape, dtype=frame.dtype)
+            self._section[self._section_count] = frame
+            self._section_count += 1
+            if self._section_count == self.image_section_size:
+                self._save_section(count // self.image_section_size)
+        return
+
+    def _save_section(self, section_id):
+        save_path = os.path.join(self.savedir, 'capt_%03d_%06d.npy' % (self.acquisition_index, section_id))
+        np.save(save_path, self._section[:self._section_count])
+        self._section_count = 0
+        return save_path
+
+    def close(self):
+        """
+        Function waits for the writer to save all committed frames, saves the last (shorter) npy section, closes the
+        archive and prints the writer statistics.
+        Returns
+        -------
+        result: bool.
+                True if all frames are saved and handed to the frame consumer.
+        """
+        self._queue.put(None)
+        self._writer.join()
+        if self.consumer_error is not None:
+            print('ERROR: frame consumer failed, later frames were only saved: %s' % self.consumer_error)
+        if self.error is not None:
+            print('ERROR: writing captured images failed: %s' % self.error)
+        elif self.save_npy and self._section_count:
+            print('WARNING: The last image section is shorter with number of images less than %d.' % self.image_section_size)
+            save_path = self._save_section((self.frames - 1) // self.image_section_size)
+            print('Last section of scanned images saved as %s' % save_path)
+        if self._archive is not None:
+            self._archive.close()
+            print('Scanned images saved as pose %d of %s' % (self.acquisition_index, os.path.join(self.savedir, SCAN_ARCHIVE)))
+        self.report()
+        return (self.error is None) and (self.consumer_error is None)
+
+    def report(self):
+        print('Writer: %d frames, %.3f s writing (max %.1f ms per frame), backlog max %d frames, ring max %d of %d '
+              'slots, %d overflow frames' % (self.frames, self.write_time, 1e3 * self.max_write_time, self.max_backlog,
+                                             self.ring.max_in_use, self.ring.capacity, self.ring.overflow))
+        if self.ring.overflow:
+            print('WARNING: writer fell behind the camera, increase ring_size or reduce saved formats')
+        return
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 10:05:12 2026
+
+@author: kl001
+
+Loader for captured fringe image stacks. Frames are decoded in a thread pool straight into a preallocated stack,
+the dark bias is subtracted in place and the next pose/scan can be prefetched while the current one is processed.
+"""
+import os
+import numpy as np
+import cv2
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+class CaptureLoader:
+    """
+    Parallel, prefetching loader of captured image stacks.
+    A source is either a list of image (tiff) paths, one frame per file, the path of a .npy stack or an array
+    (e.g. memory map of a scan archive pose).
+    """
+    def __init__(self,
+                 dark_bias=None,
+                 dtype=np.float64,
+                 workers=None,
+                 imread_flag=cv2.IMREAD_GRAYSCALE):
+        """
+        Parameters
+        ----------
+        dark_bias: np.ndarray/float.
+                   Dark bias image (or value) subtracted from every frame. Only applied to floating point stacks.
+        dtype: np.dtype.
+               Type of loaded stack e.g. np.float64, np.float32 or np.uint16.
+        workers: int.
+                 Number of decoding threads. Default is number of cpus, up to 8.
+        imread_flag: int.
+                     Flag passed to cv2.imread.
+        """
+        self.dark_bias = dark_bias
+        self.dtype = np.dtype(dtype)
+        self.workers = workers if workers else min(8, os.cpu_count() or 1)
+        self.imread_flag = imread_flag
+        self.frames = 0
+        self.load_time = 0.0
+        self._pool = ThreadPoolExecutor(self.workers)
+        self._prefetcher = ThreadPoolExecutor(1)
+        if (dark_bias is not None) and not np.issubdtype(self.dtype, np.floating):
+            print("WARNING: dark bias is not subtracted from %s stack" % self.dtype)
+
+    def _store(self, out, i, frame):
+        out[i] = frame
+        if (self.dark_bias is not None) and np.issubdtype(self.dtype, np.floating):
+            out[i] -= self.dark_bias
+
+    def _decode(self, out, i, path):
+        frame = cv2.imread(path, self.imread_flag)
+        if frame is None:
+            raise IOError("Frame %s could not be read" % path)
+        self._store(out, i, frame)
+
+    def load(self, source, out=None):
+        """
+        Function to load one image stack.
+        Parameters
+        ----------
+        source: list/str/np.ndarray.
+                List of frame paths, path of .npy stack or stack array.
+        out: np.ndarray.
+             Preallocated stack to load into. If None a new stack is allocated.
+        Returns
+        -------
+        out: np.ndarray.
+             Loaded stack with dark bias subtracted.
+        """
+        start = perf_counter()
+        if isinstance(source, (str, np.ndarray)):
+            stack = np.load(source, mmap_mode='r') if isinstance(source, str) else source
+            if out is None:
+                out = np.empty(stack.shape, dtype=self.dtype)
+            list(self._pool.map(lambda i: self._store(out, i, stack[i]), range(len(stack))))
+        else:
+            first = cv2.imread(source[0], self.imread_flag)
+            if first is None:
+                raise IOError("Frame %s could not be read" % source[0])
+            if out is None:
+                out = np.empty((len(source),) + first.shape, dtype=self.dtype)
+            self._store(out, 0, first)
+            list(self._pool.map(lambda i: self._decode(out, i, source[i]), range(1, len(source))))
+        self.load_time += perf_counter() - start
+        self.frames += len(out)
+        return out
+
+    def prefetch(self, sources):
+        """
+        Generator of loaded stacks. The next source is loaded in the background while the current stack is processed.
+        A None source yields None.
+        Parameters
+        ----------
+        sources: list.
+                 Sources to load in order.
+        Returns
+        -------
+        Generator of np.ndarray stacks.
+        """
+        sources = list(sources)
+        submit = lambda source: self._prefetcher.submit(self.load, source) if source is not None else None
+        pending = submit(sources[0]) if sources else None
+        for i in range(len(sources)):
+            current = pending
+            pending = submit(sources[i + 1]) if i + 1 < len(sources) else None
+            yield current.result() if current is not None else None
+
+    @property
+    def frame_rate(self):
+        """
+        Loading throughput in frames/s.
+        """
+        return self.frames / self.load_time if self.load_time > 0 else 0.0
+
+    def report(self):
+        print("\n Loaded %d frames in %.2f s (%.1f frames/s, %d threads)" % (self.frames, self.load_time,
+                                                                           self.frame_rate, self.workers))
+        return self.frame_rate
+
+    def close(self):
+        self._prefetcher.shutdown()
+        self._pool.shutdown()
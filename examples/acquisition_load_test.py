@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 18:47:55 2026
+
+@author: kl001
+
+Load test of projector camera acquisition without hardware. proj_cam_acquire_images (preview, projector LUT
+configuration, triggered capture, ring buffer writer) runs against the simulated camera and DLPC350 of
+simulated_devices, the camera returning a synthetic fringe scan rendered with fringe_simulator. Reported are the
+frames/s delivered by the capture loop, frames lost or incomplete, per frame latency from the end of exposure to the
+frame consumer, end to end scan latency (end of exposure of the last frame of a scan until the frame consumer, or
+until its point cloud with --reconstruct) and the projector commands sent. Results are written as json, the test
+fails (exit code 1) when frames/s is below --min-fps or scan latency above --max-latency.
+
+    python examples/acquisition_load_test.py --scans 5 --preview Once --width 640 --height 400
+    python examples/acquisition_load_test.py --reconstruct --min-fps 25 --max-latency 2
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+from time import perf_counter
+import numpy as np
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gspy
+import lcpy
+import image_acquisation
+from simulated_devices import SimulatedCamera, SimulatedDLPC350, simulated_hardware, DLPC350_VENDOR_ID, \
+    DLPC350_PRODUCT_ID
+from pipeline_benchmark import synthetic_scan
+
+
+def percentiles(values):
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return None
+    return {'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95)), 'max': float(values.max())}
+
+def run(args, data_path, savedir, images, N_list, pitch_list):
+    """
+    Function runs the acquisition on the simulated devices.
+    Returns
+    -------
+    results: dict.
+             Load test results.
+    """
+    image_index_list = np.repeat(np.arange(len(images) // 3), 3).tolist()
+    pattern_num_list = [0, 1, 2] * (len(images) // 3)
+    camera = SimulatedCamera(images=images, incomplete_rate=args.incomplete_rate, max_frame_rate=args.max_camera_fps,
+                             seed=args.seed)
+    projector = SimulatedDLPC350(command_latency=args.command_latency)
+    stream = None
+    if args.reconstruct:
+        from reconstruction import Reconstruction
+        from stream_reconstruction import StreamingReconstruction
+        reconst = Reconstruction(proj_width=912, proj_height=1140, cam_width=args.width, cam_height=args.height,
+                                 type_unwrap='multifreq', limit=30, N_list=N_list, pitch_list=pitch_list,
+                                 fringe_direc='v', kernel=7, data_type='npy', processing='cpu',
+                                 dark_bias_path=os.path.join(data_path, 'dark_bias.npy'), calib_path=data_path,
+                                 object_path=savedir, model_path=os.path.join(data_path, 'variance_model.npy'),
+                                 temp=False, save_ply=False, probability=False)
+        stream = StreamingReconstruction(reconst)
+    arrivals = []
+
+    def consumer(frame):
+        arrivals.append(perf_counter())
+        if stream is not None:
+            stream.add_frame(frame)
+
+    with simulated_hardware(camera, projector, preview_frames=args.preview_frames):
+        result, system, cam_list, num_cameras = gspy.sysScan()
+        cam = cam_list[0]
+        cam.Init()
+        start = perf_counter()
+        lcr = lcpy.dlpc350(sys.modules['usb.core'].find(idVendor=DLPC350_VENDOR_ID, idProduct=DLPC350_PRODUCT_ID))
+        connect_time = perf_counter() - start
+        start = perf_counter()
+        result &= image_acquisation.proj_cam_acquire_images(cam=cam,
+                                                            lcr=lcr,
+                                                            savedir=savedir,
+                                                            preview_option=args.preview,
+                                                            number_scan=args.scans,
+                                                            acquisition_index=0,
+                                                            image_index_list=image_index_list,
+                                                            pattern_num_list=pattern_num_list,
+                                                            cam_gain=0,
+                                                            cam_bufferCount=args.buffer_count,
+                                                            cam_capt_timeout=args.timeout,
+                                                            cam_black_level=0,
+                                                            cam_ExposureCompensation=0,
+                                                            proj_exposure_period=args.exposure_period,
+                                                            proj_frame_period=args.frame_period,
+                                                            do_insert_black=True,
+                                                            led_select=4,
+                                                            preview_image_index=0,
+                                                            focus_image_index=None,
+                                                            pprint_status=False,
+                                                            save_npy=not args.no_save,
+                                                            frame_consumer=consumer)
+        total_time = perf_counter() - start
+        if stream is not None:
+            stream.result()
+            stream.close()
+        cam.DeInit()
+        system.ReleaseInstance()
+    # frames of triggered acquisitions reach the consumer in capture order
+    capture_logs = [log for log in camera.acquisitions if log['trigger'] == 'Line0']
+    ready = [t for log in capture_logs for t in log['ready_times']]
+    delivered = [t for log in capture_logs for t in log['delivery_times']]
+    frames = len(arrivals)
+    frame_latency = np.asarray(arrivals) - np.asarray(ready[:frames])
+    fps = [(len(log['delivery_times']) - 1) / (log['delivery_times'][-1] - log['delivery_times'][0])
+           for log in capture_logs if len(log['delivery_times']) > 1]
+    frames_per_scan = len(images)
+    last = np.arange(frames_per_scan - 1, frames, frames_per_scan)
+    scan_latency = frame_latency[last]
+    if stream is not None:
+        complete = min(len(last), len(stream.latency))
+        scan_latency = scan_latency[:complete] + np.asarray(stream.latency[:complete])
+    return {'result': bool(result),
+            'frames': frames,
+            'expected_fps': 1e6 / args.frame_period,
+            'capture_fps': float(np.min(fps)) if fps else None,
+            'camera': camera.statistics('Line0'),
+            'preview': camera.statistics('Off'),
+            'frame_latency_s': percentiles(frame_latency),
+            'delivery_to_consumer_s': percentiles(np.asarray(arrivals) - np.asarray(delivered[:frames])),
+            'scan_latency_s': percentiles(scan_latency),
+            'scans_complete': int(len(scan_latency)),
+            'projector_connect_s': connect_time,
+            'total_s': total_time,
+            'projector': projector.statistics(),
+            'projector_command_latency': lcr.command_stats}
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of acquisition with simulated camera and projector.')
+    parser.add_argument('--scans', type=int, default=3, help='number of scans')
+    parser.add_argument('--preview', default='Never', choices=['Never', 'Once', 'Always'], help='preview option')
+    parser.add_argument('--preview-frames', type=int, default=10, help='frames shown by each preview')
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1200)
+    parser.add_argument('--frame-period', type=int, default=33334, help='projector frame period in us')
+    parser.add_argument('--exposure-period', type=int, default=27084, help='projector exposure period in us')
+    parser.add_argument('--incomplete-rate', type=float, default=0.0, help='probability of incomplete frames')
+    parser.add_argument('--max-camera-fps', type=float, default=163.0, help='maximum frame rate of the camera')
+    parser.add_argument('--command-latency', type=float, default=0.0, help='projector reply latency in s')
+    parser.add_argument('--buffer-count', type=int, default=15, help='camera stream buffer count')
+    parser.add_argument('--timeout', type=float, default=10, help='capture timeout in s')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-save', action='store_true', help='do not save npy sections, only the frame consumer')
+    parser.add_argument('--reconstruct', action='store_true', help='reconstruct scans while capturing')
+    parser.add_argument('--output', default='acquisition_load_test.json', help='result file')
+    parser.add_argument('--min-fps', type=float, help='fail if capture frames/s is lower')
+    parser.add_argument('--max-latency', type=float, help='fail if p95 scan latency in s is higher')
+    args = parser.parse_args()
+    N_list = [3, 3, 3, 9]
+    pitch_list = [1375, 275, 55, 11]
+    with tempfile.TemporaryDirectory() as data_path, tempfile.TemporaryDirectory() as savedir:
+        synthetic_scan(data_path, args.width, args.height, N_list, pitch_list, [0.02, 0.4])
+        images = np.load(os.path.join(data_path, 'capt_000_000000.npy'))
+        results = run(args, data_path, savedir, images, N_list, pitch_list)
+    results['config'] = vars(args)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('\nframes: %d, capture %.1f frames/s (projector %.1f), lost %d, incomplete %d, missed triggers %d'
+          % (results['frames'], results['capture_fps'] or 0, results['expected_fps'], results['camera']['lost'],
+             results['camera']['incomplete'], results['camera']['missed_triggers']))
+    for key in ['frame_latency_s', 'scan_latency_s']:
+        if results[key] is not None:
+            print('{}: p50 {:.4f} s, p95 {:.4f} s, max {:.4f} s'.format(key, results[key]['p50'], results[key]['p95'],
+                                                                        results[key]['max']))
+    print('projector: %d commands, %d errors' % (results['projector']['commands'], results['projector']['errors']))
+    print('Results saved at %s' % args.output)
+    failures = []
+    if not results['result']:
+        failures.append('acquisition failed')
+    if results['projector']['unacknowledged_errors']:
+        failures.append('%d projector commands failed without reply' % results['projector']['unacknowledged_errors'])
+    if (args.min_fps is not None) and ((results['capture_fps'] is None) or (results['capture_fps'] < args.min_fps)):
+        failures.append('capture frames/s %s below %.1f' % (results['capture_fps'], args.min_fps))
+    if (args.max_latency is not None) and ((results['scan_latency_s'] is None) or
+                                           (results['scan_latency_s']['p95'] > args.max_latency)):
+        failures.append('scan latency above %.3f s' % args.max_latency)
+    for failure in failures:
+        print('ERROR: %s' % failure)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
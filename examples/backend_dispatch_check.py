@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 21:12:40 2026
+
+@author: kl001
+
+Check of the array backend dispatch of nstep_fringe without a gpu. A dummy backend is registered whose arrays are
+a numpy ndarray subclass and whose array module forwards to numpy while recording the functions used. The phase
+pipeline (phase_cal, multifreq_unwrap, var_func) is run on toy data as numpy and as dummy arrays, the check fails
+(exit code 1) if the dummy backend is not used, results leave the backend or differ from numpy.
+"""
+
+import os
+import sys
+import types
+import numpy as np
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+import backend
+import nstep_fringe as nstep
+
+
+class DummyArray(np.ndarray):
+    """
+    Array type of the dummy backend.
+    """
+
+# backend_of dispatches on the top level module of the array type
+DummyArray.__module__ = 'dummy_array'
+
+
+def as_dummy(value):
+    """
+    Numpy arrays returned by numpy/scipy functions as dummy backend arrays, like a device library would return.
+    """
+    if isinstance(value, np.ndarray) and not isinstance(value, DummyArray):
+        return value.view(DummyArray)
+    if isinstance(value, tuple):
+        return tuple(as_dummy(v) for v in value)
+    return value
+
+
+class RecordingModule(types.ModuleType):
+    """
+    Array module forwarding to a numpy compatible module, names of the attributes used are recorded.
+    """
+    def __init__(self, name, module):
+        super().__init__(name)
+        self.module = module
+        self.used = set()
+
+    def __getattr__(self, name):
+        self.used.add(name)
+        attr = getattr(self.module, name)
+        if callable(attr) and not isinstance(attr, type):
+            return lambda *args, **kwargs: as_dummy(attr(*args, **kwargs))
+        return attr
+
+
+def dummy_backend(xp):
+    import scipy.ndimage
+    return backend.Backend('dummy', xp, RecordingModule('dummy_ndimage', scipy.ndimage),
+                           asnumpy=lambda arr: np.asarray(arr).view(np.ndarray),
+                           asarray=lambda arr: np.asarray(arr).view(DummyArray))
+
+def pipeline(images, N_list, pitch_list, model):
+    mod_stack, white_stack, phase_map, mask = nstep.phase_cal(images, 0.9, N_list, True)
+    unwrap, k_arr, pixels = nstep.multifreq_unwrap(pitch_list, phase_map[::2], 1, 'v', mask, 128, 128)
+    sigmasq_phi = nstep.var_func(images[-2 * N_list[-1]:-N_list[-1]], mask, N_list[-1], model)
+    return {'phase_map': phase_map, 'unwrap': unwrap, 'sigmasq_phi': sigmasq_phi}
+
+def main():
+    failures = []
+    if backend.get_backend('cpu') is not backend.get_backend('numpy'):
+        failures.append("processing 'cpu' is not the numpy backend")
+    for value in [np.zeros(3), [0.0], 1.0]:
+        if backend.backend_of(value).name != 'numpy':
+            failures.append('%s does not belong to the numpy backend' % type(value).__name__)
+    print('available backends: %s' % ', '.join(backend.available_backends()))
+
+    xp = RecordingModule('dummy_xp', np)
+    backend.register_backend('dummy', lambda: dummy_backend(xp), module='dummy_array')
+    dummy = backend.get_backend('dummy')
+    images = np.load(os.path.join(ROOT, 'test_data', 'toy_data.npy'))
+    if backend.backend_of(dummy.asarray(images)) is not dummy:
+        failures.append('dummy arrays do not dispatch to the dummy backend')
+
+    N_list = [3, 3]
+    pitch_list = [50, 20]
+    model = [0.02, 0.4]
+    expected = pipeline(images, N_list, pitch_list, model)
+    results = pipeline(dummy.asarray(images), N_list, pitch_list, model)
+    print('dummy backend array functions used: %s' % ', '.join(sorted(xp.used)))
+    if not xp.used:
+        failures.append('phase pipeline did not use the array module of the dummy backend')
+    for key, value in results.items():
+        if not isinstance(value, DummyArray):
+            failures.append('%s is %s, not a dummy backend array' % (key, type(value).__name__))
+        if not np.allclose(dummy.asnumpy(value), expected[key], equal_nan=True):
+            failures.append('%s differs from numpy' % key)
+    for failure in failures:
+        print('ERROR: %s' % failure)
+    if not failures:
+        print('Backend dispatch check passed')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 14:58:21 2026
+
+@author: kl001
+
+Import time check of the library modules. Each module is imported in a fresh interpreter with -X importtime,
+the check fails (exit code 1) if the cumulative import time exceeds its budget or if a heavy/optional package
+(cupy, plotting, data frames, progress bars, camera and projector drivers) is imported at module import.
+"""
+
+import os
+import sys
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# import time budget in seconds
+BUDGETS = {'nstep_fringe': 1.0,
+           'reconstruction': 1.5,
+           'calibration': 1.5,
+           'image_acquisation': 1.5}
+HEAVY_MODULES = ('cupy', 'matplotlib', 'pandas', 'seaborn', 'tqdm', 'PySpin', 'usb', 'plyfile')
+
+
+def import_profile(module):
+    """
+    Function imports module in a fresh interpreter.
+    Returns
+    -------
+    import_time: float.
+                 Cumulative import time of module in seconds.
+    heavy: list.
+           Heavy modules loaded by the import.
+    """
+    code = "import sys, {}; print(','.join(m for m in {} if m in sys.modules))".format(module, HEAVY_MODULES)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise ImportError(result.stderr.strip().splitlines()[-1])
+    # last line of the import time table is the top level module: self [us] | cumulative [us] | name
+    line = [l for l in result.stderr.splitlines() if l.startswith('import time:') and l.split('|')[-1].strip() == module][-1]
+    import_time = int(line.split('|')[1]) / 1e6
+    heavy = [m for m in result.stdout.strip().split(',') if m]
+    return import_time, heavy
+
+def main():
+    failed = False
+    for module, budget in BUDGETS.items():
+        import_time, heavy = import_profile(module)
+        print('{}: {:.3f} s (budget {:.1f} s), heavy modules: {}'.format(module, import_time, budget, heavy or 'none'))
+        if import_time > budget:
+            print('ERROR: import of {} exceeds budget'.format(module))
+            failed = True
+        if heavy:
+            print('ERROR: import of {} loads {}'.format(module, ', '.join(heavy)))
+            failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
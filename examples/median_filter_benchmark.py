@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 09:12:40 2026
+
+@author: kl001
+
+Benchmark of the mask aware 1-D median filter used in nstep_fringe.filt against scipy.ndimage.median_filter
+for a camera sized (1920x1200) unwrapped phase map with kernel size 7.
+"""
+
+import numpy as np
+import os
+import sys
+from time import perf_counter
+import scipy.ndimage
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import nstep_fringe as nstep
+
+
+def phase_map(cam_width, cam_height, mask_type, seed=0):
+    """
+    Function generates a spiky unwrapped phase map with nan at invalid pixels.
+    mask_type 'full': all pixels valid, 'object': elliptical object with a few invalid specks,
+    'speckle': 5% of randomly scattered invalid pixels.
+    """
+    rng = np.random.default_rng(seed)
+    unwrap = np.tile(np.linspace(0, 40 * np.pi, cam_width), (cam_height, 1))
+    spikes = rng.random(unwrap.shape) < 0.01
+    unwrap[spikes] += 2 * np.pi * rng.choice([-1, 1], size=np.count_nonzero(spikes))
+    if mask_type == 'object':
+        y, x = np.mgrid[0:cam_height, 0:cam_width]
+        inside = ((x - cam_width / 2) / (0.4 * cam_width))**2 + ((y - cam_height / 2) / (0.4 * cam_height))**2 < 1
+        unwrap[~inside | (rng.random(unwrap.shape) < 0.002)] = np.nan
+    elif mask_type == 'speckle':
+        unwrap[rng.random(unwrap.shape) < 0.05] = np.nan
+    return unwrap
+
+def best_time(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        timings.append(perf_counter() - start)
+    return min(timings)
+
+def main():
+    cam_width = 1920
+    cam_height = 1200
+    kernel = 7
+    repeat = 5
+    for mask_type in ['full', 'object', 'speckle']:
+        unwrap = phase_map(cam_width, cam_height, mask_type)
+        valid = ~np.isnan(unwrap)
+        for direc, axis, footprint in [('v', 1, (1, kernel)), ('h', 0, (kernel, 1))]:
+            scipy_med = scipy.ndimage.median_filter(unwrap, footprint)
+            med = nstep.median_filter_1d(unwrap, kernel, axis)
+            # pixels whose whole window is valid
+            full = scipy.ndimage.minimum_filter(valid, footprint, mode='constant', cval=False)
+            if not np.array_equal(med[full], scipy_med[full]):
+                print('ERROR: median differs from scipy on full windows')
+            scipy_time = best_time(lambda: scipy.ndimage.median_filter(unwrap, footprint), repeat)
+            med_time = best_time(lambda: nstep.median_filter_1d(unwrap, kernel, axis), repeat)
+            partial = np.count_nonzero(valid) - np.count_nonzero(full)
+            print('direc {} mask {}: scipy {:.4f} s, median_filter_1d {:.4f} s, speedup {:.1f}x, '
+                  'valid pixels with partial window {}'.format(direc, mask_type, scipy_time, med_time,
+                                                               scipy_time / med_time, partial))
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 15:52:07 2026
+
+@author: kl001
+
+Benchmark of the stages of the reconstruction pipeline (phase_cal, multifreq_unwrap, filt, undistort,
+triangulation, sigma_random, var_func, cloud_save) at camera resolution. Input is a synthetic scan rendered with
+fringe_simulator (default) or a captured scan directory with capt_000_000000.npy, calibration, dark bias and
+variance model. A captured scan is read in place, its calibration is copied to a temporary directory which takes
+the files written by the benchmark (triangulation table, point cloud). Each stage is timed (best of repeat) and its
+peak allocated memory measured with tracemalloc, results are written as json. If a baseline result file is given, the benchmark fails (exit code 1) when a stage is
+slower or uses more memory than the baseline by more than the threshold.
+
+    python examples/pipeline_benchmark.py --output bench.json
+    python examples/pipeline_benchmark.py --baseline bench.json --threshold 0.25
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter
+import numpy as np
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import nstep_fringe as nstep
+from reconstruction import Reconstruction, EPSILON, write_ply
+from fringe_simulator import FringeSimulator, Plane, Sphere, Union
+
+CALIB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          'test_data', 'reconst_toydata', 'multifreq_mean_calibration_param.npz')
+CALIBRATION_FILES = ['multifreq_mean_calibration_param.npz', 'multifreq_std_calibration_param.npz']
+STAGES = ['phase_cal', 'multifreq_unwrap', 'filt', 'undistort', 'triangulation', 'sigma_random', 'var_func', 'cloud_save']
+
+
+def synthetic_scan(path, cam_width, cam_height, N_list, pitch_list, model):
+    """
+    Function renders a sphere in front of a tilted plane and writes it to path with its calibration, a dark bias
+    and the variance model. A calibration std file with 0.1% relative std is added for sigma_random.
+    """
+    simulator = FringeSimulator(CALIB_PATH, cam_width, cam_height, scale=cam_width / 1920)
+    scene = Union(Sphere(center=(-50, 10, 720), radius=40), Plane(point=(0, 0, 760), normal=(0.1, 0.05, 1)))
+    dark_bias = np.random.default_rng(1).uniform(0, 1, (cam_height, cam_width))
+    images, _ = simulator.render(scene, N_list, pitch_list, model=model, dark_bias=dark_bias)
+    simulator.write_scan(path, images, model=model, dark_bias=dark_bias)
+    calibration = simulator.calibration()
+    np.savez(os.path.join(path, 'multifreq_std_calibration_param.npz'),
+             cam_h_mtx_std=1e-3 * np.abs(calibration['cam_h_mtx_mean']),
+             proj_h_mtx_std=1e-3 * np.abs(calibration['proj_h_mtx_mean']))
+    return
+
+def measure(func, repeat):
+    """
+    Function runs func repeat times.
+    Returns
+    -------
+    time: float.
+          Best wall time in seconds.
+    peak_mb: float.
+             Peak memory allocated by one call in MB (numpy allocations are traced by tracemalloc).
+    result:
+           Return value of func.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        result = func()
+        timings.append(perf_counter() - start)
+    del result
+    tracemalloc.start()
+    result = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(timings), peak / 2**20, result
+
+def run(path, work_path, N_list, pitch_list, kernel, limit, processing, repeat, cam_width, cam_height):
+    """
+    Function benchmarks the pipeline stages on the scan in path. The calibration is read from work_path, the
+    triangulation table and point cloud are written there.
+    Returns
+    -------
+    results: dict.
+             Time (s) and peak memory (MB) of each stage.
+    """
+    reconst = Reconstruction(proj_width=912, proj_height=1140, cam_width=cam_width, cam_height=cam_height,
+                             type_unwrap='multifreq', limit=limit, N_list=N_list, pitch_list=pitch_list,
+                             fringe_direc='v', kernel=kernel, data_type='npy', processing=processing,
+                             dark_bias_path=os.path.join(path, 'dark_bias.npy'), calib_path=work_path, object_path=path,
+                             model_path=os.path.join(path, 'variance_model.npy'), temp=False, save_ply=False,
+                             probability=True, prob_up=False)
+    backend = reconst.backend
+    images = backend.asarray(np.load(os.path.join(path, 'capt_000_000000.npy')).astype(np.float64) - reconst.dark_bias)
+    results = {}
+
+    def record(stage, func):
+        time, peak_mb, result = measure(func, repeat)
+        results[stage] = {'time_s': time, 'peak_mb': peak_mb}
+        return result
+
+    _, _, phase_map, mask = record('phase_cal', lambda: nstep.phase_cal(images, limit, N_list, False))
+    phase_map[0][phase_map[0] < EPSILON] += 2 * np.pi
+    pixels = nstep.PixelSet.from_mask(mask)
+    unwrap_vector, _, unwrap_pixels = record('multifreq_unwrap',
+                                             lambda: nstep.multifreq_unwrap(pitch_list, phase_map, kernel, 'v', pixels,
+                                                                            cam_width, cam_height))
+    # filt on the unfiltered unwrapped phase of the last level
+    absolute_ph = phase_map[0]
+    for i in range(len(pitch_list) - 1):
+        absolute_ph, _ = nstep.multi_kunwrap(pitch_list[i:i + 2], [absolute_ph, phase_map[i + 1]])
+    absolute_image = pixels.scatter(absolute_ph)
+    record('filt', lambda: nstep.filt(absolute_image, kernel, 'v', pixels))
+    sigma_sq_phi = record('var_func', lambda: nstep.var_func(images[-N_list[-1]:], unwrap_pixels, N_list[-1],
+                                                             reconst.model))
+    unwrap_image = unwrap_pixels.scatter(unwrap_vector)
+    # undistortion map is cached after the first call, as in repeated scans
+    nstep.undistort(unwrap_image, reconst.cam_mtx, reconst.cam_dist, sigmasq_image=sigma_sq_phi)
+    unwrap_dist, var_dist = record('undistort', lambda: nstep.undistort(unwrap_image, reconst.cam_mtx, reconst.cam_dist,
+                                                                        sigmasq_image=sigma_sq_phi))
+    dist_pixels = nstep.PixelSet.from_mask(~backend.xp.isnan(unwrap_dist))
+    uc = dist_pixels.cols.astype(np.float64)
+    vc = dist_pixels.rows.astype(np.float64)
+    up = (dist_pixels.gather(unwrap_dist) - reconst.phase_st) * pitch_list[-1] / (2 * np.pi)
+    # triangulation table is cached on disk and in memory after the first call, as in repeated scans
+    reconst.triangulation_lut()
+    coords = record('triangulation', lambda: backend.asnumpy(
+        Reconstruction.coeff_coords(dist_pixels.gather(reconst.triangulation_lut()), up)))
+    sigmasq_x, sigmasq_y, sigmasq_z, _, _, _ = record('sigma_random', lambda: reconst.sigma_random(
+        dist_pixels.gather(var_dist), uc, vc, up, derivative=False))
+    cordi_sigma = np.sqrt(np.stack((sigmasq_x, sigmasq_y, sigmasq_z), axis=-1))
+    color = np.repeat(np.linspace(0, 1, len(coords))[:, None], 3, axis=1)
+    quality = np.ones(len(coords))
+    record('cloud_save', lambda: write_ply(os.path.join(work_path, 'obj.ply'), coords, color=color, sigma=cordi_sigma,
+                                           quality=quality))
+    results['points'] = len(coords)
+    return results
+
+def compare(results, baseline, threshold):
+    """
+    Function compares results with baseline results.
+    Returns
+    -------
+    regressions: list.
+                 Description of stages slower or using more memory than baseline by more than threshold.
+    """
+    regressions = []
+    for stage in STAGES:
+        if stage not in baseline['stages']:
+            continue
+        for key in ['time_s', 'peak_mb']:
+            old = baseline['stages'][stage][key]
+            new = results['stages'][stage][key]
+            if new > old * (1 + threshold):
+                regressions.append('{} {}: {:.4f} -> {:.4f} (+{:.0f}%)'.format(stage, key, old, new, 100 * (new / old - 1)))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the reconstruction pipeline stages.')
+    parser.add_argument('--data', help='scan directory (capt_000_000000.npy, calibration, dark_bias.npy, '
+                                       'variance_model.npy), default is a rendered synthetic scan')
+    parser.add_argument('--output', default='pipeline_benchmark.json', help='result file')
+    parser.add_argument('--baseline', help='baseline result file for regression check')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed relative regression of each stage')
+    parser.add_argument('--processing', default='cpu', help="processing type ('cpu', 'gpu') or backend name")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1200)
+    args = parser.parse_args()
+    N_list = [3, 3, 3, 9]
+    pitch_list = [1375, 275, 55, 11]
+    kernel = 7
+    limit = 30
+    model = [0.02, 0.4]
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.data is None:
+            synthetic_scan(tmp, args.width, args.height, N_list, pitch_list, model)
+            path = tmp
+        else:
+            # nothing is written to the scan directory
+            path = args.data
+            for name in CALIBRATION_FILES:
+                shutil.copy(os.path.join(path, name), tmp)
+        stages = run(path, tmp, N_list, pitch_list, kernel, limit, args.processing, args.repeat, args.width,
+                     args.height)
+    results = {'stages': {stage: stages[stage] for stage in STAGES},
+               'config': {'cam_width': args.width, 'cam_height': args.height, 'N_list': N_list,
+                          'pitch_list': pitch_list, 'kernel': kernel, 'processing': args.processing,
+                          'repeat': args.repeat, 'points': stages['points'], 'data': args.data or 'synthetic'},
+               'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                               'machine': platform.machine(), 'processor': platform.processor()}}
+    for stage in STAGES:
+        print('{:<18s} {:8.4f} s {:9.1f} MB'.format(stage, results['stages'][stage]['time_s'],
+                                                     results['stages'][stage]['peak_mb']))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results saved at %s' % args.output)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['config']['cam_width'] != args.width or baseline['config']['cam_height'] != args.height:
+            print('WARNING: baseline resolution differs from benchmark resolution')
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print('ERROR: regression %s' % regression)
+        if regressions:
+            return 1
+        print('No stage regressed by more than {:.0f}%'.format(100 * args.threshold))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
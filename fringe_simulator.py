@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 15:24:46 2026
+
+@author: kl001
+
+Synthetic fringe capture generator. Camera pixel rays of a calibrated camera projector pair are intersected with an
+analytic surface (plane, sphere, step or free form height map), the intersection points are projected into the
+projector with reconstruction.device_cord and the multi frequency patterns of nstep_fringe.cos_func are sampled
+there. Captures include albedo, ambient light, the pred_var_fn intensity noise model, dark bias and 8 bit
+quantization, so they can be processed by Reconstruction and Calibration exactly like real captures and compared
+with the known surface. The camera frame is the world frame, as in the calibration.
+"""
+import os
+import numpy as np
+import scipy.ndimage
+import nstep_fringe as nstep
+from reconstruction import device_cord
+
+
+class Plane:
+    """
+    Plane through point with normal, in camera coordinates (mm).
+    """
+    def __init__(self, point=(0, 0, 750), normal=(0, 0, 1)):
+        self.point = np.asarray(point, dtype=np.float64)
+        self.normal = np.asarray(normal, dtype=np.float64)
+
+    def depth(self, x, y):
+        """
+        Function to intersect camera rays (x, y, 1) with the surface.
+        Parameters
+        ----------
+        x: np.ndarray:float.
+           Undistorted normalized x coordinate of rays.
+        y: np.ndarray:float.
+           Undistorted normalized y coordinate of rays.
+        Returns
+        -------
+        z: np.ndarray:float.
+           Z coordinate of intersection (the ray point is z * (x, y, 1)), nan if the ray misses the surface.
+        """
+        denominator = self.normal[0] * x + self.normal[1] * y + self.normal[2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = np.dot(self.normal, self.point) / denominator
+        z[~(z > 0)] = np.nan
+        return z
+
+
+class Sphere:
+    """
+    Sphere of radius with center, in camera coordinates (mm). The visible (near) side is rendered.
+    """
+    def __init__(self, center=(0, 0, 750), radius=50):
+        self.center = np.asarray(center, dtype=np.float64)
+        self.radius = float(radius)
+
+    def depth(self, x, y):
+        dd = x**2 + y**2 + 1
+        dc = self.center[0] * x + self.center[1] * y + self.center[2]
+        discriminant = dc**2 - dd * (np.dot(self.center, self.center) - self.radius**2)
+        with np.errstate(invalid='ignore'):
+            z = (dc - np.sqrt(discriminant)) / dd
+        z[~(z > 0)] = np.nan
+        return z
+
+
+class HeightField:
+    """
+    Surface z = z0 + height(X, Y) over the camera X, Y plane (mm), intersected by fixed point iteration along each ray.
+    The iteration converges for surfaces with moderate slope (|grad height| * |x, y| < 1).
+    """
+    def __init__(self, height, z0=750, iterations=30):
+        """
+        Parameters
+        ----------
+        height: callable.
+                Function of X, Y arrays returning height arrays, nan outside the surface.
+        z0: float.
+            Base distance of surface.
+        iterations: int.
+                    Number of fixed point iterations.
+        """
+        self.height = height
+        self.z0 = float(z0)
+        self.iterations = iterations
+
+    def depth(self, x, y):
+        z = np.full(np.broadcast(x, y).shape, self.z0)
+        for _ in range(self.iterations):
+            z = self.z0 + self.height(x * z, y * z)
+        z[~(z > 0)] = np.nan
+        return z
+
+
+class Step(HeightField):
+    """
+    Plane at z0 with a step of given height (towards the camera for negative height) for X > edge.
+    """
+    def __init__(self, z0=750, step_height=-20, edge=0.0):
+        super().__init__(lambda X, Y: np.where(X > edge, float(step_height), 0.0), z0, iterations=2)
+
+
+class HeightMap(HeightField):
+    """
+    Free form surface from a sampled height map, bi-linearly interpolated over extent (X min, X max, Y min, Y max).
+    Rays outside the extent miss the surface.
+    """
+    def __init__(self, height_map, extent, z0=750, iterations=30):
+        self.height_map = np.asarray(height_map, dtype=np.float64)
+        self.extent = extent
+        super().__init__(self._height, z0, iterations)
+
+    def _height(self, X, Y):
+        rows, cols = self.height_map.shape
+        col = (X - self.extent[0]) / (self.extent[1] - self.extent[0]) * (cols - 1)
+        row = (Y - self.extent[2]) / (self.extent[3] - self.extent[2]) * (rows - 1)
+        height = scipy.ndimage.map_coordinates(self.height_map, [np.nan_to_num(row, nan=-1), np.nan_to_num(col, nan=-1)],
+                                               order=1, mode='constant', cval=np.nan)
+        return height.reshape(np.shape(X))
+
+
+class Union:
+    """
+    Scene of several surfaces, each ray sees the nearest one.
+    """
+    def __init__(self, *surfaces):
+        self.surfaces = surfaces
+
+    def depth(self, x, y):
+        with np.errstate(invalid='ignore'):
+            return np.fmin.reduce([surface.depth(x, y) for surface in self.surfaces])
+
+
+class FringeSimulator:
+    """
+    Renderer of synthetic fringe captures for a calibrated camera projector pair.
+    """
+    def __init__(self,
+                 calibration,
+                 cam_width=1920,
+                 cam_height=1200,
+                 proj_width=912,
+                 proj_height=1140,
+                 scale=1.0):
+        """
+        Parameters
+        ----------
+        calibration: str/dict.
+                     Path of calibration npz ({type_unwrap}_mean_calibration_param.npz) or dictionary of its arrays.
+        cam_width: int.
+                   Width of rendered camera images.
+        cam_height: int.
+                    Height of rendered camera images.
+        proj_width: int.
+                    Projector width.
+        proj_height: int.
+                     Projector height.
+        scale: float.
+               Scale of camera intrinsics for rendering at a resolution other than the calibrated one
+               (e.g. 0.5 with half cam_width and cam_height).
+        """
+        if isinstance(calibration, str):
+            calibration = dict(np.load(calibration))
+        self.cam_width = cam_width
+        self.cam_height = cam_height
+        self.proj_width = proj_width
+        self.proj_height = proj_height
+        self.cam_mtx = np.array(calibration['cam_mtx_mean'], dtype=np.float64)
+        self.cam_mtx[:2] *= scale
+        self.cam_dist = np.array(calibration['cam_dist_mean'], dtype=np.float64).reshape(1, -1)
+        self.proj_mtx = np.array(calibration['proj_mtx_mean'], dtype=np.float64)
+        self.proj_dist = np.array(calibration['proj_dist_mean'], dtype=np.float64).reshape(1, -1)
+        self.st_rmat = np.array(calibration['st_rmat_mean'], dtype=np.float64)
+        self.st_tvec = np.array(calibration['st_tvec_mean'], dtype=np.float64).reshape(3, 1)
+        self._rays = None
+
+    def calibration(self):
+        """
+        Calibration parameters of the rendered images in the format of {type_unwrap}_mean_calibration_param.npz.
+        """
+        cam_h_mtx = np.dot(self.cam_mtx, np.hstack((np.identity(3), np.zeros((3, 1)))))
+        proj_h_mtx = np.dot(self.proj_mtx, np.hstack((self.st_rmat, self.st_tvec)))
+        return dict(cam_mtx_mean=self.cam_mtx, cam_dist_mean=self.cam_dist, proj_mtx_mean=self.proj_mtx,
+                    proj_dist_mean=self.proj_dist, st_rmat_mean=self.st_rmat, st_tvec_mean=self.st_tvec,
+                    cam_h_mtx_mean=cam_h_mtx, proj_h_mtx_mean=proj_h_mtx)
+
+    def camera_rays(self, iterations=20):
+        """
+        Function computes the undistorted normalized ray (x, y, 1) of each camera pixel by inverting the radial
+        distortion model used in nstep_fringe.undistort_map, distorted = undistorted * (1 + k1 r^2 + k2 r^4).
+        Returns
+        -------
+        x, y: np.ndarray:float.
+              cam_height x cam_width normalized coordinates of rays.
+        """
+        if self._rays is None:
+            xd, yd = self.pinhole_rays()
+            x = xd.copy()
+            y = yd.copy()
+            for _ in range(iterations):
+                r_sq = x**2 + y**2
+                radial = 1 + self.cam_dist[0, 0] * r_sq + self.cam_dist[0, 1] * r_sq**2
+                x = xd / radial
+                y = yd / radial
+            self._rays = (x, y)
+        return self._rays
+
+    def pinhole_rays(self):
+        """
+        Normalized rays of pixels of undistorted images (nstep_fringe.undistort), the pixel grid of reconstructed
+        coordinates.
+        """
+        uc, vc = np.meshgrid(np.arange(self.cam_width, dtype=np.float64), np.arange(self.cam_height, dtype=np.float64))
+        return (uc - self.cam_mtx[0, 2]) / self.cam_mtx[0, 0], (vc - self.cam_mtx[1, 2]) / self.cam_mtx[1, 1]
+
+    def surface_points(self, surface, distorted=True):
+        """
+        Function to get the surface point seen by each camera pixel.
+        Returns
+        -------
+        xyz: np.ndarray:float.
+             cam_height x cam_width x 3 camera coordinates of surface points, nan where rays miss the surface.
+             Points of raw camera pixels if distorted, else of pixels of undistorted images.
+        """
+        x, y = self.camera_rays() if distorted else self.pinhole_rays()
+        z = surface.depth(x, y)
+        return np.stack((x * z, y * z, z), axis=-1)
+
+    def projector_coords(self, xyz):
+        """
+        Function projects surface points into the projector with the distortion model of reconstruction.device_cord.
+        Returns
+        -------
+        up, vp: np.ndarray:float.
+                Projector column and row coordinates, same shape as xyz[..., 0].
+        """
+        world_cord = np.concatenate((xyz.reshape(-1, 3), np.ones((xyz[..., 0].size, 1))), axis=1)
+        _, proj_uv = device_cord(world_cord, self.proj_mtx, self.proj_dist, np.hstack((self.st_rmat, self.st_tvec)))
+        return proj_uv[0].reshape(xyz.shape[:-1]), proj_uv[1].reshape(xyz.shape[:-1])
+
+    def render(self,
+               surface,
+               N_list,
+               pitch_list,
+               direc='v',
+               inte_rang=(5, 250),
+               albedo=0.8,
+               ambient=2.0,
+               model=None,
+               dark_bias=None,
+               dtype=np.uint8,
+               seed=0):
+        """
+        Function renders the capture stack of a surface.
+        Parameters
+        ----------
+        surface: Plane/Sphere/HeightField.
+                 Surface to render.
+        N_list: list.
+                Number of patterns in each level.
+        pitch_list: list.
+                    Number of projector pixels per fringe period of each level.
+        direc: str.
+               'v' for vertical fringes (reconstruction), 'h' for horizontal fringes or 'vh' for vertical and
+               horizontal fringes of each level as captured for calibration.
+        inte_rang: list.
+                   Projector intensity range of patterns, patterns are rounded up to integers as in calib_generate.
+        albedo: float/callable.
+                Surface reflectance, or function of X, Y, Z arrays returning reflectance (e.g. to paint a target).
+        ambient: float.
+                 Ambient light intensity, also seen where the projector does not reach.
+        model: list.
+               Intensity noise model, variance = model[0] * intensity + model[1] (nstep_fringe.pred_var_fn).
+               If None the captures are noise free.
+        dark_bias: np.ndarray/float.
+                   Dark bias image (or value) added to every image.
+        dtype: np.dtype.
+               Type of returned stack, np.uint8 images are rounded and clipped to 0..255 like camera frames.
+        seed: int.
+              Seed of noise.
+        Returns
+        -------
+        images: np.ndarray.
+                Capture stack (no. of images x cam_height x cam_width) in the order of the pattern sequence.
+        truth: dict.
+               Ground truth: xyz (surface points of camera pixels), up, vp (projector coordinates), mask (pixels lit
+               by the projector) and xyz_undistorted (surface points on the pixel grid of undistorted images, to
+               compare with reconstructed coordinates).
+        """
+        rng = np.random.default_rng(seed)
+        xyz = self.surface_points(surface)
+        up, vp = self.projector_coords(xyz)
+        with np.errstate(invalid='ignore'):
+            mask = (up >= 0) & (up <= self.proj_width - 1) & (vp >= 0) & (vp <= self.proj_height - 1)
+        if callable(albedo):
+            reflectance = albedo(xyz[..., 0], xyz[..., 1], xyz[..., 2])
+        else:
+            reflectance = np.full(mask.shape, float(albedo))
+        reflectance = np.where(mask, reflectance, 0.0)
+        # same pattern definition as cos_func with phase_st = 0
+        i1 = (inte_rang[1] - inte_rang[0]) / 2
+        i0 = i1 + inte_rang[0]
+        directions = ['v', 'h'] if direc == 'vh' else [direc]
+        images = np.empty((sum(N_list) * len(directions), self.cam_height, self.cam_width), dtype=dtype)
+        i = 0
+        for pitch, n in zip(pitch_list, N_list):
+            for d in directions:
+                coord = np.nan_to_num(up if d == 'v' else vp)
+                for k in range(1, n + 1):
+                    pattern = np.ceil(i0 + i1 * np.cos(coord / pitch * 2 * np.pi + 2 * np.pi * k / n))
+                    image = ambient + reflectance * pattern
+                    if model is not None:
+                        image += rng.standard_normal(image.shape) * np.sqrt(nstep.pred_var_fn(image, model))
+                    if dark_bias is not None:
+                        image += dark_bias
+                    if np.dtype(dtype) == np.uint8:
+                        image = np.clip(np.round(image), 0, 255)
+                    images[i] = image
+                    i += 1
+        truth = {'xyz': xyz, 'up': up, 'vp': vp, 'mask': mask, 'xyz_undistorted': self.surface_points(surface, False)}
+        return images, truth
+
+    def write_scan(self, path, images, acquisition_index=0, model=None, dark_bias=None, type_unwrap='multifreq'):
+        """
+        Function writes a rendered stack as capt_{index}_000000.npy together with the calibration, dark bias and
+        noise model files read by Reconstruction and Calibration.
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'capt_%03d_000000.npy' % acquisition_index), images)
+        np.savez(os.path.join(path, '{}_mean_calibration_param.npz'.format(type_unwrap)), **self.calibration())
+        if dark_bias is not None:
+            np.save(os.path.join(path, 'dark_bias.npy'), np.broadcast_to(dark_bias, images.shape[1:]))
+        if model is not None:
+            np.save(os.path.join(path, 'variance_model.npy'), np.asarray(model))
+        return
+
+
+def main():
+    """
+    Render a sphere in front of a plane and write it for reconstruction.
+    """
+    calib_path = os.path.join('test_data', 'reconst_toydata', 'multifreq_mean_calibration_param.npz')
+    save_path = os.path.join('test_data', 'synthetic_scan')
+    N_list = [3, 3, 3, 9]
+    pitch_list = [1375, 275, 55, 11]
+    model = [0.02, 0.4]
+    simulator = FringeSimulator(calib_path)
+    scene = Union(Sphere(center=(-50, 10, 720), radius=40), Plane(point=(0, 0, 760), normal=(0.1, 0.05, 1)))
+    dark_bias = np.random.default_rng(1).uniform(0, 1, (simulator.cam_height, simulator.cam_width))
+    images, truth = simulator.render(scene, N_list, pitch_list, model=model, dark_bias=dark_bias)
+    simulator.write_scan(save_path, images, model=model, dark_bias=dark_bias)
+    print('Rendered %d images, %d lit pixels' % (len(images), np.count_nonzero(truth['mask'])))
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,15 @@
 # coding=utf-8
 #TODO: Impliment adjusting camera resolution
 import os
-import PySpin
+from lazy_modules import LazyModule
 import sys
+import numpy as np
 import cv2
 from time import perf_counter_ns
 
+PySpin = LazyModule('PySpin')
 
-def capture_image(cam, timeout=1000, save_path=None, return_array=True):
+def capture_image(cam, timeout=1000, save_path=None, return_array=True, out=None):
     """
     Once the camera engine has been activated, this function is used to Extract 
     one image from the buffering memory and save it into a numpy array.
@@ -24,6 +26,8 @@ def capture_image(cam, timeout=1000, save_path=None, return_array=True):
         save_path for saving jpeg file
     return_array:bool
         whether numpy array is saved
+    out:np.ndarray
+        preallocated array the image is copied into and returned, e.g. a ring buffer slot
     Returns
     -------
     result:bool
@@ -37,12 +41,22 @@ def capture_image(cam, timeout=1000, save_path=None, return_array=True):
 
     # Ensure image completion
     if image_result.IsIncomplete():
-        print('Image incomplete with image status %d ...' % image_result.GetImageStatus(), end="\r")
+        print('Image incomplete with image status %d ...' % image_result.GetImageStatus())
+        image_result.Release()
         return False, None
     else:
         if save_path is not None:
             image_result.Save(save_path)
-        if return_array:
+        if out is not None:
+            image_array = image_result.GetNDArray()
+            if image_array.dtype != out.dtype:
+                # copying would truncate the pixel values
+                print('ERROR: image type %s does not match buffer type %s, check PixelFormat' % (image_array.dtype, out.dtype))
+                image_result.Release()
+                return False, None
+            np.copyto(out, image_array)
+            image_array = out
+        elif return_array:
             image_array = image_result.GetNDArray()
         else:
             image_array = None
@@ -202,6 +216,8 @@ def acquire_images(cam,
     cam.BeginAcquisition()
     while True:
         ret, frame = capture_image(cam)
+        if not ret:  # incomplete frame
+            continue
         img_show = cv2.resize(frame, None, fx=0.5, fy=0.5)
         cv2.imshow("press q to quit", img_show)
         key = cv2.waitKey(1)
@@ -11,10 +11,13 @@ import gspy
 import lcpy
 import cv2
 import glob
-from time import perf_counter_ns, sleep
-import usb.core
-import PySpin
-import matplotlib.pyplot as plt
+from time import perf_counter_ns, sleep, time
+from capture_engine import CaptureEngine
+from lazy_modules import LazyModule
+
+usb = LazyModule('usb', 'usb.core')
+PySpin = LazyModule('PySpin')
+plt = LazyModule('matplotlib.pyplot')
 os.environ["KMP_DUPLICATE_LIB_OK"] = "True"  # needed when openCV and matplotlib used at the same time
 
 #TODO:Exposure time can be NONE. If none the default values to be read from firmware.
@@ -149,6 +152,8 @@ def proj_cam_preview(cam,
         cam.BeginAcquisition()
         while True:                
             ret, frame = gspy.capture_image(cam)       
+            if not ret:  # incomplete frame
+                continue
             img_show = cv2.resize(frame, None, fx=0.5, fy=0.5)
             mean_lst.append(img_show)
             if len(mean_lst) == 20:
@@ -207,7 +212,11 @@ def run_proj_cam_capt(cam,
                       total_image_number=None,
                       image_section_size=None,
                       save_npy=True,
-                      save_tiff=False):
+                      save_tiff=False,
+                      save_archive=False,
+                      scan_info=None,
+                      frame_consumer=None,
+                      ring_size=64):
     
     """
     This function projects and acquires images. Note that projector and camera must be initialized before 
@@ -234,6 +243,12 @@ def run_proj_cam_capt(cam,
     :image_section_size: the number of images that are packed into a single npy file. If None is given, using len(image_index_list).
     :param save_npy: Save images as .npy format
     :param save_tiff: Save images as .tiff format
+    :param save_archive: Append images as a new pose of the session scan archive (scan_archive.SCAN_ARCHIVE in savedir).
+    :param scan_info: information about the pattern sequence (e.g. levels, N, pitch) stored in the archive index.
+    :param frame_consumer: function called with each captured image array in capture order, e.g. 
+                           stream_reconstruction.StreamingReconstruction.add_frame to reconstruct while capturing.
+                           It is called on the writer thread with a copy of the frame.
+    :param ring_size: number of preallocated frame buffers between the capture loop and the writer thread.
     :type cam: CameraPtr
     :type nodemap:cNodemapPtr.
     :type s_node_map:cNodemapPtr.
@@ -253,6 +268,10 @@ def run_proj_cam_capt(cam,
     :type image_section_size: int
     :type save_npy: bool.
     :type save_tiff: bool.
+    :type save_archive: bool.
+    :type scan_info: dict.
+    :type frame_consumer: callable.
+    :type ring_size: int.
     :return result :True if successful, False otherwise. 
     :rtype: bool.
     """
@@ -271,8 +290,8 @@ def run_proj_cam_capt(cam,
     if (not do_repeat) and (total_image_number > number_of_patterns):
         print("WARNING: Pattern sequence running once while the total number of images requested is larger than the number of patterns!")
     # Check if the saving options are valid
-    if (not save_npy) and (not save_tiff):
-        print("ERROR: both save_npy and save_tiff are false, at least one should be True")
+    if (not save_npy) and (not save_tiff) and (not save_archive) and (frame_consumer is None):
+        print("ERROR: save_npy, save_tiff and save_archive are false and there is no frame_consumer, at least one should be True")
         return False
 
     result = True
@@ -316,63 +335,53 @@ def run_proj_cam_capt(cam,
     if result:
         gspy.activate_trigger(nodemap)
         sleep(0.05)
+        # frames go to a preallocated ring buffer, a background thread saves them
+        frame_shape = (gspy.get_IInteger_node_current_val(nodemap, 'Height', verbose=False),
+                       gspy.get_IInteger_node_current_val(nodemap, 'Width', verbose=False))
+        pixel_format = gspy.get_IEnumeration_node_current_entry_name(nodemap, 'PixelFormat', verbose=False)
+        pixel_dtype = np.uint8 if pixel_format.endswith('8') else np.uint16
+        engine = CaptureEngine(savedir,
+                               acquisition_index,
+                               frame_shape,
+                               image_section_size,
+                               save_npy=save_npy,
+                               save_tiff=save_tiff,
+                               save_archive=save_archive,
+                               scan_info=scan_info,
+                               frame_consumer=frame_consumer,
+                               ring_size=min(ring_size, total_image_number),
+                               dtype=pixel_dtype)
         cam.BeginAcquisition()
         start = perf_counter_ns()
         count = 0
-        image_array_list = []
+        failed = 0
         result &= lcr.pattern_display('start')
         capturing_time_start = perf_counter_ns()
         while count < total_image_number:
+            slot, frame = engine.frame()
             try:
-                if save_npy:
-                    return_array = True
-                else:
-                    return_array = False
-                if save_tiff:
-                    save_path_tiff = os.path.join(savedir,
-                                                  'capt_%03d_%06d.tiff' % (acquisition_index, count))
-                else:
-                    save_path_tiff = None
-                ret, image_array = gspy.capture_image(cam=cam, save_path=save_path_tiff, return_array=return_array)
+                ret, image_array = gspy.capture_image(cam=cam, out=frame)
             except PySpin.SpinnakerException as ex:
                 print('Error: %s' % ex)
                 ret = False
                 image_array = None
-                pass
             if ret:
-                print("extract successful")
-                # save one section when the counter reaches the section size
-                if save_npy:
-                    image_array_list.append(image_array)
-                    if (count % image_section_size) == (image_section_size - 1):
-                        section_id = count // image_section_size
-                        save_path = os.path.join(savedir, 'capt_%03d_%06d.npy' % (acquisition_index, section_id))
-                        np.save(save_path, image_array_list)
-                        image_array_list = []
+                engine.commit(slot, image_array, time())
                 count += 1
                 start = perf_counter_ns()
-                print('waiting clock is reset')
             else:
-                end = perf_counter_ns()
-                waiting_time = (end - start)/1e9
-                print('Capture failed, time spent %2.3f s before %2.3f s timeout' % (waiting_time, cam_capt_timeout))
+                engine.ring.release(slot)
+                failed += 1
+                waiting_time = (perf_counter_ns() - start)/1e9
                 if waiting_time > cam_capt_timeout:
-                    print('timeout is reached, stop capturing image ...')
+                    print('Capture failed, timeout %2.3f s is reached, stop capturing image ...' % cam_capt_timeout)
                     break
         capturing_time_end = perf_counter_ns()
         if do_repeat:
             result &= lcr.pattern_display('stop')
         image_capture_time = (capturing_time_end - capturing_time_start) / 1e9
-        print('image capturing time:%.3f' % image_capture_time)
-
-        # save the last section if the number of images is shorter than a section size
-        if save_npy:
-            if image_array_list:
-                print('WARNING: The last image section is shorter with number of images less than %d.' % image_section_size)
-                section_id = (count - 1) // image_section_size
-                save_path = os.path.join(savedir, 'capt_%03d_%06d.npy' % (acquisition_index, section_id))
-                np.save(save_path, image_array_list)
-                print('Last section of scanned images saved as %s' % save_path)
+        print('image capturing time:%.3f, %d frames captured, %d failed captures' % (image_capture_time, count, failed))
+        result &= engine.close()
 
         cam.EndAcquisition()
         gspy.deactivate_trigger(nodemap)
@@ -403,7 +412,10 @@ def proj_cam_acquire_images(cam,
                             image_section_size=None,
                             pprint_status=True,
                             save_npy=True,
-                            save_tiff=False):
+                            save_tiff=False,
+                            save_archive=False,
+                            scan_info=None,
+                            frame_consumer=None):
     """
     Wrapper function combining preview option and object scanning. 
     The projector configuration and camera trigger mode for each is different.
@@ -432,6 +444,9 @@ def proj_cam_acquire_images(cam,
     :param image_section_size: the number of images that are packed into a single npy file. If None is given, using len(image_index_list).
     :param save_npy: Save images as .npy format
     :param save_tiff: Save images as .tiff
+    :param save_archive: Append images to the session scan archive.
+    :param scan_info: information about the pattern sequence (e.g. levels, N, pitch) stored in the archive index.
+    :param frame_consumer: function called with each captured image array, see run_proj_cam_capt.
     :type cam: CameraPtr
     :type lcr: class instance.
     :type savedir: str
@@ -455,6 +470,9 @@ def proj_cam_acquire_images(cam,
     :type image_section_size: int / None
     :type save_npy: bool
     :type save_tiff: bool
+    :type save_archive: bool
+    :type scan_info: dict
+    :type frame_consumer: callable
     :return result :True if successful, False otherwise.
     :rtype: bool
     """
@@ -527,7 +545,10 @@ def proj_cam_acquire_images(cam,
                                  image_section_size=image_section_size,
                                  pprint_status=pprint_status,
                                  save_npy=save_npy,
-                                 save_tiff=save_tiff)
+                                 save_tiff=save_tiff,
+                                 save_archive=save_archive,
+                                 scan_info=scan_info,
+                                 frame_consumer=frame_consumer)
         
     elif (number_scan > 1) & (preview_option == 'Always'):
         # if preview option is Always the projector LUT has to be rewritten hence do_validation must be True
@@ -570,7 +591,10 @@ def proj_cam_acquire_images(cam,
                                      image_section_size=image_section_size,
                                      pprint_status=pprint_status,
                                      save_npy=save_npy,
-                                     save_tiff=save_tiff)
+                                     save_tiff=save_tiff,
+                                     save_archive=save_archive,
+                                     scan_info=scan_info,
+                                     frame_consumer=frame_consumer)
             initial_acq_index += 1
             
     elif (number_scan > 1) & (preview_option == 'Once'):
@@ -604,7 +628,10 @@ def proj_cam_acquire_images(cam,
                                  image_section_size=image_section_size,
                                  pprint_status=pprint_status,
                                  save_npy=save_npy,
-                                 save_tiff=save_tiff)
+                                 save_tiff=save_tiff,
+                                 save_archive=save_archive,
+                                 scan_info=scan_info,
+                                 frame_consumer=frame_consumer)
             
     elif preview_option == 'Never':
         if number_scan == 1:
@@ -632,7 +659,10 @@ def proj_cam_acquire_images(cam,
                                 image_section_size=image_section_size,
                                 pprint_status=pprint_status,
                                 save_npy=save_npy,
-                                save_tiff=save_tiff)
+                                save_tiff=save_tiff,
+                                save_archive=save_archive,
+                                scan_info=scan_info,
+                                frame_consumer=frame_consumer)
             
     result &= ret
     
@@ -659,6 +689,8 @@ def run_proj_single_camera(savedir,
                            pprint_status=True,
                            save_npy=True,
                            save_tiff=False,
+                           save_archive=False,
+                           scan_info=None,
                            clear_dir=True):
     """
     Initialize and de-initialize projector and camera before and after capture.
@@ -684,6 +716,8 @@ def run_proj_single_camera(savedir,
     :param image_section_size: the number of images that are packed into a single npy file. If None is given, using len(image_index_list).
     :param save_npy: Save images as .npy format
     :param save_tiff: Save images as .tiff
+    :param save_archive: Append images to the session scan archive.
+    :param scan_info: information about the pattern sequence (e.g. levels, N, pitch) stored in the archive index.
     :param clear_dir: Clear given directory
     :type savedir: str
     :type image_index_list: list
@@ -706,6 +740,8 @@ def run_proj_single_camera(savedir,
     :type image_section_size: int/ None
     :type save_npy: bool
     :type save_tiff: bool
+    :type save_archive: bool
+    :type scan_info: dict
     :type clear_dir: bool
     :return result: True if successful, False otherwise.
     :rtype :bool
@@ -747,7 +783,9 @@ def run_proj_single_camera(savedir,
                                       image_section_size=image_section_size,
                                       pprint_status=pprint_status,
                                       save_npy=save_npy,
-                                      save_tiff=save_tiff)
+                                      save_tiff=save_tiff,
+                                      save_archive=save_archive,
+                                      scan_info=scan_info)
         result &= ret
         # Deinitialize camera        
         cam.DeInit()
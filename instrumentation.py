@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 16:21:35 2026
+
+@author: kl001
+
+Per stage timing and memory instrumentation of the reconstruction and calibration pipelines. A Tracer records a
+trace for each scan (or calibration run): a list of spans with wall time, cpu time, peak resident memory of the
+process and the bytes held by the device memory pool of the processing backend (e.g. cupy). Pipeline functions
+open spans with the module level span function, which returns a shared no-op context when no scan is traced, so
+instrumentation costs one attribute check when disabled. The traced scan is per thread: spans opened on a thread go
+to the scan entered on that thread, e.g. the worker of the streaming reconstruction.
+
+    tracer = Tracer(path='trace.jsonl')
+    reconst = Reconstruction(..., tracer=tracer)
+    reconst.obj_reconst_wrapper()
+    tracer.report()
+"""
+import json
+import os
+import sys
+import threading
+import time
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+
+def peak_rss():
+    """
+    Peak resident memory (high water mark) of the process in bytes, None if not available.
+    """
+    if resource is not None:
+        # kilobytes on Linux, bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().peak_wset
+
+
+class _NullSpan:
+    """
+    Span doing nothing, used when tracing is disabled.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """
+    Timed section of a traced scan. Its record holds wall time, cpu time of the process (all threads), peak_rss_mb,
+    the process wide resident memory high water mark (ru_maxrss) at the end of the span, not the memory used by the
+    span, and the device memory pool size. Device work of a non numpy backend is synchronized at the span boundaries,
+    so asynchronous kernels are timed in the span launching them.
+    """
+    def __init__(self, scan, name):
+        self.scan = scan
+        self.name = name
+
+    def __enter__(self):
+        self.parent = self.scan.stack[-1].name if self.scan.stack else None
+        self.scan.stack.append(self)
+        self.scan.synchronize()
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.scan.synchronize()
+        wall = time.perf_counter() - self.start
+        cpu = time.process_time() - self.cpu_start
+        self.scan.stack.pop()
+        record = {'name': self.name,
+                  'parent': self.parent,
+                  'start_s': self.start - self.scan.start,
+                  'wall_s': wall,
+                  'cpu_s': cpu,
+                  'peak_rss_mb': _mb(peak_rss())}
+        if self.scan.pool_bytes is not None:
+            record['gpu_pool_mb'] = _mb(self.scan.pool_bytes())
+        self.scan.spans.append(record)
+        return False
+
+
+class _Scan:
+    """
+    Context of one traced scan, it is the active scan of the module level span function on the thread entering it.
+    """
+    def __init__(self, tracer, name, backend, info):
+        self.tracer = tracer
+        self.name = name
+        self.backend = backend
+        self.info = info
+        self.spans = []
+        self.stack = []
+        self.pool_bytes = backend.pool_bytes if backend is not None else None
+        # numpy runs synchronously, only device backends need to wait for queued work
+        if backend is not None and backend.name != 'numpy':
+            self.synchronize = backend.synchronize
+        else:
+            self.synchronize = lambda: None
+        self.start = 0.0
+
+    def __enter__(self):
+        self.previous = _active_scan()
+        _local.scan = self
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        self.time = time.time()
+        return self.tracer
+
+    def __exit__(self, *exc):
+        _local.scan = self.previous
+        tracer = self.tracer
+        trace = {'scan': self.name,
+                 'time': self.time,
+                 'backend': self.backend.name if self.backend is not None else None,
+                 'wall_s': time.perf_counter() - self.start,
+                 'cpu_s': time.process_time() - self.cpu_start,
+                 'peak_rss_mb': _mb(peak_rss()),
+                 'info': self.info,
+                 'spans': self.spans}
+        with tracer._lock:
+            tracer.traces.append(trace)
+            if tracer.path is not None:
+                with open(tracer.path, 'a') as f:
+                    f.write(json.dumps(trace, default=str) + '\n')
+        return False
+
+
+class Tracer:
+    """
+    Recorder of per scan traces.
+    """
+    def __init__(self, path=None, enabled=True):
+        """
+        Parameters
+        ----------
+        path: str.
+              Json lines file, one trace per scan is appended. If None traces are only kept in memory (traces).
+        enabled: bool.
+                 If False scans are not traced.
+        """
+        self.path = path
+        self.enabled = enabled
+        self.traces = []
+        self._lock = threading.Lock()
+        if (path is not None) and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def scan(self, name, backend=None, **info):
+        """
+        Context of a traced scan, spans opened inside it are recorded in its trace.
+        Parameters
+        ----------
+        name: str.
+              Scan name, e.g. object path.
+        backend: Backend.
+                 Processing backend, its device memory pool is recorded with each span.
+        info:
+              Additional json serializable scan information.
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Scan(self, name, backend, info)
+
+    def span(self, name):
+        """
+        Span of the scan of this tracer traced on the current thread, a no-op context if there is none.
+        """
+        scan = _active_scan()
+        if (scan is None) or (scan.tracer is not self):
+            return _NULL_SPAN
+        return Span(scan, name)
+
+    def summary(self, trace=None):
+        """
+        Function to sum wall and cpu time of spans with the same name.
+        Parameters
+        ----------
+        trace: dict.
+               Trace of a scan, default is the last one.
+        Returns
+        -------
+        summary: dict.
+                 Calls, wall_s, cpu_s and maximum peak_rss_mb (and gpu_pool_mb) of each span name.
+        """
+        trace = trace if trace is not None else self.traces[-1]
+        summary = {}
+        for record in trace['spans']:
+            stage = summary.setdefault(record['name'], {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0})
+            stage['calls'] += 1
+            stage['wall_s'] += record['wall_s']
+            stage['cpu_s'] += record['cpu_s']
+            for key in ['peak_rss_mb', 'gpu_pool_mb']:
+                if record.get(key) is not None:
+                    stage[key] = max(stage.get(key, 0.0), record[key])
+        return summary
+
+    def report(self, trace=None):
+        """
+        Function prints the summary of a trace, default is the last one.
+        """
+        if not self.traces:
+            print('WARNING: no scan has been traced')
+            return
+        trace = trace if trace is not None else self.traces[-1]
+        print('\n Trace of %s: %.3f s wall, %.3f s cpu' % (trace['scan'], trace['wall_s'], trace['cpu_s']))
+        for name, stage in self.summary(trace).items():
+            gpu = ', gpu pool %.1f MB' % stage['gpu_pool_mb'] if 'gpu_pool_mb' in stage else ''
+            print('  {:<16s} {:3d} x {:8.4f} s wall {:8.4f} s cpu, process peak rss {} MB{}'.format(
+                name, stage['calls'], stage['wall_s'], stage['cpu_s'], stage.get('peak_rss_mb', 'n/a'), gpu))
+        return
+
+
+def _mb(value):
+    return round(value / 2**20, 1) if value is not None else None
+
+# scan traced on each thread
+_local = threading.local()
+NULL_TRACER = Tracer(enabled=False)
+
+def _active_scan():
+    return getattr(_local, 'scan', None)
+
+def span(name):
+    """
+    Span of the scan traced on the current thread, a shared no-op context if no scan is traced.
+    """
+    scan = _active_scan()
+    if scan is None:
+        return _NULL_SPAN
+    return Span(scan, name)
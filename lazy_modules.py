@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 14:37:09 2026
+
+@author: kl001
+
+Lazy imports of heavy or optional dependencies (plotting, data frames, progress bars, camera and projector drivers).
+A LazyModule is imported on first attribute access, so importing a library module only loads numpy, scipy and
+opencv, and a missing optional package only fails the function that uses it.
+"""
+import importlib
+import types
+
+# pip package of modules whose name differs
+PIP_NAMES = {'PySpin': 'spinnaker-python (FLIR Spinnaker SDK)', 'usb': 'pyusb', 'cv2': 'opencv-python'}
+
+
+class LazyModule(types.ModuleType):
+    """
+    Module placeholder imported on first attribute access.
+    """
+    def __init__(self, name, import_name=None):
+        """
+        Parameters
+        ----------
+        name: str.
+              Name of module the placeholder stands for, e.g. 'matplotlib.pyplot'.
+        import_name: str.
+                     Module to import before name, e.g. 'usb.core' for name 'usb' to mimic import usb.core.
+                     Default is name.
+        """
+        super().__init__(name)
+        self.__dict__['_import_name'] = import_name if import_name is not None else name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            try:
+                importlib.import_module(self._import_name)
+            except ImportError as ex:
+                root = self._import_name.split('.')[0]
+                raise ImportError("%s is required for this function, install %s"
+                                  % (self._import_name, PIP_NAMES.get(root, root))) from ex
+            self.__dict__['_module'] = importlib.import_module(self.__name__)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    @property
+    def loaded(self):
+        """
+        True if the module has been imported.
+        """
+        return self._module is not None
+
+
+def tqdm(iterable=None, *args, **kwargs):
+    """
+    tqdm progress bar of iterable, the iterable itself if tqdm is not installed.
+    """
+    try:
+        from tqdm import tqdm as progress_bar
+    except ImportError:
+        return iterable
+    return progress_bar(iterable, *args, **kwargs)
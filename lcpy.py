@@ -6,16 +6,28 @@ Created on Sat Dec 24 13:27:49 2022
 """
 import numpy as np
 import os
+import struct
 import sys
 import time
+import types
 from contextlib import contextmanager
-import usb.core
-from usb.core import USBError
-from time import perf_counter_ns
+from time import perf_counter, perf_counter_ns
 import nstep_fringe as nstep
 import cv2
+from lazy_modules import LazyModule
+
+usb = LazyModule('usb', 'usb.core')
 #TODO: Add a function to modify LED current
 
+# USB command packets: 64 bytes, only the first packet starts with the header
+# {[flags (1 byte)][sequence (1 byte)][data length (2 bytes)][CMD3 (1 byte)][CMD2 (1 byte)]}
+PACKET_SIZE = 64
+HEADER = struct.Struct('<BBHBB')
+FLAG_READ = 0x80  # read transaction
+FLAG_REPLY = 0x40  # host needs reply from device
+FLAG_ERROR = 0x20  # reply flag, command failed
+STATUS_POLL_INTERVAL = 0.002  # seconds between status reads
+
 def conv_len(a, l):
     """
     Function that converts a number into a bit string of given length.
@@ -98,15 +110,23 @@ class dlpc350(object):
     Check IDs in device manager.
     """
     # TODO: Writing log file
-    def __init__(self, device):
+    def __init__(self, device, timeout=1000):
         """
         Connects the device.
         :param device: lcr4500 USB device.
+        :param timeout: waiting time for a reply in milliseconds.
         :type device: ptr
+        :type timeout: int
         """
 
         # Initialise device address
         self.dlpc = device
+        self.timeout = timeout
+        # per command latency statistics, see print_command_stats
+        self.command_stats = {}
+        # pending write commands of a batch, see batch
+        self._batch = None
+        self._batch_result = True
         self.mirrorStatus = None
         self.sequencer_status = None
         self.frame_buffer_status = None
@@ -161,6 +181,9 @@ class dlpc350(object):
         Byte5 and beyond: Data byte. 
         After completion of this command, DLPC3500 responds with a packet that includes:
         Requested data, Length of the data packet, and byte with the command.
+        The reply marks the completion of the command, so the next command is sent right after it. Every command
+        requests a reply, the error flag of a reply only covers its own command.
+        Inside batch, write commands are queued and their replies are read after all of them are sent, see batch.
     
         :param str rw_mode: Whether reading or writing.
         :param sequence_byte:
@@ -172,102 +195,164 @@ class dlpc350(object):
         :type sequence_byte: int
         :type com1: int
         :type com2: int
-        :type data: list
+        :type data: list/bytes
         :type verbose: bool
         :return result: True if successful, False otherwise.
         :rtype result:bool
         """
-
-        buffer = []
-        command_message = []
-        result = True
-
+        data = bytes(data) if data is not None else b''
+        if self._batch is not None:
+            if rw_mode != 'r':
+                self._batch.append((sequence_byte, com1, com2, data))
+                return True
+            # the batched writes are executed before the read
+            self._batch_result &= self._send_batch()
         if rw_mode == 'r':
-            flagstring = 0xc0  # 0b11000000
+            flags = FLAG_READ | FLAG_REPLY
         else:
-            flagstring = 0x40  # 0b01000000
-
-        data_len = conv_len(len(data) + 2, 16)  # size of data + subcommands to 16 bits binary
-        data_len = bits_to_bytes(data_len)
-        buffer.append(flagstring)
-        buffer.append(sequence_byte)
-        buffer.extend(data_len)
-        buffer.append(com2)
-        buffer.append(com1)
-
-        # if data fits into single buffer, write all and fill. Single command = 64 bytes
-        if len(buffer) + len(data) < 65:
-            for i in range(len(data)):
-                buffer.append(data[i])
-
-            # append empty data to fill buffer
-            for i in range(64 - len(buffer)):
-                buffer.append(0x00)
-            self.dlpc.write(1, buffer)
-            command_message.extend(buffer)
-
-        # else, keep filling buffer and pushing until data all sent
-        else:
-            for i in range(64 - len(buffer)):
-                buffer.append(data[i])
-            self.dlpc.write(1, buffer)
-            command_message.extend(buffer)
-            buffer = []
-            
-            # One packet includes 64 bytes starting from
-            # {[flagstring (1byte)][sequence(1 byte)][data length(2 bytes)][CMD3(1 byte)][CMD2(1 byte)]}
-            # that occupies 6 bytes on the very beginning, then is data bytes.
-            # Only the first packet includes 6 bytes packet header, the data bytes starting from 7th byte.
-            # The number 58 is the remaining bytes in the first packet (64 bytes - 6 bytes packet header),
-            # When a signal command is more than 64 bytes, the command is sent as multiple packets(64 bytes each)
-            # and padding all unused bytes as '0'.
-
-            j = 0
-            while j < len(data) - 58:
-                buffer.append(data[j + 58])
-                j += 1
-                if j % 64 == 0:
-                    self.dlpc.write(1, buffer)
-                    command_message.extend(buffer)
-                    buffer = []
-            if j % 64 != 0:
-                while j % 64 != 0:
-                    buffer.append(0x00)
-                    j += 1
-                self.dlpc.write(1, buffer)
-                command_message.extend(buffer)
-        # listen to the response from the device for verification
+            flags = FLAG_REPLY
+        start = perf_counter()
+        command_message = self._command_message(flags, sequence_byte, com1, com2, data)
         try:
-            self.ans = self.dlpc.read(0x81, 64)
-            length_lsb = self.ans[2]
-            length_msb = self.ans[3]
-            # get the number of packets received
-            response_message_length = length_msb*256 + length_lsb + 4  # overhead of first packet received is 4
-            num_packet = np.ceil(response_message_length/64).astype(int)
-            if num_packet > 1:
-                for i in range(num_packet-1):
-                    self.ans.extend(self.dlpc.read(0x81, 64))                
-        except USBError as e:
+            self._write_message(command_message)
+            result, packets = self._read_reply(com1, com2)
+        except usb.core.USBError as e:
             print('USB Error:', e)
-            result = False
+            result, packets = False, 0
+        self._record_command(com1, com2, perf_counter() - start, len(command_message) // PACKET_SIZE + packets, result)
         if verbose:
             print("Command used: %s, %s" % (hex(command_message[5]), hex(command_message[4])))
-            print("Entire command message sent:{}".format(command_message))
+            print("Entire command message sent:{}".format(list(command_message)))
             command_message_length = command_message[3] * 256 + command_message[2] + 4
             print("Command message length = %d" % command_message_length)
             print("Commend message total number of bytes = %d" % len(command_message))
             if command_message_length > len(command_message):
                 print("ERROR: The command message is incomplete! The declared message length is greater than the total number of bytes sent.")
-
             print("Entire response message received:{}".format(self.ans))
             response_message_length = self.ans[3] * 256 + self.ans[2] + 4
             print("Response message length = %d" % response_message_length)
             print("Response message total number of bytes = %d" % len(self.ans))
             if response_message_length > len(self.ans):
                 print("ERROR: The response message is incomplete! The declared message length is greater than the total number of bytes received.")
-        time.sleep(0.02)
         return result
 
+    @staticmethod
+    def _command_message(flags, sequence_byte, com1, com2, data):
+        """
+        Command header and data, padded with 0 to whole packets.
+        """
+        command_message = HEADER.pack(flags, sequence_byte, len(data) + 2, com2, com1) + data
+        return command_message + bytes(-len(command_message) % PACKET_SIZE)
+
+    def _write_message(self, command_message):
+        for i in range(0, len(command_message), PACKET_SIZE):
+            self.dlpc.write(1, command_message[i:i + PACKET_SIZE])
+        return
+
+    def _read_reply(self, com1, com2):
+        """
+        Reads the reply of a command into self.ans and checks its error flag.
+        :return result: True if the command is acknowledged.
+        :return packets: number of reply packets after the first one.
+        """
+        self.ans = self.dlpc.read(0x81, PACKET_SIZE, self.timeout)
+        packets = 0
+        # reply length excludes the 4 bytes of the first packet header
+        response_message_length = self.ans[3] * 256 + self.ans[2] + 4
+        while len(self.ans) < response_message_length:
+            self.ans.extend(self.dlpc.read(0x81, PACKET_SIZE, self.timeout))
+            packets += 1
+        result = not (self.ans[0] & FLAG_ERROR)
+        if not result:
+            print('ERROR: Command 0x%02x%02x is not acknowledged by the projector' % (com1, com2))
+        return result, packets
+
+    @contextmanager
+    def batch(self):
+        """
+        Context in which write commands are queued and sent when the context ends (or before a read command).
+        The packets of the queued commands are written back to back, each command requests a reply, then one reply
+        per command is read and checked, saving the wait for a reply between the writes. Write commands inside the
+        context return True, the result of the batch is set on the yielded object when the context ends. A batch
+        inside a batch is part of the outer one.
+            with lcr.batch() as batch:
+                lcr.open_mailbox(1)
+                lcr.mailbox_set_address(address=0)
+            result = batch.result
+        :yields: object with result attribute, True if every command of the batch is acknowledged.
+        """
+        status = types.SimpleNamespace(result=True)
+        if self._batch is not None:
+            yield status
+            return
+        self._batch = []
+        self._batch_result = True
+        try:
+            yield status
+        except BaseException:
+            self._batch = None
+            raise
+        status.result = self._send_batch() & self._batch_result
+        self._batch = None
+
+    def _send_batch(self):
+        """
+        Sends the queued write commands and reads their replies.
+        """
+        pending = self._batch
+        self._batch = []
+        if not pending:
+            return True
+        start = perf_counter()
+        messages = [self._command_message(FLAG_REPLY, sequence_byte, com1, com2, data)
+                    for sequence_byte, com1, com2, data in pending]
+        try:
+            for command_message in messages:
+                self._write_message(command_message)
+        except usb.core.USBError as e:
+            print('USB Error:', e)
+            for sequence_byte, com1, com2, data in pending:
+                self._record_command(com1, com2, perf_counter() - start, 0, False)
+            return False
+        result = True
+        for (sequence_byte, com1, com2, data), command_message in zip(pending, messages):
+            try:
+                acknowledged, packets = self._read_reply(com1, com2)
+            except usb.core.USBError as e:
+                print('USB Error:', e)
+                acknowledged, packets = False, 0
+            # latency of a batched command is counted from the write of the batch until its reply
+            self._record_command(com1, com2, perf_counter() - start,
+                                 len(command_message) // PACKET_SIZE + packets, acknowledged)
+            result &= acknowledged
+        return result
+
+    def _record_command(self, com1, com2, seconds, packets, result):
+        stats = self.command_stats.setdefault('0x%02x%02x' % (com1, com2),
+                                              {'calls': 0, 'total_s': 0.0, 'max_s': 0.0, 'packets': 0, 'errors': 0})
+        stats['calls'] += 1
+        stats['total_s'] += seconds
+        stats['max_s'] = max(stats['max_s'], seconds)
+        stats['packets'] += packets
+        stats['errors'] += int(not result)
+        return
+
+    def print_command_stats(self):
+        """
+        Print number of calls, mean and maximum latency (write until reply received) of each command sent. Latency of
+        a batched command is counted from the write of the batch.
+        """
+        print('\n{:<8s} {:>6s} {:>10s} {:>10s} {:>8s} {:>7s}'.format('command', 'calls', 'mean ms', 'max ms', 'packets',
+                                                                    'errors'))
+        for command, stats in sorted(self.command_stats.items()):
+            print('{:<8s} {:6d} {:10.3f} {:10.3f} {:8d} {:7d}'.format(command, stats['calls'],
+                                                                       1e3 * stats['total_s'] / stats['calls'],
+                                                                       1e3 * stats['max_s'], stats['packets'],
+                                                                       stats['errors']))
+        total = sum(stats['total_s'] for stats in self.command_stats.values())
+        calls = sum(stats['calls'] for stats in self.command_stats.values())
+        print('Total: %d commands, %.3f s' % (calls, total))
+
     def print_reply(self):
         """
         Print bytes in reply(Hex).
@@ -352,15 +437,11 @@ class dlpc350(object):
         result = True
         time_list_microsec = []
         for i in image_indices:
-            starting_index = conv_len(i, 8)
-            no_images = conv_len(1, 8)
-            payload = no_images + starting_index
-            payload = bits_to_bytes(payload)
-            result &= self.command('w', 0x00, 0x1a, 0x3a, payload)
+            # Byte0: starting image index, Byte1: number of images
+            result &= self.command('w', 0x00, 0x1a, 0x3a, bytes([i, 1]))
             if result:
                 result &= self.command('r', 0x00, 0x1a, 0x3a, [])
-                ans = self.ans
-                time_microsec = (ans[4] + ans[5]*256 + ans[6]*256**2 + ans[7]*256**3)*1e3/18667
+                time_microsec = struct.unpack_from('<I', self.ans, 4)[0]*1e3/18667
                 time_list_microsec.append(time_microsec)
             else:
                 print('ERROR: Requested image index: %d not valid, appending None' % i)
@@ -494,13 +575,10 @@ class dlpc350(object):
         :rtype result: bool
         """
         
-        num_lut_entries_bin = '0' + conv_len(num_lut_entries - 1, 7)  # Byte0: 6:0 LUT, 7: Reserved
-        do_repeat_bin = '0000000' + str(int(do_repeat))  # Byte1: 0 Repeat pattern seq, 7:1: Reserved
-        num_pats_for_trig_out2_bin = conv_len(num_pats_for_trig_out2 - 1, 8)  # Byte2: 7:0 Pattern number
-        num_images_bin = '00' + conv_len(num_images - 1, 6)  # Byte3: 5:0 Image index, 7:6 Reserved
-
-        payload = num_images_bin + num_pats_for_trig_out2_bin + do_repeat_bin + num_lut_entries_bin
-        payload = bits_to_bytes(payload)
+        payload = bytes([(num_lut_entries - 1) & 0x7f,  # Byte0: 6:0 LUT, 7: Reserved
+                         int(do_repeat),  # Byte1: 0 Repeat pattern seq, 7:1: Reserved
+                         (num_pats_for_trig_out2 - 1) & 0xff,  # Byte2: 7:0 Pattern number
+                         (num_images - 1) & 0x3f])  # Byte3: 5:0 Image index, 7:6 Reserved
 
         result = self.command('w', 0x00, 0x1a, 0x31, payload)
         if result:
@@ -602,15 +680,12 @@ class dlpc350(object):
         trigedge_rise_delay = int((trigedge_rise_delay_microsec - (-20.05))/0.1072)
         trigedge_fall_delay = int((trigedge_fall_delay_microsec - (-20.05))/0.1072)
         if polarity_invert:
-            polarity = '00000010'  # Bit0: reserved. Bit1: 1: active low signal 0: active high signal. Bit 7:2: Reserved
+            polarity = 0x02  # Bit0: reserved. Bit1: 1: active low signal 0: active high signal. Bit 7:2: Reserved
             self.trigger_polarity = "active low signal"
         else:
-            polarity = '00000000'
+            polarity = 0x00
             self.trigger_polarity = "active high signal"
-        trigedge_rise_delay = conv_len(trigedge_rise_delay, 8)
-        trigedge_fall_delay = conv_len(trigedge_fall_delay, 8)
-        payload = trigedge_fall_delay + trigedge_rise_delay + polarity
-        payload = bits_to_bytes(payload)
+        payload = bytes([polarity, trigedge_rise_delay & 0xff, trigedge_fall_delay & 0xff])
         result = self.command('w', 0x00, 0x1a, 0x1d, payload)
         if result:
             self.trigedge_rise_delay_microsec = trigedge_rise_delay_microsec
@@ -625,9 +700,7 @@ class dlpc350(object):
         """
         result = self.command('r', 0x00, 0x1a, 0x29, [])
         if result:
-            ans = self.ans
-            self.exposure_period = ans[4] + ans[5]*256 + ans[6]*256**2 + ans[7]*256**3
-            self.frame_period = ans[8] + ans[9]*256 + ans[10]*256**2 + ans[11]*256**3
+            self.exposure_period, self.frame_period = struct.unpack_from('<II', self.ans, 4)
         else:
             self.exposure_period = None
             self.frame_period = None
@@ -651,13 +724,7 @@ class dlpc350(object):
         :return result: True if all steps executed correctly
         :rtype result: bool
         """
-        
-        exposure_period_bin = conv_len(exposure_period, 32)  # decimal to bit string of size 32
-        frame_period_bin = conv_len(frame_period, 32)  # decimal to bit string of size 32
-
-        payload = frame_period_bin + exposure_period_bin
-        payload = bits_to_bytes(payload)  # it will be reverse
-
+        payload = struct.pack('<II', exposure_period, frame_period)  # little endian 32 bit
         result = self.command('w', 0x00, 0x1a, 0x29, payload)
         if result:
             self.exposure_period = exposure_period
@@ -681,7 +748,7 @@ class dlpc350(object):
         :return result: True if all steps executed correctly
         :rtype result: bool
         """
-        result = self.command('w', 0x00, 0x1a, 0x1a, bits_to_bytes(conv_len(0x00, 8)))  # Pattern Display Mode: Validate Data: CMD2: 0x1A, CMD3: 0x1A
+        result = self.command('w', 0x00, 0x1a, 0x1a, [0x00])  # Pattern Display Mode: Validate Data: CMD2: 0x1A, CMD3: 0x1A
         if result:            
             ans = '11111111'
             ret = int(ans[0], 2)
@@ -691,6 +758,8 @@ class dlpc350(object):
                 if result:
                     ans = conv_len(self.ans[4], 8)
                     ret = int(ans[0], 2)
+                    if ret:
+                        time.sleep(STATUS_POLL_INTERVAL)
                 end = perf_counter_ns()
                 t = (end - start)/1e9
                 if t > 10:
@@ -734,8 +803,7 @@ class dlpc350(object):
         :return result: True if all steps executed correctly
         :rtype result: bool
         """
-        mbox_num = bits_to_bytes(conv_len(mbox_num, 8))
-        result = self.command('w', 0x00, 0x1a, 0x33, mbox_num)
+        result = self.command('w', 0x00, 0x1a, 0x33, [mbox_num])
         return result
         
     def mailbox_set_address(self, address=0):
@@ -746,8 +814,7 @@ class dlpc350(object):
         :return result: True if all steps executed correctly
         :rtype result: bool
         """
-        address = bits_to_bytes(conv_len(address, 8))
-        result = self.command('w', 0x00, 0x1a, 0x32, address)
+        result = self.command('w', 0x00, 0x1a, 0x32, [address])
         return result
         
     def read_mailbox_address(self):
@@ -772,11 +839,12 @@ class dlpc350(object):
         :return result: True if all steps executed correctly
         :rtype result: bool
         """
-        result = self.open_mailbox(1)
-        result &= self.mailbox_set_address(address=address)
-        result &= self.command('w', 0x00, 0x1a, 0x34, index_list)
-        result &= self.open_mailbox(0)
-        return result
+        with self.batch() as batch:
+            self.open_mailbox(1)
+            self.mailbox_set_address(address=address)
+            self.command('w', 0x00, 0x1a, 0x34, index_list)
+            self.open_mailbox(0)
+        return batch.result
         
     def pattern_lut_payload_list(self,
                                  trig_type,
@@ -817,30 +885,20 @@ class dlpc350(object):
         :rtype: list
         """
         payload_list = []
-        trig_type = conv_len(trig_type, 2)
-        bit_depth = conv_len(bit_depth, 4)
-        led_select = conv_len(led_select, 4)
-        # byte 1
-        byte_1 = led_select + bit_depth
-        # byte 2
-        do_invert_pat = str(int(do_invert_pat))
-        do_insert_black = str(int(do_insert_black))
-        do_trig_out_prev = str(int(do_trig_out_prev))
+        # byte 1: 7:4 LED select, 3:0 bit depth
+        byte_1 = (led_select & 0x0f) << 4 | (bit_depth & 0x0f)
+        # byte 2: 3 trigger out previous, 2 buffer swap, 1 insert black, 0 invert
+        byte_2 = int(do_trig_out_prev) << 3 | int(do_insert_black) << 1 | int(do_invert_pat)
         
         if len(image_index_list) != len(pattern_num_list):
             print('ERROR: length of image list is not compatible with that of pattern number list')
             return None
+        swap_locations = set(swap_location_list)
         for i in range(len(image_index_list)):
-            if i in swap_location_list:
-                buffer_swap = True
-            else:
-                buffer_swap = False
-            byte_0 = conv_len(pattern_num_list[i], 6) + trig_type
-            do_buf_swap = str(int(buffer_swap))
-            byte_2 = '0000' + do_trig_out_prev + do_buf_swap + do_insert_black + do_invert_pat
-            payload = byte_2 + byte_1 + byte_0
-            payload = bits_to_bytes(payload)
-            payload_list.extend(payload)
+            buffer_swap = i in swap_locations
+            # byte 0: 7:2 pattern number, 1:0 trigger type
+            byte_0 = (pattern_num_list[i] & 0x3f) << 2 | (trig_type & 0x03)
+            payload_list.extend([byte_0, byte_1, byte_2 | int(buffer_swap) << 2])
         return payload_list
             
     def send_pattern_lut(self,
@@ -921,20 +979,25 @@ class dlpc350(object):
                                                           do_insert_black,
                                                           do_trig_out_prev)
         if payload_flat_list:
-            result = self.open_mailbox(2) 
-            result &= self.mailbox_set_address(address=starting_address)
-            result &= self.command('w', 0x00, 0x1a, 0x34, payload_flat_list)
-            result &= self.open_mailbox(0) 
+            with self.batch() as batch:
+                self.open_mailbox(2)
+                self.mailbox_set_address(address=starting_address)
+                self.command('w', 0x00, 0x1a, 0x34, payload_flat_list)
+                self.open_mailbox(0)
+            result = batch.result
             result &= self.read_mailbox_info()  # to update the image and pattern LUT table
         else:
             result = False
         return result
         
-    def pattern_display(self, action='start'):
+    def pattern_display(self, action='start', timeout=1.0):
         """
-        This API starts or stops the programmed patterns sequence.
+        This API starts or stops the programmed patterns sequence. Start is complete when the projector acknowledges
+        the command, after stop the main status is read until the sequencer is stopped.
         :param action: Pattern Display Start/Stop Pattern Sequence.
+        :param timeout: Maximum time in seconds to wait for the sequencer to stop.
         :type action: str
+        :type timeout: float
         :return result:True if successful, False otherwise.
         :rtype result: bool
         """
@@ -942,6 +1005,17 @@ class dlpc350(object):
         if action in actions:
             action_no = actions.index(action)
             result = self.command('w', 0x00, 0x1a, 0x24, [action_no])
+            if result and (action == 'stop'):
+                start = perf_counter()
+                while True:
+                    result &= self.read_main_status()
+                    if (not result) or (self.sequencer_status == 'stopped'):
+                        break
+                    if perf_counter() - start > timeout:
+                        print('ERROR: Pattern sequence is not stopped after %.1f s' % timeout)
+                        result = False
+                        break
+                    time.sleep(STATUS_POLL_INTERVAL)
         else:
             result = False
             print("\n Invalid action keyword, must be one of {'stop', 'pause', 'start'}")
@@ -953,19 +1027,22 @@ class dlpc350(object):
         :return result: True if all steps executed correctly
         :rtype result: bool
         """
-        # Read image table
-        result = self.open_mailbox(1)
-        result &= self.mailbox_set_address(address=0)
-        result &= self.command('r', 0x00, 0x1a, 0x34, [])
-        image_ans = self.ans[4:].tolist()
-        result &= self.open_mailbox(0)
-        
-        # Read pattern LUT
-        result &= self.open_mailbox(2)
-        result &= self.mailbox_set_address(address=0)
-        result &= self.command('r', 0x00, 0x1a, 0x34, [])
-        pattern_ans = self.ans[4:].tolist()
-        result &= self.open_mailbox(0)
+        # the mailbox writes are batched, the batch is sent before each read
+        with self.batch() as batch:
+            # Read image table
+            self.open_mailbox(1)
+            self.mailbox_set_address(address=0)
+            result = self.command('r', 0x00, 0x1a, 0x34, [])
+            image_ans = self.ans[4:].tolist()
+            self.open_mailbox(0)
+
+            # Read pattern LUT
+            self.open_mailbox(2)
+            self.mailbox_set_address(address=0)
+            result &= self.command('r', 0x00, 0x1a, 0x34, [])
+            pattern_ans = self.ans[4:].tolist()
+            self.open_mailbox(0)
+        result &= batch.result
         if result:
             self.image_LUT_entries = image_ans
             self.pattern_LUT_entries = pattern_ans
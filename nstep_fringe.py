@@ -3,11 +3,14 @@
 
 
 import numpy as np
-import scipy.ndimage
 import os
+import threading
+from collections import OrderedDict
 from typing import Tuple
 import pickle
 import cv2
+from backend import backend_of, get_backend, to_numpy
+from instrumentation import span
 
 def delta_deck_gen(N: int,
                    height: int,
@@ -285,96 +288,246 @@ def recon_generate(width: int,
     np.save(os.path.join(path, '{}_fringes.npy'.format(type_unwrap)), fringe_arr) 
     return fringe_arr, delta_deck_list
 
+class PixelSet:
+    """
+    Set of valid pixels of an image, stored as sorted int32 flat (row major) indices.
+    It replaces the boolean mask when moving between full images and compact vectors of valid pixels.
+    The indices stay on the backend (numpy, cupy, ...) of the mask they were created from, a copy for another backend
+    is made on first use. Bounding box and row runs are computed once on the host and cached.
+    """
+    def __init__(self, flat_idx, shape):
+        self.flat_idx = flat_idx
+        self.shape = tuple(shape)
+        self._copies = {}
+        self._mask = None
+        self._bbox = None
+        self._row_runs = None
+
+    @classmethod
+    def from_mask(cls, mask):
+        """
+        Create pixel set from boolean mask image.
+        """
+        flat_idx = mask.ravel().nonzero()[0].astype(np.int32)
+        return cls(flat_idx, mask.shape)
+
+    def __len__(self):
+        return int(self.flat_idx.shape[0])
+
+    def _index(self, arr):
+        """
+        Flat indices on the same backend as arr.
+        """
+        backend = backend_of(arr)
+        if backend is backend_of(self.flat_idx):
+            return self.flat_idx
+        if backend.name not in self._copies:
+            self._copies[backend.name] = backend.asarray(to_numpy(self.flat_idx))
+        return self._copies[backend.name]
+
+    @property
+    def mask(self):
+        """
+        Boolean mask image.
+        """
+        if self._mask is None:
+            mask = _array_module(self.flat_idx).zeros(self.shape[0] * self.shape[1], dtype=bool)
+            mask[self.flat_idx] = True
+            self._mask = mask.reshape(self.shape)
+        return self._mask
+
+    @property
+    def rows(self):
+        return self.flat_idx // self.shape[1]
+
+    @property
+    def cols(self):
+        return self.flat_idx % self.shape[1]
+
+    def _host_idx(self):
+        return self._index(np.empty(0))
+
+    @property
+    def bbox(self):
+        """
+        Bounding box (row_start, row_stop, col_start, col_stop) of valid pixels.
+        """
+        if self._bbox is None:
+            flat_idx = self._host_idx()
+            if len(flat_idx) == 0:
+                self._bbox = (0, 0, 0, 0)
+            else:
+                cols = flat_idx % self.shape[1]
+                self._bbox = (int(flat_idx[0] // self.shape[1]), int(flat_idx[-1] // self.shape[1]) + 1,
+                              int(cols.min()), int(cols.max()) + 1)
+        return self._bbox
+
+    @property
+    def row_runs(self):
+        """
+        Runs of consecutive valid pixels in a row as int32 array of (row, col_start, col_stop).
+        Runs are in the order of the flat indices, so the pixels of a run are contiguous in a vector of valid pixels.
+        """
+        if self._row_runs is None:
+            flat_idx = self._host_idx()
+            breaks = np.flatnonzero((np.diff(flat_idx) != 1) | (np.diff(flat_idx // self.shape[1]) != 0)) + 1
+            starts = np.concatenate(([0], breaks)).astype(np.int64)
+            stops = np.concatenate((breaks, [len(flat_idx)])).astype(np.int64)
+            if len(flat_idx) == 0:
+                starts = stops = np.empty(0, dtype=np.int64)
+            runs = np.empty((len(starts), 3), dtype=np.int32)
+            runs[:, 0] = flat_idx[starts] // self.shape[1]
+            runs[:, 1] = flat_idx[starts] % self.shape[1]
+            runs[:, 2] = runs[:, 1] + (stops - starts)
+            self._row_runs = runs
+        return self._row_runs
+
+    def gather(self, images):
+        """
+        Values of valid pixels from image or stack of images (last two axes are image axes).
+        """
+        return _array_module(images).take(images.reshape(images.shape[:-2] + (-1,)), self._index(images), axis=-1)
+
+    def scatter(self, vector, fill=np.nan):
+        """
+        Image (or stack of images) from vector of valid pixel values, other pixels are set to fill.
+        """
+        xp = _array_module(vector)
+        image = xp.full(vector.shape[:-1] + (self.shape[0] * self.shape[1],), fill)
+        image[..., self._index(vector)] = vector
+        return image.reshape(vector.shape[:-1] + self.shape)
+
+    def subset(self, keep):
+        """
+        Pixel set of valid pixels where boolean vector keep is true.
+        """
+        return PixelSet(self.flat_idx[keep], self.shape)
+
+def _array_module(arr):
+    """
+    Return array module (numpy, cupy, ...) of the backend of the array.
+    """
+    return backend_of(arr).xp
+
+def as_pixel_set(mask):
+    """
+    Helper function to accept either boolean mask image or PixelSet.
+    """
+    if isinstance(mask, PixelSet):
+        return mask
+    return PixelSet.from_mask(mask)
+
 def pred_var_fn(images, model):
     """
-    Function predicting variances based on pixel intensity and  create the variance covariance matrix for phase variance calculations.
+    Function predicting variances based on pixel intensity using the intensity noise model.
+    Since the intensity noise of each pattern is independent, the variance covariance matrix of each pixel is
+    diagonal and only its diagonal is returned.
+    Parameters
+    ----------
+    images: np.ndarray:float.
+            Fringe images of the level (N, H, W).
+    model: list.
+           Intensity noise model coefficients, variance = model[0] * intensity + model[1].
+    Returns
+    -------
+    pred_var_map: np.ndarray:float.
+                  Predicted intensity variance of each pattern and pixel (N, H, W).
     """
     pred_var_map = model[0] * images + model[1]
-    pred_var = pred_var_map.reshape(images.shape[0],images.shape[-2]*images.shape[-1])
-    var_cov_mtx = np.zeros((images.shape[-2]*images.shape[-1], images.shape[0],images.shape[0]))
-    for i in range(pred_var.shape[0]):
-        var_cov_mtx[:,i,i] = pred_var[i]
-    return var_cov_mtx, pred_var_map 
+    return pred_var_map
 
 def var_func(images: np.ndarray,
              mask: np.ndarray,
-             N:int,
-             cov_arr: np.ndarray)->np.ndarray:
+             N: int,
+             model: list)->np.ndarray:
     """
     Function calculating phase variance based on the equation:
         phase var = J varcov J.T
-     Parameters
-     ----------
-     images: Fringe images of the level.
-     mask: bool
-           Mask applied to image.
-     N : Number of patterns
-     cov_arr: variance covariance array for each pixel
-     
-    """
-    back_mask = mask.astype(float)
-    back_mask[back_mask == 0] = np.nan
-    images = np.einsum("ijk,jk->ijk", images, back_mask)
-    sin_lst_k =  np.sin(2*np.pi*(np.tile(np.arange(1,N+1),N)-np.repeat(np.arange(1,N+1),N))/N)
-    sin_lst =  np.sin(2*np.pi*np.arange(1,N+1)/N)
-    cos_lst =  np.cos(2*np.pi*np.arange(1,N+1)/N)
-    denominator_cs = (np.einsum("i,ikl->kl",sin_lst, images))**2 + (np.einsum("i,ikl->kl",cos_lst, images))**2 
-    each_int = np.array([np.einsum("i,ikl->kl",sin_lst_k[i*N: (i+1)*N], images)/(denominator_cs)for i in range(N)]) 
-    each_int_reshape = each_int.reshape(each_int.shape[0],each_int.shape[-2]*each_int.shape[-1])
-    sigmasq_phi = np.einsum("ij,jik->jk", each_int_reshape, cov_arr)
-    final_sigmasq_phi = np.einsum("ij,ji->i",sigmasq_phi,each_int_reshape).reshape(images.shape[-2],images.shape[-1])
-    return final_sigmasq_phi 
-  
-def level_process(image_stack: np.ndarray,
-                  n: int)->Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
-    """
-    Helper function for phase_cal to perform intermediate calculation in each level.
+    with a diagonal varcov given by the intensity noise model. This reduces to
+        phase var = sum_i J_i**2 * (model[0] * I_i + model[1])
+    where J_i = (cos(delta_i) * S - sin(delta_i) * C) / (S**2 + C**2) with S, C the sine and cosine
+    weighted sums of the N images. The sum is accumulated one pattern at a time so that memory usage
+    stays O(H*W) for any N. Computed on the backend of images.
     Parameters
     ----------
-    image_stack: np.ndarray:np.float64.
-                 Image stack of levels with same number of patterns (N).
-    n: int.
-        Number of patterns.
+    images: np.ndarray/cp.ndarray:float.
+            Fringe images of the level (N, H, W).
+    mask: np.ndarray:bool/PixelSet.
+          Mask applied to image. Pixels outside the mask are set to nan.
+    N: int.
+       Number of patterns.
+    model: list.
+           Intensity noise model coefficients, variance = model[0] * intensity + model[1].
+    Returns
+    -------
+    sigmasq_phi: np.ndarray:float.
+                 Phase variance map (H, W).
+    """
+    xp = _array_module(images)
+    pixels = as_pixel_set(mask)
+    images = pixels.gather(images)
+    # pattern coefficients are host scalars
+    delta = 2 * np.pi * np.arange(1, N + 1) / N
+    sin_lst = np.sin(delta)
+    cos_lst = np.cos(delta)
+    sin_sum = xp.zeros(images.shape[-1])
+    cos_sum = xp.zeros(images.shape[-1])
+    for i in range(N):
+        sin_sum += sin_lst[i] * images[i]
+        cos_sum += cos_lst[i] * images[i]
+    sigmasq_phi = xp.zeros(images.shape[-1])
+    for i in range(N):
+        jacobian = cos_lst[i] * sin_sum - sin_lst[i] * cos_sum
+        sigmasq_phi += jacobian ** 2 * (model[0] * images[i] + model[1])
+    sigmasq_phi /= (sin_sum ** 2 + cos_sum ** 2) ** 2
+    return pixels.scatter(sigmasq_phi)
+
+def level_deltas(n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sine and cosine of the phase shifts of n patterns used by level_process, rounding residues are set to zero.
     """
     delta = 2 * np.pi * np.arange(1, n + 1) / n
     sin_delta = np.sin(delta)
     sin_delta[np.abs(sin_delta) < 1e-15] = 0
     cos_delta = np.cos(delta)
     cos_delta[np.abs(cos_delta) < 1e-15] = 0
-    sin_deck = np.einsum('ijkl,j->ikl', image_stack, sin_delta)
-    cos_deck = np.einsum('ijkl,j->ikl', image_stack, cos_delta)
-    modulation_deck = 2 * np.sqrt(sin_deck ** 2 + cos_deck ** 2) / n
-    average_deck = np.sum(image_stack, axis=1) / n
-    return sin_deck, cos_deck, modulation_deck, average_deck
+    return sin_delta, cos_delta
 
-def mask_application(mask: np.ndarray,
-                     mod_stack: np.ndarray,
-                     sin_stack: np.ndarray,
-                     cos_stack: np.ndarray)->Tuple[np.ndarray, np.ndarray, np.ndarray]:
+def level_process(image_stack: np.ndarray,
+                  n: int)->Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
     """
-    Helper function to apply mask get relevant pixels for phase calculations.
+    Helper function for phase_cal to perform intermediate calculation in each level, on the backend of image_stack.
+    Parameters
+    ----------
+    image_stack: np.ndarray/cp.ndarray:np.float64.
+                 Image stack of levels with same number of patterns (N), either images or vectors of valid pixels.
+    n: int.
+        Number of patterns.
     """
-    num_total_levels = mod_stack.shape[0]
-
-    mask = mask.astype('float')
-    mask[mask == 0] = np.nan
-    # apply mask to all levels
-    mod_stack = np.einsum("ijk, jk->ijk", mod_stack, mask)
-    flag = ~np.isnan(mod_stack)
-    sin_stack = sin_stack[flag].reshape((num_total_levels, -1))
-    cos_stack = cos_stack[flag].reshape((num_total_levels, -1))
-    mod_stack = mod_stack[flag].reshape((num_total_levels, -1))
-    return sin_stack, cos_stack, mod_stack
+    xp = _array_module(image_stack)
+    sin_delta, cos_delta = level_deltas(n)
+    # elementwise accumulation gives the same result for images, pixel vectors and row bands
+    sin_deck = image_stack[:, 0] * sin_delta[0]
+    cos_deck = image_stack[:, 0] * cos_delta[0]
+    sum_deck = image_stack[:, 0].copy()
+    temp = xp.empty_like(sum_deck)
+    for j in range(1, n):
+        sin_deck += xp.multiply(image_stack[:, j], sin_delta[j], out=temp)
+        cos_deck += xp.multiply(image_stack[:, j], cos_delta[j], out=temp)
+        sum_deck += image_stack[:, j]
+    modulation_deck = 2 * xp.sqrt(sin_deck ** 2 + cos_deck ** 2) / n
+    average_deck = sum_deck / n
+    return sin_deck, cos_deck, modulation_deck, average_deck
 
 def phase_cal(images: np.ndarray,
               limit: float, 
               N: list,
               calibration: bool) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
     """
-    Function computes phase map for all levels given in list N.
+    Function computes phase map for all levels given in list N. All arrays are computed on the backend of images.
     Parameters
     ----------
-    images: np.ndarray:np.float64.
+    images: np.ndarray/cp.ndarray:np.float64.
             Captured fringe images.
     limit: float.
            Background limit. Regions with low intensity for reference images lesser than limit will be masked out.
@@ -403,15 +556,16 @@ def phase_cal(images: np.ndarray,
         repeat = 2
     else:
         repeat = 1
+    xp = _array_module(images)
     # Note: This mask method will remove all points below threshold like black regions    
-    mask = (np.max(images[:N[0]], axis=0) > limit)
-    back_mask = mask.astype(float)
-    back_mask[back_mask == 0] = np.nan
-    images = np.einsum("ijk,jk->ijk", images, back_mask)
+    mask = (xp.max(images[:N[0]], axis=0) > limit)
+    pixels = PixelSet.from_mask(mask)
+    # only valid pixels are processed
+    images = pixels.gather(images)
     
     if len(set(N))==2:
-        image_set1 = images[0:(repeat*len(N)-repeat)*N[0]].reshape((repeat*len(N)-repeat), N[0], images.shape[-2], images.shape[-1])
-        image_set2 = images[(repeat*len(N)-repeat)*N[0]:].reshape(repeat, N[-1], images.shape[-2], images.shape[-1])
+        image_set1 = images[0:(repeat*len(N)-repeat)*N[0]].reshape((repeat*len(N)-repeat), N[0], images.shape[-1])
+        image_set2 = images[(repeat*len(N)-repeat)*N[0]:].reshape(repeat, N[-1], images.shape[-1])
         image_set = [image_set1, image_set2]
         #images_last2levels = [image_set1[-1],image_set2[0]]
         sin_stack = None
@@ -426,17 +580,17 @@ def phase_cal(images: np.ndarray,
                 mod_stack = modulation
                 white_stack = modulation + average_int
             else:
-                sin_stack = np.vstack((sin_stack, sin_deck))
-                cos_stack = np.vstack((cos_stack, cos_deck))
-                mod_stack = np.vstack((mod_stack, modulation))
-                white_stack = np.vstack((white_stack, (modulation + average_int)))
+                sin_stack = xp.vstack((sin_stack, sin_deck))
+                cos_stack = xp.vstack((cos_stack, cos_deck))
+                mod_stack = xp.vstack((mod_stack, modulation))
+                white_stack = xp.vstack((white_stack, (modulation + average_int)))
     else:
-        image_set = images.reshape(int(images.shape[0]/N[0]), N[0], images.shape[-2], images.shape[-1])
+        image_set = images.reshape(int(images.shape[0]/N[0]), N[0], images.shape[-1])
         #images_last2levels = image_set[-2:]
         sin_stack, cos_stack, mod_stack, average_stack = level_process(image_set, N[0])
         white_stack = mod_stack + average_stack
-    sin_stack, cos_stack, mod_stack = mask_application(mask, mod_stack, sin_stack, cos_stack)
-    phase_map = -np.arctan2(sin_stack, cos_stack)  # wrapped phase;
+    white_stack = pixels.scatter(white_stack)
+    phase_map = -xp.arctan2(sin_stack, cos_stack)  # wrapped phase;
     return mod_stack, white_stack, phase_map, mask
 
 def recover_image(vector_array: np.ndarray, 
@@ -447,14 +601,16 @@ def recover_image(vector_array: np.ndarray,
     Function to convert vector to image array using flag.
     vector_array: np.ndarray
                   Vector to be converted
-    flag: np.ndarray
+    flag: np.ndarray/PixelSet
           Indexes of the array cordinates with data.
     cam_width: int.
                Width of image.
     cam_height: int.
                 Height of image.
     """
-    image = np.full((cam_height, cam_width), np.nan)
+    if isinstance(flag, PixelSet):
+        return flag.scatter(vector_array)
+    image = _array_module(vector_array).full((cam_height, cam_width), np.nan)
     image[flag] = vector_array
     return image
 
@@ -521,22 +677,241 @@ def unwrap_cal(step_wrap: np.ndarray,
     return cos_unwrap, k
 
 # median filter
+def _sorting_network(n: int) -> list:
+    """
+    Comparator pairs of Batcher's merge exchange sorting network (Knuth, Algorithm 5.2.2M) for n inputs.
+    """
+    comparators = []
+    if n < 2:
+        return comparators
+    t = (n - 1).bit_length()
+    p = 1 << (t - 1)
+    while p > 0:
+        q = 1 << (t - 1)
+        r = 0
+        d = p
+        while True:
+            for i in range(n - d):
+                if i & p == r:
+                    comparators.append((i, i + d))
+            if q == p:
+                break
+            d = q - p
+            q >>= 1
+            r = p
+        p >>= 1
+    return comparators
+
+def median_network(n: int, outputs: tuple = None) -> list:
+    """
+    Sorting network pruned to the comparators the given outputs (default the middle output) depend on.
+    Each entry is (i, j, need_min, need_max): only the min and/or max of wires i, j is used later.
+    """
+    need = set(outputs) if outputs is not None else {n // 2}
+    network = []
+    for i, j in reversed(_sorting_network(n)):
+        if (i in need) or (j in need):
+            network.append((i, j, i in need, j in need))
+            need |= {i, j}
+    return network[::-1]
+
+# share of image pixels with windows holding invalid pixels (estimated from the runs of valid pixels), above which
+# median_filter_1d uses +-inf sentinels instead of recomputing these pixels one by one
+SENTINEL_MEDIAN_SHARE = 0.05
+
+def _count_runs(valid: np.ndarray,
+                axis: int) -> int:
+    """
+    Number of runs of consecutive valid pixels along an image axis.
+    """
+    if axis == 0:
+        valid = valid.T
+    xp = _array_module(valid)
+    return int(xp.count_nonzero(valid[:, 0]) + xp.count_nonzero(valid[:, 1:] > valid[:, :-1]))
+
+def _block_rows(backend, height, width, block_bytes):
+    """
+    Rows per block of the cache blocked median loops, whole image if neither block_bytes nor the backend set a size.
+    """
+    if block_bytes is None:
+        block_bytes = backend.block_bytes
+    return max(1, block_bytes // (8 * max(width, 1))) if block_bytes is not None else height
+
+def median_filter_1d(image: np.ndarray,
+                     kernel: int,
+                     axis: int,
+                     block_bytes: int = None,
+                     runs: int = None) -> np.ndarray:
+    """
+    Sliding median of odd kernel size along one image axis that ignores nan (invalid) pixels.
+    Full windows use a pruned sorting network of elementwise min/max evaluated over cache sized blocks of rows.
+    Since nan propagates through the network, windows containing invalid pixels come out as nan and only these
+    pixels are recomputed with the median of their valid neighbours.
+    Fragmented (speckle) masks, where the pixels near the ends of runs of valid pixels exceed SENTINEL_MEDIAN_SHARE
+    of the image, are filtered by _sentinel_median_1d instead, which needs no per pixel recomputation.
+    Parameters
+    ----------
+    image: np.ndarray/cp.ndarray:float.
+           Image with nan for invalid pixels.
+    kernel: int.
+            Odd kernel size.
+    axis: int.
+          1 to filter along rows, 0 to filter along columns.
+    block_bytes: int.
+                 Approximate size of each block of rows. Default is the block size of the backend, whole image if
+                 the backend has none.
+    runs: int.
+          Number of runs of consecutive valid pixels along axis (e.g. from PixelSet.row_runs for axis 1), used to
+          choose the method. Default counts them in image.
+    Returns
+    -------
+    med_fil: np.ndarray/cp.ndarray:float.
+             Median filtered image, nan at invalid pixels.
+    """
+    backend = backend_of(image)
+    xp = backend.xp
+    height, width = image.shape
+    r = kernel // 2
+    invalid = xp.isnan(image)
+    if runs is None:
+        runs = _count_runs(~invalid, axis)
+    # each run has at most 2r pixels whose window reaches past its ends
+    if 2 * r * runs > SENTINEL_MEDIAN_SHARE * height * width:
+        return _sentinel_median_1d(image, invalid, kernel, axis, block_bytes)
+    if axis == 1:
+        pad = xp.full((height, width + 2 * r), np.nan)
+        pad[:, r:r + width] = image
+    else:
+        pad = xp.full((height + 2 * r, width), np.nan)
+        pad[r:r + height] = image
+    network = median_network(kernel)
+    med_fil = xp.empty((height, width))
+    block = _block_rows(backend, height, width, block_bytes)
+    for start in range(0, height, block):
+        end = min(start + block, height)
+        if axis == 1:
+            wires = [pad[start:end, d:d + width] for d in range(kernel)]
+        else:
+            wires = [pad[start + d:end + d] for d in range(kernel)]
+        for i, j, need_min, need_max in network:
+            low = xp.minimum(wires[i], wires[j]) if need_min else None
+            high = xp.maximum(wires[i], wires[j]) if need_max else None
+            wires[i] = low
+            wires[j] = high
+        med_fil[start:end] = wires[r]
+    # windows with invalid pixels: sort with nan as inf and average the middle valid values
+    flat_idx = xp.flatnonzero(xp.isnan(med_fil) & ~invalid)
+    if len(flat_idx):
+        if axis == 1:
+            pad_idx = flat_idx + 2 * r * (flat_idx // width)
+            step = 1
+        else:
+            pad_idx = flat_idx
+            step = width
+        wires = [xp.take(pad, pad_idx + d * step) for d in range(kernel)]
+        count = xp.zeros(len(flat_idx), dtype=np.int8)
+        for wire in wires:
+            missing = xp.isnan(wire)
+            count += ~missing
+            wire[missing] = np.inf
+        for i, j in _sorting_network(kernel):
+            wires[i], wires[j] = xp.minimum(wires[i], wires[j]), xp.maximum(wires[i], wires[j])
+        wires = xp.stack(wires)
+        low = xp.take_along_axis(wires, ((count - 1) // 2)[None, :], axis=0)[0]
+        high = xp.take_along_axis(wires, (count // 2)[None, :], axis=0)[0]
+        med_fil.ravel()[flat_idx] = (low + high) / 2
+    return med_fil
+
+def _sentinel_median_1d(image: np.ndarray,
+                        invalid: np.ndarray,
+                        kernel: int,
+                        axis: int,
+                        block_bytes: int = None) -> np.ndarray:
+    """
+    Sliding median of median_filter_1d for images with many invalid pixels scattered over the valid ones.
+    Invalid pixels are replaced by +inf and -inf alternately along the axis, so a window of m invalid pixels holds
+    m/2 of each or one more of either. The median of the window is then the median of its valid pixels if m is even,
+    otherwise the upper (one more +inf) or lower (one more -inf) of the two middle valid values, which is averaged
+    with the neighbouring order statistic. The parity of the invalid pixel count before and at the end of each
+    window tells the case, so one pass of a sorting network pruned to the three middle outputs filters all pixels.
+    """
+    backend = backend_of(image)
+    xp = backend.xp
+    height, width = image.shape
+    r = kernel // 2
+    # one more leading pad pixel holds the parity before the first window
+    if axis == 1:
+        inner = (slice(None), slice(r + 1, r + 1 + width))
+        pad_shape = (height, width + 2 * r + 1)
+    else:
+        inner = (slice(r + 1, r + 1 + height), slice(None))
+        pad_shape = (height + 2 * r + 1, width)
+    pad_invalid = xp.ones(pad_shape, dtype=bool)
+    pad_invalid[inner] = invalid
+    pad = xp.empty(pad_shape)
+    pad[inner] = image
+    # parity of the number of invalid pixels up to each pixel along the axis, as running xor over the lines
+    parity = pad_invalid.astype(np.int8)
+    lines = parity if axis == 0 else parity.T
+    for i in range(1, lines.shape[0]):
+        xp.bitwise_xor(lines[i - 1], lines[i], out=lines[i])
+    pad_idx = xp.flatnonzero(pad_invalid)
+    pad.ravel()[pad_idx] = xp.where(parity.ravel()[pad_idx], np.inf, -np.inf)
+    network = median_network(kernel, (r - 1, r, r + 1))
+    med_fil = xp.empty((height, width))
+    block = _block_rows(backend, height, width, block_bytes)
+    # shifts wires[r] beyond wires[r - 1] or wires[r + 1] without the nan of 0 * inf
+    big = np.finfo(np.float64).max
+    # wires[r] + neighbour is +inf - inf at some invalid center pixels, these are set to nan at the end
+    with np.errstate(invalid='ignore'):
+        for start in range(0, height, block):
+            end = min(start + block, height)
+            if axis == 1:
+                wires = [pad[start:end, 1 + d:1 + d + width] for d in range(kernel)]
+                before = parity[start:end, :width]
+                after = parity[start:end, kernel:kernel + width]
+            else:
+                wires = [pad[start + 1 + d:end + 1 + d] for d in range(kernel)]
+                before = parity[start:end]
+                after = parity[start + kernel:end + kernel]
+            for i, j, need_min, need_max in network:
+                low = xp.minimum(wires[i], wires[j]) if need_min else None
+                high = xp.maximum(wires[i], wires[j]) if need_max else None
+                wires[i] = low
+                wires[j] = high
+            # parity falls (rises) over a window with one more -inf (+inf), where wires[r] is the lower (upper) middle
+            # value, it is averaged with wires[r + 1] (wires[r - 1]). Min/max select without branches, in place.
+            neighbour = (before - after) * big
+            neighbour += wires[r]
+            xp.minimum(wires[r + 1], neighbour, out=neighbour)
+            xp.maximum(wires[r - 1], neighbour, out=neighbour)
+            xp.add(wires[r], neighbour, out=med_fil[start:end])
+            med_fil[start:end] /= 2
+    med_fil[invalid] = np.nan
+    return med_fil
+
 def filt(unwrap: np.ndarray,
          kernel: int,
-         direc: str) -> Tuple[np.ndarray, np.ndarray]:
+         direc: str,
+         pixels: PixelSet = None) -> Tuple[np.ndarray, np.ndarray]:
     """
     Function is used to remove artifacts generated in the temporal unwrapped phase map. 
     A median filter is applied to locate incorrectly unwrapped points, and those point phase is corrected by adding or
     subtracting an integer number of 2π.
+    For odd kernel sizes the mask aware median_filter_1d is used, invalid (nan) pixels are skipped in the median
+    instead of spreading into their neighbours. Even kernel sizes use the median_filter of the backend ndimage module.
 
     Parameters
     ----------
-    unwrap: np.ndarray:float.
+    unwrap: np.ndarray/cp.ndarray:float.
             Unwrapped phase map with spike noise.
     kernel: int.
             Kernel size for median filter.
     direc: str.
            Vertical (v) or horizontal(h) pattern.
+    pixels: PixelSet.
+            Valid pixels of unwrap. If given, filtering is limited to their bounding box and the number of their row
+            runs chooses the median_filter_1d method for vertical fringes.
     Returns
     -------
     correct_unwrap: np.ndarray:float.
@@ -545,16 +920,31 @@ def filt(unwrap: np.ndarray,
              Spiking point fringe order.
 
     """
+    backend = backend_of(unwrap)
     if direc == 'v':
         k = (1, kernel)  # kernel size
+        axis = 1
     elif direc == 'h':
         k = (kernel, 1)
+        axis = 0
     else:
         print("ERROR:Invalid directions.Directions should be \'v\'for vertical fringes and \'h\'for horizontal fringes")
         k = None
-    med_fil = scipy.ndimage.median_filter(unwrap, k)
-    k_array = np.round((unwrap - med_fil) / (2 * np.pi))
-    correct_unwrap = unwrap - (k_array * 2 * np.pi)
+    with span('filt'):
+        if (k is not None) and (kernel % 2 == 1):
+            if pixels is not None:
+                row_start, row_stop, col_start, col_stop = pixels.bbox
+                # row runs are the runs along the filter axis of vertical fringes
+                runs = len(pixels.row_runs) if axis == 1 else None
+                med_fil = backend.xp.full(unwrap.shape, np.nan)
+                med_fil[row_start:row_stop, col_start:col_stop] = median_filter_1d(unwrap[row_start:row_stop, col_start:col_stop],
+                                                                                   kernel, axis, runs=runs)
+            else:
+                med_fil = median_filter_1d(unwrap, kernel, axis)
+        else:
+            med_fil = backend.ndimage.median_filter(unwrap, k)
+        k_array = backend.xp.round((unwrap - med_fil) / (2 * np.pi))
+        correct_unwrap = unwrap - (k_array * 2 * np.pi)
     return correct_unwrap, k_array
 
 def ph_temp_unwrap(cos_wrap_v: np.ndarray,
@@ -625,7 +1015,7 @@ def multi_kunwrap(wavelength: np.array,
        Fringe order of the lowest wavelength (the highest frequency)
 
     """
-    k = np.round(((wavelength[0] / wavelength[1]) * ph[0] - ph[1]) / (2 * np.pi))
+    k = _array_module(ph[1]).round(((wavelength[0] / wavelength[1]) * ph[0] - ph[1]) / (2 * np.pi))
     unwrap = ph[1] + 2 * np.pi * k
     return unwrap, k
 
@@ -638,18 +1028,18 @@ def multifreq_unwrap(wavelength_arr: np.array,
                      cam_height: int) -> Tuple[np.ndarray, np.ndarray]:
     """
     Function performs sequential temporal multi-frequency phase unwrapping from high wavelength (low frequency)
-    wrapped phase map to low wavelength (high frequency) wrapped phase map.
+    wrapped phase map to low wavelength (high frequency) wrapped phase map, on the backend of phase_arr.
     Parameters
     ----------
     wavelength_arr: np.array:float.
                     Wavelengths from high wavelength to low wavelength.
-    phase_arr: np.ndarray.
+    phase_arr: np.ndarray/cp.ndarray.
                Wrapped phase maps from high wavelength to low wavelength.
     kernel_size: int
             Filter kernel.
     direc: str
            'v' for vertical or 'h' for horizontal filter
-    mask: np.ndarray
+    mask: np.ndarray/PixelSet
             Mask for image recovery.
     cam_width: int
                 Camera width
@@ -661,16 +1051,118 @@ def multifreq_unwrap(wavelength_arr: np.array,
                   The final unwrapped phase map of low wavelength (high frequency) wrapped phase map.
     k4: np.ndarray:int.
         The fringe order of low wavelength (high frequency) phase map.
-
+    mask: np.ndarray/PixelSet
+          Valid pixels of unwrapped phase map, same type as input mask.
     """
+    pixels = as_pixel_set(mask)
     absolute_ph, k = multi_kunwrap(wavelength_arr[0:2], phase_arr[0:2])
     for i in range(1, len(wavelength_arr)-1):
         absolute_ph, k = multi_kunwrap(wavelength_arr[i:i+2], [absolute_ph, phase_arr[i+1]]) 
-    absolute_ph = recover_image(absolute_ph, mask, cam_height, cam_width)
-    absolute_ph, k0 = filt(absolute_ph, kernel_size, direc)  # correction of unwrapped phase map image with nan using median filter creates nan values.
-    mask =  ~np.isnan(absolute_ph)
-    absolute_ph = absolute_ph[mask]
-    return absolute_ph, k, mask
+    absolute_ph = pixels.scatter(absolute_ph)
+    absolute_ph, k0 = filt(absolute_ph, kernel_size, direc, pixels)  # median filter correction of spiking points, invalid pixels skipped.
+    absolute_ph = pixels.gather(absolute_ph)
+    valid = ~_array_module(absolute_ph).isnan(absolute_ph)
+    unwrap_pixels = pixels.subset(valid)
+    absolute_ph = absolute_ph[valid]
+    if isinstance(mask, PixelSet):
+        return absolute_ph, k, unwrap_pixels
+    return absolute_ph, k, unwrap_pixels.mask
+
+def phase_unwrap_tiled(images: np.ndarray,
+                       limit: float,
+                       N: list,
+                       wavelength_arr: np.array,
+                       kernel_size: int,
+                       direc: str,
+                       cam_width: int,
+                       cam_height: int,
+                       max_memory: int,
+                       dark_bias: np.ndarray = None,
+                       phase_fix: float = None,
+                       model: list = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Function performs phase_cal followed by multifreq_unwrap on bands of image rows so that peak memory is bounded
+    by max_memory instead of growing with the full capture stack. Each band is extended by the rows needed by
+    the median filter in filt, hence the result is identical to the full frame computation.
+    Parameters
+    ----------
+    images: np.ndarray.
+            Captured fringe images (any dtype, can be np.memmap). Only one band is converted to float64 at a time.
+    limit: float.
+           Background limit. Regions with low intensity for reference images lesser than limit will be masked out.
+    N: list.
+        List of number of patterns in each level.
+    wavelength_arr: np.array:float.
+                    Wavelengths from high wavelength to low wavelength.
+    kernel_size: int
+            Filter kernel.
+    direc: str
+           'v' for vertical or 'h' for horizontal filter
+    cam_width: int
+                Camera width
+    cam_height: int
+                Camera height
+    max_memory: int.
+                Memory budget in bytes for the intermediate arrays of a band.
+    dark_bias: np.ndarray:float.
+               Dark bias image subtracted from each band, if given.
+    phase_fix: float.
+               If given, 2π is added to wrapped phase of the first level where it is lesser than phase_fix.
+    model: list.
+           Intensity noise model. If given the phase variance maps of the last two levels are calculated.
+    Returns
+    -------
+    white_img: np.ndarray:float.
+               White image of the last level.
+    absolute_ph: np.ndarray:float.
+                 The final unwrapped phase map vector of low wavelength (high frequency) wrapped phase map.
+    k: np.ndarray:int.
+       The fringe order vector of low wavelength (high frequency) phase map.
+    mask: np.ndarray:bool.
+          Mask of the unwrapped phase map.
+    sigmasq_phi: np.ndarray:float.
+                 Phase variance maps of the last two levels (2, cam_height, cam_width), None if model is not given.
+    """
+    if direc == 'h':
+        halo = kernel_size // 2
+    else:
+        halo = 0
+    # float64 band, its masked copy in phase_cal and the level decks take about five band sized arrays
+    row_bytes = 5 * images.shape[0] * cam_width * 8
+    band_rows = max(1, int(max_memory // row_bytes) - 2 * halo)
+    white_img = np.full((cam_height, cam_width), np.nan)
+    mask = np.zeros((cam_height, cam_width), dtype=bool)
+    if model is not None:
+        sigmasq_phi = np.full((2, cam_height, cam_width), np.nan)
+    else:
+        sigmasq_phi = None
+    absolute_ph_lst = []
+    k_lst = []
+    for start in range(0, cam_height, band_rows):
+        end = min(start + band_rows, cam_height)
+        ext_start = max(start - halo, 0)
+        ext_end = min(end + halo, cam_height)
+        band = np.asarray(images[:, ext_start:ext_end], dtype=np.float64)
+        if dark_bias is not None:
+            band = band - dark_bias[ext_start:ext_end]
+        ext_rows = ext_end - ext_start
+        mod_stack, white_stack, phase_map, band_mask = phase_cal(band, limit, N, False)
+        if phase_fix is not None:
+            phase_map[0][phase_map[0] < phase_fix] = phase_map[0][phase_map[0] < phase_fix] + 2 * np.pi
+        band_ph, band_k, band_unwrap_mask = multifreq_unwrap(wavelength_arr, phase_map, kernel_size, direc, 
+                                                             band_mask, cam_width, ext_rows)
+        core = slice(start - ext_start, end - ext_start)
+        core_mask = band_unwrap_mask[core]
+        absolute_ph_lst.append(recover_image(band_ph, band_unwrap_mask, ext_rows, cam_width)[core][core_mask])
+        k_lst.append(recover_image(band_k, band_mask, ext_rows, cam_width)[core][band_mask[core]])
+        white_img[start:end] = white_stack[-1][core]
+        mask[start:end] = core_mask
+        if model is not None:
+            sigmasq_phi[0, start:end] = var_func(band[-(N[-2] + N[-1]):-N[-1], core], core_mask, N[-2], model)
+            sigmasq_phi[1, start:end] = var_func(band[-N[-1]:, core], core_mask, N[-1], model)
+    absolute_ph = np.concatenate(absolute_ph_lst)
+    k = np.concatenate(k_lst)
+    return white_img, absolute_ph, k, mask, sigmasq_phi
 
 def multiwave_unwrap(wavelength_arr: np.ndarray,
                      phase_arr: np.array,
@@ -696,15 +1188,14 @@ def multiwave_unwrap(wavelength_arr: np.ndarray,
 
     """
     
+    pixels = as_pixel_set(mask)
     absolute_ph, k = multi_kunwrap(wavelength_arr[0:2], phase_arr[0:2])
-    absolute_ph = recover_image(absolute_ph, mask, cam_height, cam_width)
-    absolute_ph, k0 = filt(absolute_ph, kernel, direc)
-    absolute_ph = absolute_ph[mask]
+    absolute_ph, k0 = filt(pixels.scatter(absolute_ph), kernel, direc, pixels)
+    absolute_ph = pixels.gather(absolute_ph)
     for i in range(1, len(wavelength_arr)-1):
         absolute_ph, k = multi_kunwrap(wavelength_arr[i:i+2], [absolute_ph, phase_arr[i+1]])
-    absolute_ph = recover_image(absolute_ph, mask, cam_height, cam_width)
-    absolute_ph, k0 = filt(absolute_ph, kernel, direc)
-    absolute_ph = absolute_ph[mask]    
+    absolute_ph, k0 = filt(pixels.scatter(absolute_ph), kernel, direc, pixels)
+    absolute_ph = pixels.gather(absolute_ph)
     return absolute_ph, k
 
 def edge_rectification(multi_phase_123: np.ndarray,
@@ -749,9 +1240,10 @@ def bilinear_interpolate(image, x, y,  sigmasq_image=None):
 
     """
     # neighbours
-    x0 = np.floor(x).astype(int)
+    xp = _array_module(x)
+    x0 = xp.floor(x).astype(int)
     x1 = x0 + 1
-    y0 = np.floor(y).astype(int)
+    y0 = xp.floor(y).astype(int)
     y1 = y0 + 1
     image_a = image[y0, x0]
     image_b = image[y1, x0]
@@ -774,21 +1266,189 @@ def bilinear_interpolate(image, x, y,  sigmasq_image=None):
 
     return new_image, int_pred_var
 
+def bilinear_interpolate_stack(images, x, y, sigmasq_images=None, masks=None):
+    """
+    Function to perform bi-linear interpolation of point sets in a stack of images in one vectorized call. 
+    Point set i is interpolated in image i.
+
+    Parameters
+    ----------
+    images = type:float. (no. of images x height x width) numpy array or list of images.
+    x = type:float. (no. of images x no. of points) subpixel x coordinates.
+    y = type:float. (no. of images x no. of points) subpixel y coordinates.
+    sigmasq_images = type:float. Stack or list of variance images.
+    masks = type:bool. Stack or list of masks, points with a neighbour outside the mask are nan.
+
+    Returns
+    -------
+    Subpixel mapped absolute values and corresponding variances (no. of images x no. of points). 
+    """
+    # neighbours
+    x0 = np.floor(x).astype(int)
+    x1 = x0 + 1
+    y0 = np.floor(y).astype(int)
+    y1 = y0 + 1
+    if isinstance(images, np.ndarray):
+        pose = np.arange(x.shape[0])[:, None]
+        gather = lambda stack, yy, xx: stack[pose, yy, xx]
+    else:
+        gather = lambda stack, yy, xx: np.stack([image[yy[i], xx[i]] for i, image in enumerate(stack)])
+    neighbours = lambda stack: [gather(stack, y0, x0), gather(stack, y1, x0), gather(stack, y0, x1), gather(stack, y1, x1)]
+    # weights
+    weights = [(x1-x) * (y1-y), (x1-x) * (y-y0), (x-x0) * (y1-y), (x-x0) * (y-y0)]
+    new_image = sum(w * n for w, n in zip(weights, neighbours(images)))
+    if sigmasq_images is not None:
+        int_pred_var = sum(w ** 2 * n for w, n in zip(weights, neighbours(sigmasq_images)))
+    else:
+        int_pred_var = None
+    if masks is not None:
+        outside = ~np.logical_and.reduce(neighbours(masks))
+        new_image[outside] = np.nan
+        if int_pred_var is not None:
+            int_pred_var[outside] = np.nan
+    return new_image, int_pred_var
+
+# least recently used undistortion maps keyed by (camera_mtx, camera_dist, shape), device copies by
+# (backend name, camera_mtx, camera_dist, shape). Each entry holds full resolution maps.
+UNDISTORT_MAP_CACHE_SIZE = 4
+_undistort_maps = OrderedDict()
+_undistort_maps_lock = threading.Lock()
+
+def _cached_undistort_map(key):
+    with _undistort_maps_lock:
+        maps = _undistort_maps.get(key)
+        if maps is not None:
+            _undistort_maps.move_to_end(key)
+        return maps
+
+def _cache_undistort_map(key, maps):
+    with _undistort_maps_lock:
+        _undistort_maps[key] = maps
+        _undistort_maps.move_to_end(key)
+        while len(_undistort_maps) > UNDISTORT_MAP_CACHE_SIZE:
+            _undistort_maps.popitem(last=False)
+    return maps
+
+def undistort_map_key(camera_mtx: np.ndarray,
+                      camera_dist: np.ndarray,
+                      shape: tuple) -> tuple:
+    """
+    Hashable cache key of undistortion maps from host copies of the camera matrix and distortion.
+    """
+    camera_mtx = np.asarray(to_numpy(camera_mtx), dtype=np.float64)
+    camera_dist = np.asarray(to_numpy(camera_dist), dtype=np.float64)
+    return camera_mtx.tobytes(), camera_dist.tobytes(), tuple(shape)
+
+def undistort_map(camera_mtx: np.ndarray,
+                  camera_dist: np.ndarray,
+                  shape: tuple,
+                  backend=None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Function computes (once per camera matrix, distortion and image shape) the bi-linear interpolation table 
+    used to undistort an image. Later calls return the cached table, the UNDISTORT_MAP_CACHE_SIZE most recently
+    used tables are kept. The table is computed on the host, other backends get a cached copy of it.
+    Parameters
+    ----------
+    camera_mtx: np.ndarray.
+                Camera intrinsic matrix.
+    camera_dist: np.ndarray.
+                 Camera distortion matrix.
+    shape: tuple.
+           Image shape (height, width).
+    backend: Backend/str.
+             Backend of returned table. Default is numpy.
+    Returns
+    -------
+    flat_idx: np.ndarray:int.
+              4 x height x width flat indices of the neighbours a (y0,x0), b (y1,x0), c (y0,x1), d (y1,x1) 
+              of each mapped pixel.
+    weights: np.ndarray:float.
+             4 x height x width bi-linear weights of neighbours.
+    weights_sq: np.ndarray:float.
+                Squared weights for variance propagation.
+    """
+    key = undistort_map_key(camera_mtx, camera_dist, shape)
+    backend = get_backend(backend)
+    if backend.xp is not np:
+        maps = _cached_undistort_map((backend.name,) + key)
+        if maps is None:
+            host_maps = undistort_map(camera_mtx, camera_dist, shape)
+            maps = _cache_undistort_map((backend.name,) + key, tuple(backend.asarray(m) for m in host_maps))
+        return maps
+    maps = _cached_undistort_map(key)
+    if maps is None:
+        camera_mtx = np.asarray(to_numpy(camera_mtx), dtype=np.float64)
+        camera_dist = np.asarray(to_numpy(camera_dist), dtype=np.float64)
+        height, width = shape
+        uc, vc = np.meshgrid(np.arange(0, width), np.arange(0, height))
+        x = (uc - camera_mtx[0, 2])/camera_mtx[0, 0]
+        y = (vc - camera_mtx[1, 2])/camera_mtx[1, 1]
+        r_sq = x**2 + y**2
+        x_double_dash = x*(1 + camera_dist[0, 0] * r_sq + camera_dist[0, 1] * r_sq**2)
+        y_double_dash = y*(1 + camera_dist[0, 0] * r_sq + camera_dist[0, 1] * r_sq**2)
+        map_x = x_double_dash * camera_mtx[0, 0] + camera_mtx[0, 2]
+        map_y = y_double_dash * camera_mtx[1, 1] + camera_mtx[1, 2]
+        # neighbours
+        x0 = np.floor(map_x).astype(int)
+        x1 = x0 + 1
+        y0 = np.floor(map_y).astype(int)
+        y1 = y0 + 1
+        flat_idx = np.empty((4, height, width), dtype=np.intp)
+        for i, (yn, xn) in enumerate([(y0, x0), (y1, x0), (y0, x1), (y1, x1)]):
+            # same negative index convention as image[yn, xn]
+            flat_idx[i] = np.ravel_multi_index((np.where(yn < 0, yn + height, yn), np.where(xn < 0, xn + width, xn)), 
+                                               shape)
+        # weights
+        weights = np.array([(x1-map_x) * (y1-map_y),
+                            (x1-map_x) * (map_y-y0),
+                            (map_x-x0) * (y1-map_y),
+                            (map_x-x0) * (map_y-y0)])
+        maps = _cache_undistort_map(key, (flat_idx, weights, weights ** 2))
+    return maps
+
+def weighted_gather(image: np.ndarray,
+                    flat_idx: np.ndarray,
+                    weights: np.ndarray) -> np.ndarray:
+    """
+    Weighted sum of the four gathered neighbours, sum_i weights[i] * image.flat[flat_idx[i]].
+    """
+    xp = _array_module(image)
+    out = xp.take(image, flat_idx[0])
+    out *= weights[0]
+    temp = xp.empty_like(out)
+    for i in range(1, 4):
+        xp.take(image, flat_idx[i], out=temp)
+        temp *= weights[i]
+        out += temp
+    return out
+
 def undistort(image, camera_mtx, camera_dist, sigmasq_image=None): # image with nan values after undistorting and applying interpolation creates nan values
-    # no_img = image.shape[0]
-    u = np.arange(0, image.shape[1])
-    v = np.arange(0, image.shape[0])
-    uc, vc = np.meshgrid(u, v)
-    # uc = np.repeat(uc[np.newaxis,:,:],no_img,axis=0)
-    # vc = np.repeat(vc[np.newaxis,:,:],no_img,axis=0)
-    x = (uc - camera_mtx[0, 2])/camera_mtx[0, 0]
-    y = (vc - camera_mtx[1, 2])/camera_mtx[1, 1]
-    r_sq = x**2 + y**2
-    x_double_dash = x*(1 + camera_dist[0, 0] * r_sq + camera_dist[0, 1] * r_sq**2)
-    y_double_dash = y*(1 + camera_dist[0, 0] * r_sq + camera_dist[0, 1] * r_sq**2)
-    map_x = x_double_dash * camera_mtx[0, 0] + camera_mtx[0, 2]
-    map_y = y_double_dash * camera_mtx[1, 1] + camera_mtx[1, 2]
-    undistort_image, image_var = bilinear_interpolate(image, map_x, map_y, sigmasq_image) 
+    """
+    Function to undistort an image and propagate its variance using the cached undistortion map 
+    on the backend of image.
+    Parameters
+    ----------
+    image: np.ndarray/cp.ndarray:float.
+           Image to apply undistortion.
+    camera_mtx: np.ndarray.
+                Camera intrinsic matrix.
+    camera_dist: np.ndarray.
+                 Camera distortion matrix.
+    sigmasq_image: np.ndarray:float.
+                   The image variance.
+    Returns
+    -------
+    undistort_image: np.ndarray:float.
+                     Undistorted image.
+    image_var: np.ndarray:float.
+               Variance image, None if sigmasq_image is None.
+    """
+    flat_idx, weights, weights_sq = undistort_map(camera_mtx, camera_dist, image.shape, backend_of(image))
+    undistort_image = weighted_gather(image, flat_idx, weights)
+    if sigmasq_image is not None:
+        image_var = weighted_gather(sigmasq_image, flat_idx, weights_sq)
+    else:
+        image_var = None
     return undistort_image, image_var
 # =====================================================
 # For diagnosis
@@ -818,9 +1478,9 @@ def main():
     cam_width = 128
     cam_height = 128
     fringe_arr_np = np.load("test_data/toy_data.npy")
-    with open(r'test_data\vertical_fringes_np.pickle', 'rb') as f:
+    with open(os.path.join('test_data', 'vertical_fringes_np.pickle'), 'rb') as f:
         vertical_fringes = pickle.load(f)
-    with open(r'test_data\horizontal_fringes_np.pickle', 'rb') as f:
+    with open(os.path.join('test_data', 'horizontal_fringes_np.pickle'), 'rb') as f:
         horizontal_fringes = pickle.load(f)
     # testing #1:
     mod_stack, white_stack, phase_map, mask = phase_cal(fringe_arr_np, test_limit, N_list, True)
@@ -828,7 +1488,7 @@ def main():
     phase_np_h = phase_map[1::2]
     if phase_np_v.all() == vertical_fringes['phase_map_np_v'].all():
         print('\n All vertical phase maps match')
-        multifreq_unwrap_np_v, k_arr_np_v = multifreq_unwrap(pitch_list, phase_np_v, 1, 'v', mask, cam_width, cam_height)
+        multifreq_unwrap_np_v, k_arr_np_v, _ = multifreq_unwrap(pitch_list, phase_np_v, 1, 'v', mask, cam_width, cam_height)
         if multifreq_unwrap_np_v.all() == vertical_fringes['multifreq_unwrap_np_v'].all():
             print('\n Vertical unwrapped phase maps match')
         else:
@@ -837,13 +1497,23 @@ def main():
         print('\n Vertical phase map mismatch')
     if phase_np_h.all() == horizontal_fringes['phase_map_np_h'].all():
         print('\n All horizontal phase maps match')
-        multifreq_unwrap_np_h, k_arr_np_h = multifreq_unwrap(pitch_list, phase_np_h, 1, 'h', mask, cam_width, cam_height)
+        multifreq_unwrap_np_h, k_arr_np_h, _ = multifreq_unwrap(pitch_list, phase_np_h, 1, 'h', mask, cam_width, cam_height)
         if multifreq_unwrap_np_h.all() == horizontal_fringes['multifreq_unwrap_np_h'].all():
             print('\n Horizontal unwrapped phase maps match')
         else:
             print('\n Horizontal unwrapped phase map mismatch ')  
     else:
         print('\n Horizontal phase map mismatch')
+    # testing #2: phase variance against reference computed with full variance covariance matrix
+    with open(os.path.join('test_data', 'phase_variance_np.pickle'), 'rb') as f:
+        phase_variance = pickle.load(f)
+    sigmasq_phi_v = var_func(fringe_arr_np[-2 * N_list[-1]:-N_list[-1]], mask, N_list[-1], phase_variance['model'])
+    sigmasq_phi_h = var_func(fringe_arr_np[-N_list[-1]:], mask, N_list[-1], phase_variance['model'])
+    if (np.allclose(sigmasq_phi_v, phase_variance['sigmasq_phi_np_v'], rtol=1e-10, equal_nan=True)
+            and np.allclose(sigmasq_phi_h, phase_variance['sigmasq_phi_np_h'], rtol=1e-10, equal_nan=True)):
+        print('\n Phase variance maps match')
+    else:
+        print('\n Phase variance map mismatch')
 
     return 
 
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 12:41:05 2026
+
+@author: kl001
+
+Persistent cache of per pose calibration artifacts (wrapped and unwrapped phase maps, modulation, masks, true
+image, circle detections and projector image points). Entries are .npz files named by a hash of the captured data
+content together with the parameters used to compute them, so a pose is analysed once and reused by every calibration
+run and every bootstrap sample set. A changed capture or changed parameter gives a new key, stale entries are never
+read.
+"""
+import os
+import glob
+import hashlib
+import numpy as np
+
+POSE_CACHE = 'pose_cache'
+CACHE_VERSION = 2
+
+
+class PoseCache:
+    """
+    Directory of cached pose artifacts. Each entry is a dictionary of arrays stored as one .npz file.
+    """
+    def __init__(self, cache_dir):
+        """
+        Parameters
+        ----------
+        cache_dir: str.
+                   Directory of cache files. It is created on first save.
+        """
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def content_hash(source):
+        """
+        Function to hash the content of a captured image source.
+        Parameters
+        ----------
+        source: list/str/np.ndarray.
+                List of frame paths, path of .npy stack or stack array (e.g. memory map of a scan archive pose).
+        Returns
+        -------
+        digest: str.
+                Hex digest of source content.
+        """
+        h = hashlib.blake2b(digest_size=16)
+        if isinstance(source, np.ndarray):
+            h.update(repr((source.shape, source.dtype.str)).encode('utf-8'))
+            h.update(memoryview(np.ascontiguousarray(source)).cast('B'))
+        else:
+            for path in ([source] if isinstance(source, str) else source):
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(2**22), b''):
+                        h.update(chunk)
+        return h.hexdigest()
+
+    @staticmethod
+    def key(*parts):
+        """
+        Function to build a cache key from content hashes and parameters.
+        Parameters
+        ----------
+        parts: str/int/float/list/np.ndarray/None.
+               Values the cached artifacts depend on. Arrays are hashed by shape, type and content,
+               other values by their repr.
+        Returns
+        -------
+        key: str.
+             Hex digest used as entry name.
+        """
+        h = hashlib.blake2b(digest_size=16)
+        h.update(str(CACHE_VERSION).encode('utf-8'))
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                h.update(repr((part.shape, part.dtype.str)).encode('utf-8'))
+                h.update(memoryview(np.ascontiguousarray(part)).cast('B'))
+            else:
+                h.update(repr(part).encode('utf-8'))
+            h.update(b'|')
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '%s.npz' % key)
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def load(self, key):
+        """
+        Function to read a cache entry.
+        Parameters
+        ----------
+        key: str.
+             Entry key.
+        Returns
+        -------
+        entry: dict.
+               Dictionary of cached arrays, None if entry does not exist.
+        """
+        if key not in self:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._read(key)
+
+    def _read(self, key):
+        with np.load(self._path(key)) as data:
+            return {name: data[name] for name in data.files}
+
+    def save(self, key, **arrays):
+        """
+        Function to write a cache entry. None values are not stored.
+        The entry is written to a temporary file first so that an interrupted run never leaves a partial entry.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self._path(key) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **{name: a for name, a in arrays.items() if a is not None})
+        os.replace(tmp_path, self._path(key))
+
+    def update(self, key, **arrays):
+        """
+        Function to add arrays to an existing entry (or create it).
+        """
+        entry = self._read(key) if key in self else {}
+        entry.update(arrays)
+        self.save(key, **entry)
+
+    def clear(self):
+        """
+        Function to remove all cache entries.
+        """
+        for path in glob.glob(os.path.join(self.cache_dir, '*.npz')):
+            os.remove(path)
+        self.hits = 0
+        self.misses = 0
@@ -6,16 +6,19 @@ Created on Tue May 24 13:00:19 2022
 @author: Sreelakshmi
 """
 import numpy as np
-import cupy as cp
 import glob
 import cv2
 import os
-from plyfile import PlyData, PlyElement
 import nstep_fringe as nstep
-import nstep_fringe_cp as nstep_cp
-import matplotlib.pyplot as plt
+from backend import backend_available, get_backend, to_numpy
+from capture_loader import CaptureLoader
+from scan_archive import ScanArchive, SCAN_ARCHIVE
+from lazy_modules import LazyModule
+from instrumentation import NULL_TRACER, span
 import pickle
 
+plt = LazyModule('matplotlib.pyplot')
+
 EPSILON = -0.5
 TAU = 5.5
 #TODO: Convert to pyqtgraph. 
@@ -46,7 +49,9 @@ class Reconstruction:
                  temp=False,
                  save_ply=True,
                  probability=False,
-                 prob_up=True):
+                 prob_up=True,
+                 max_memory=None,
+                 tracer=None):
         self.proj_width = proj_width
         self.proj_height = proj_height
         self.cam_width = cam_width
@@ -64,8 +69,13 @@ class Reconstruction:
         self.save_ply = save_ply
         self.probability = probability
         self.prob_up=prob_up
+        # If set (bytes), cpu multifrequency phase unwrapping is done in row bands within this budget.
+        self.max_memory = max_memory
+        # instrumentation.Tracer recording a per scan trace of the pipeline stages, disabled by default.
+        self.tracer = tracer if tracer is not None else NULL_TRACER
         
-        self.mask = None
+        self.pixels = None
+        self.tri_lut = None
         if (self.type_unwrap == 'multifreq') or (self.type_unwrap == 'multiwave'):
             self.phase_st = 0
         else:
@@ -85,64 +95,131 @@ class Reconstruction:
         else:
             self.dark_bias = np.load(dark_bias_path)
     
-        if processing == 'cpu':
-            self.processing = processing
-            calibration_mean = np.load(os.path.join(self.calib_path, '{}_mean_calibration_param.npz'.format(self.type_unwrap)))
-            self.cam_mtx = calibration_mean["cam_mtx_mean"]
-            self.cam_dist = calibration_mean["cam_dist_mean"]
-            self.proj_mtx = calibration_mean["proj_mtx_mean"]
-            self.proj_dist = calibration_mean["proj_dist_mean"]
-            self.camproj_rot_mtx = calibration_mean["st_rmat_mean"]
-            self.camproj_trans_mtx = calibration_mean["st_tvec_mean"]
-            self.cam_h_mtx = calibration_mean["cam_h_mtx_mean"]
-            self.proj_h_mtx = calibration_mean["proj_h_mtx_mean"]
-            # self.uc_img = np.load(os.path.join(self.calib_path,"uc_img.npy"))
-            # self.vc_img = np.load(os.path.join(self.calib_path,"vc_img.npy"))
-            if not os.path.exists(model_path):
-                 print('ERROR:Path for noise error  %s does not exist' % self.calib_path)
-            else:
-                self.model = np.load(model_path)
-            if  ((probability == True) & (prob_up == False)):
-                calibration_std = np.load(os.path.join(self.calib_path, '{}_std_calibration_param.npz'.format(self.type_unwrap)))
-                self.cam_h_mtx_std = calibration_std["cam_h_mtx_std"]
-                self.proj_h_mtx_std = calibration_std["proj_h_mtx_std"]
-                
-            else:
-                self.proj_h_mtx_std = np.zeros((3,4))
-                self.cam_h_mtx_std = np.zeros((3,4))
-               
-        elif processing == 'gpu':
-            self.processing = processing
-            calibration_mean = cp.load(os.path.join(self.calib_path, '{}_mean_calibration_param.npz'.format(self.type_unwrap)))
-            self.cam_mtx = cp.asarray(calibration_mean["cam_mtx_mean"])
-            self.cam_dist = cp.asarray(calibration_mean["cam_dist_mean"])
-            self.proj_mtx = cp.asarray(calibration_mean["proj_mtx_mean"])
-            self.proj_dist = cp.asarray(calibration_mean["proj_dist_mean"])
-            self.camproj_rot_mtx = cp.asarray(calibration_mean["st_rmat_mean"])
-            self.camproj_trans_mtx = cp.asarray(calibration_mean["st_tvec_mean"])
-            self.cam_h_mtx = cp.asarray(calibration_mean["cam_h_mtx_mean"])
-            self.proj_h_mtx = cp.asarray(calibration_mean["proj_h_mtx_mean"])
-            #self.uc_img = cp.load(os.path.join(self.calib_path,"uc_img.npy"))
-            #self.vc_img = cp.load(os.path.join(self.calib_path,"vc_img.npy"))
-            if not os.path.exists(model_path):
-                 print('ERROR:Path for noise error  %s does not exist' % self.calib_path)
-            else:
-                self.model = cp.load(model_path)
-                
-            if ((probability == True) & (prob_up == False)):
-                calibration_std = cp.load(os.path.join(self.calib_path, '{}_std_calibration_param.npz'.format(self.type_unwrap)))
-                self.cam_h_mtx_std = cp.asarray(calibration_std["cam_h_mtx_std"])
-                self.proj_h_mtx_std = cp.asarray(calibration_std["proj_h_mtx_std"])
-               
-            else:
-                self.proj_h_mtx_std = cp.zeros((3,4))
-                self.cam_h_mtx_std = cp.zeros((3,4))
-                
-        else:
+        if not backend_available(processing):
             self.processing = None
             print("ERROR: Invalid processing type.")
             return
+        self.processing = processing
+        # arrays of the pipeline live on the processing backend ('cpu': numpy, 'gpu': cupy or any registered backend)
+        self.backend = get_backend(processing)
+        to_backend = self.backend.asarray
+        calibration_mean = np.load(os.path.join(self.calib_path, '{}_mean_calibration_param.npz'.format(self.type_unwrap)))
+        self.cam_mtx = to_backend(calibration_mean["cam_mtx_mean"])
+        self.cam_dist = to_backend(calibration_mean["cam_dist_mean"])
+        self.proj_mtx = to_backend(calibration_mean["proj_mtx_mean"])
+        self.proj_dist = to_backend(calibration_mean["proj_dist_mean"])
+        self.camproj_rot_mtx = to_backend(calibration_mean["st_rmat_mean"])
+        self.camproj_trans_mtx = to_backend(calibration_mean["st_tvec_mean"])
+        self.cam_h_mtx = to_backend(calibration_mean["cam_h_mtx_mean"])
+        self.proj_h_mtx = to_backend(calibration_mean["proj_h_mtx_mean"])
+        # self.uc_img = np.load(os.path.join(self.calib_path,"uc_img.npy"))
+        # self.vc_img = np.load(os.path.join(self.calib_path,"vc_img.npy"))
+        if not os.path.exists(model_path):
+             print('ERROR:Path for noise error  %s does not exist' % self.calib_path)
+        else:
+            self.model = to_backend(np.load(model_path))
+        if  ((probability == True) & (prob_up == False)):
+            calibration_std = np.load(os.path.join(self.calib_path, '{}_std_calibration_param.npz'.format(self.type_unwrap)))
+            self.cam_h_mtx_std = to_backend(calibration_std["cam_h_mtx_std"])
+            self.proj_h_mtx_std = to_backend(calibration_std["proj_h_mtx_std"])
+        else:
+            self.proj_h_mtx_std = self.backend.xp.zeros((3,4))
+            self.cam_h_mtx_std = self.backend.xp.zeros((3,4))
             
+    @property
+    def mask(self):
+        """
+        Boolean mask image (numpy) of valid pixels, derived from the valid pixel set.
+        """
+        if self.pixels is None:
+            return None
+        return to_numpy(self.pixels.mask)
+
+    @mask.setter
+    def mask(self, mask):
+        if mask is None:
+            self.pixels = None
+        else:
+            self.pixels = nstep.PixelSet.from_mask(mask)
+
+    def triangulation_coeffs(self, uc, vc):
+        """
+        Coefficients of the triangulation solution for given camera coordinates.
+        The camera rows of the triangulation system depend only on uc, vc and the projector row is linear in up,
+        hence each coordinate is a rational function of up:
+            x = (a_x + b_x * up) / (c + d * up)
+            y = (a_y + b_y * up) / (c + d * up)
+            z = (a_z + b_z * up) / (c + d * up)
+        The homogeneous solution [x, y, z, 1] is the null vector of the 3x4 system [m0; m1; q0 + up * q1],
+        computed by cofactor expansion sharing the 2x2 minors of the two camera rows.
+
+        Parameters
+        ----------
+        uc : np.ndarray/cp.ndarray.
+             u_c camera coordinate (any shape).
+        vc : np.ndarray/cp.ndarray.
+             v_c camera coordinate (same shape as uc).
+        Returns
+        -------
+        coeffs: np.ndarray/cp.ndarray.
+                Coefficients stacked as (a_x, a_y, a_z, c, b_x, b_y, b_z, d) along the first axis.
+        """
+        xp = self.backend.xp
+        m0 = [self.cam_h_mtx[0, i] - uc * self.cam_h_mtx[2, i] for i in range(4)]
+        m1 = [self.cam_h_mtx[1, i] - vc * self.cam_h_mtx[2, i] for i in range(4)]
+        minor = {(j, k): m0[j] * m1[k] - m0[k] * m1[j] for j in range(4) for k in range(j + 1, 4)}
+        
+        def null_vector(q):
+            return [minor[(1, 2)] * q[3] - minor[(1, 3)] * q[2] + minor[(2, 3)] * q[1],
+                    -(minor[(0, 2)] * q[3] - minor[(0, 3)] * q[2] + minor[(2, 3)] * q[0]),
+                    minor[(0, 1)] * q[3] - minor[(0, 3)] * q[1] + minor[(1, 3)] * q[0],
+                    -(minor[(0, 1)] * q[2] - minor[(0, 2)] * q[1] + minor[(1, 2)] * q[0])]
+        coeffs = xp.stack(null_vector(self.proj_h_mtx[0]) + null_vector(-self.proj_h_mtx[2]))
+        return coeffs
+
+    @staticmethod
+    def coeff_coords(coeffs, up):
+        """
+        Evaluate triangulation coefficients from triangulation_coeffs at projector coordinate up.
+        Returns
+        -------
+        coords: np.ndarray/cp.ndarray.
+                n x 3 array of x, y, z coordinates.
+        """
+        denominator = coeffs[3] + coeffs[7] * up
+        x = (coeffs[0] + coeffs[4] * up) / denominator
+        y = (coeffs[1] + coeffs[5] * up) / denominator
+        z = (coeffs[2] + coeffs[6] * up) / denominator
+        return nstep._array_module(x).stack((x, y, z), axis=-1)
+
+    def triangulation_lut(self):
+        """
+        Per pixel triangulation coefficient table (8 x cam_height x cam_width) for the camera grid.
+        The table only depends on the calibration and is cached on disk as
+        {type_unwrap}_triangulation_lut.npz in calib_path together with the h matrices it was built from.
+        It is rebuilt whenever the stored h matrices do not match the loaded calibration.
+        """
+        if self.tri_lut is not None:
+            return self.tri_lut
+        cam_h_mtx = self.backend.asnumpy(self.cam_h_mtx)
+        proj_h_mtx = self.backend.asnumpy(self.proj_h_mtx)
+        lut_path = os.path.join(self.calib_path, '{}_triangulation_lut.npz'.format(self.type_unwrap))
+        lut = None
+        if os.path.exists(lut_path):
+            lut_file = np.load(lut_path)
+            if (np.array_equal(lut_file['cam_h_mtx'], cam_h_mtx) and np.array_equal(lut_file['proj_h_mtx'], proj_h_mtx) 
+                and lut_file['lut'].shape == (8, self.cam_height, self.cam_width)):
+                lut = lut_file['lut']
+        if lut is None:
+            uc_grid, vc_grid = np.meshgrid(np.arange(0, self.cam_width, dtype=np.float64), 
+                                           np.arange(0, self.cam_height, dtype=np.float64))
+            lut = self.backend.asnumpy(self.triangulation_coeffs(self.backend.asarray(uc_grid), 
+                                                                 self.backend.asarray(vc_grid)))
+            if os.path.exists(self.calib_path):
+                np.savez(lut_path, cam_h_mtx=cam_h_mtx, proj_h_mtx=proj_h_mtx, lut=lut)
+        self.tri_lut = self.backend.asarray(lut)
+        return self.tri_lut
+
     def triangulation(self, uc, vc, up):
         """
         Used for triangulation given camera coordinates uc vc and projector coordinates up, as well as two 'h' matrices
@@ -158,376 +235,237 @@ class Reconstruction:
         Returns
         -------
         coords:
-            x = coords[:,0,0]
-            y = coords[:,1,0]
-            z = coords[:,2,0]
-    
+            n x 3 numpy array of x, y, z coordinates.
         """
-        n_pixels = len(uc)
-        if self.processing == 'gpu':
-            A = cp.empty((n_pixels, 3, 3))
-            c = cp.empty((n_pixels, 3, 1))
-        else:
-            A = np.empty((n_pixels, 3, 3))
-            c = np.empty((n_pixels, 3, 1))
-        
-        A[:, 0, 0] = self.cam_h_mtx[0, 0] - uc * self.cam_h_mtx[2, 0]
-        A[:, 0, 1] = self.cam_h_mtx[0, 1] - uc * self.cam_h_mtx[2, 1]
-        A[:, 0, 2] = self.cam_h_mtx[0, 2] - uc * self.cam_h_mtx[2, 2]
-    
-        A[:, 1, 0] = self.cam_h_mtx[1, 0] - vc * self.cam_h_mtx[2, 0]
-        A[:, 1, 1] = self.cam_h_mtx[1, 1] - vc * self.cam_h_mtx[2, 1]
-        A[:, 1, 2] = self.cam_h_mtx[1, 2] - vc * self.cam_h_mtx[2, 2]
-    
-        A[:, 2, 0] = self.proj_h_mtx[0, 0] - up * self.proj_h_mtx[2, 0]
-        A[:, 2, 1] = self.proj_h_mtx[0, 1] - up * self.proj_h_mtx[2, 1]
-        A[:, 2, 2] = self.proj_h_mtx[0, 2] - up * self.proj_h_mtx[2, 2]
-        if self.processing == 'gpu':
-            A_inv = cp.linalg.inv(A)
-        else:
-            A_inv = np.linalg.inv(A)
-        
-        c[:, 0, 0] = uc * self.cam_h_mtx[2, 3] - self.cam_h_mtx[0, 3]
-        c[:, 1, 0] = vc * self.cam_h_mtx[2, 3] - self.cam_h_mtx[1, 3]
-        c[:, 2, 0] = up * self.proj_h_mtx[2, 3] - self.proj_h_mtx[0, 3]
-        if self.processing == 'gpu':
-            coords = cp.einsum('ijk,ikl->lij', A_inv, c)[0]
-            coords = cp.asnumpy(coords)
-        else:
-            coords = np.einsum('ijk,ikl->lij', A_inv, c)[0]
-        return coords
+        coords = Reconstruction.coeff_coords(self.triangulation_coeffs(uc, vc), up)
+        return self.backend.asnumpy(coords)
     
-    def reconstruction_pts(self, uv_true, unwrap_vector):
+    def reconstruction_pts(self, uv_true, unwrap_images, sigmasq_images=None, masks=None):
         """
-        Function to reconstruct 3D point coordinates of 2D points.
+        Function to reconstruct 3D point coordinates of 2D points (e.g. circle centers) of one or many poses.
+        Points of all poses are undistorted, interpolated and triangulated in one vectorized call on the
+        processing device.
+        Parameters
+        ----------
+        uv_true: np.ndarray/list.
+                 Camera coordinates of points, n x 1 x 2 array for one pose or list/array of them for each pose.
+        unwrap_images: np.ndarray/list.
+                       Unwrapped phase map image for one pose or list/stack of images for each pose.
+        sigmasq_images: np.ndarray/list.
+                        Phase variance images, same layout as unwrap_images. If None sigma is not computed.
+        masks: np.ndarray/list.
+               Masks of valid phase, same layout as unwrap_images. Points with a neighbour outside the mask are nan.
+        Returns
+        -------
+        coords: np.ndarray.
+                n x 3 (one pose) or no. of poses x n x 3 array of x, y, z coordinates.
+        cordi_sigma: np.ndarray.
+                     Standard deviation of x, y, z coordinates, same shape as coords. None if sigmasq_images is None.
         """
-        no_pts = uv_true.shape[0]
-        unwrap_image = nstep.recover_image(unwrap_vector, self.mask, self.cam_height, self.cam_width)
-        if self.processing == "gpu":
-            c_mtx = cp.asnumpy(self.cam_mtx)
-            c_dist = cp.asnumpy(self.cam_dist)
-        uv = cv2.undistortPoints(uv_true, c_mtx, c_dist, None, c_mtx)
-        uv = uv.reshape(uv.shape[0], 2)
-        uv_true = uv_true.reshape(no_pts, 2)
-        #  Extract x and y coordinate of each point as uc, vc
-        uc = uv[:, 0]
-        vc = uv[:, 1]
+        single = isinstance(unwrap_images, np.ndarray) and unwrap_images.ndim == 2
+        if single:
+            uv_true = [uv_true]
+            unwrap_images = [unwrap_images]
+            sigmasq_images = [sigmasq_images] if sigmasq_images is not None else None
+            masks = [masks] if masks is not None else None
+        uv_true = np.asarray(uv_true, dtype=np.float64).reshape(len(unwrap_images), -1, 2)
+        no_poses, no_pts = uv_true.shape[:2]
+        c_mtx = self.backend.asnumpy(self.cam_mtx)
+        c_dist = self.backend.asnumpy(self.cam_dist)
+        uv = cv2.undistortPoints(uv_true.reshape(-1, 1, 2), c_mtx, c_dist, None, c_mtx).reshape(-1, 2)
         # Determinate 'up' from circle center
-        up = (nstep.bilinear_interpolate(unwrap_image, uv_true[:, 0], uv_true[:, 1]) - self.phase_st) * self.pitch_list[-1] / (2*np.pi)
-        if self.processing == 'gpu':
-            uc = cp.asarray(uv[:, 0])
-            vc = cp.asarray(uv[:, 1])
-            up = cp.asarray(up)
-        coordintes = self.triangulation(uc, vc, up) #return is numpy
-        return coordintes
+        phase, sigmasq_phi = nstep.bilinear_interpolate_stack(unwrap_images, uv_true[..., 0], uv_true[..., 1],
+                                                              sigmasq_images, masks)
+        up = (phase.ravel() - self.phase_st) * self.pitch_list[-1] / (2*np.pi)
+        #  Extract x and y coordinate of each point as uc, vc
+        uc = self.backend.asarray(uv[:, 0])
+        vc = self.backend.asarray(uv[:, 1])
+        up = self.backend.asarray(up)
+        coordintes = self.triangulation(uc, vc, up).reshape(no_poses, no_pts, 3) #return is numpy
+        if sigmasq_phi is not None:
+            sigmasq_phi = self.backend.asarray(sigmasq_phi.ravel())
+            sigmasq_x, sigmasq_y, sigmasq_z, _, _, _ = self.sigma_random(sigmasq_phi, uc, vc, up, derivative=False)
+            cordi_sigma = np.sqrt(np.stack((sigmasq_x, sigmasq_y, sigmasq_z), axis=-1)).reshape(no_poses, no_pts, 3)
+        else:
+            cordi_sigma = None
+        if single:
+            return coordintes[0], cordi_sigma[0] if cordi_sigma is not None else None
+        return coordintes, cordi_sigma
    
     def reconstruction_obj(self,
                            unwrap_vector, sigma_sq_phi):
         """
         Sub function to reconstruct object from phase map
         """
-        if self.processing == 'cpu':
-            unwrap_image = nstep.recover_image(unwrap_vector, self.mask, self.cam_height, self.cam_width)
+        with span('undistort'):
+            unwrap_image = self.pixels.scatter(unwrap_vector)
             unwrap_dist, unwrap_var = nstep.undistort(unwrap_image, self.cam_mtx, self.cam_dist, 
                                                       sigmasq_image=sigma_sq_phi)
-            self.mask = ~np.isnan(unwrap_dist)
-            u = np.arange(0, self.cam_width)
-            v = np.arange(0, self.cam_height)
-            uc_grid, vc_grid = np.meshgrid(u, v)
-            # cordinates = np.stack((vc_grid.ravel(),uc_grid.ravel()),axis=1).astype("float64")
-            # uv = cv2.undistortPoints(cordinates, self.cam_mtx, self.cam_dist, None, self.cam_mtx).reshape((self.cam_width*self.cam_height,2))
-            # uc = uv[:,1]
-            # vc = uv[:,0]
-            # uc = uc.reshape(self.cam_height, self.cam_width)[self.mask]
-            # vc = vc.reshape(self.cam_height, self.cam_width)[self.mask]
-            uc = uc_grid[self.mask]
-            vc = vc_grid[self.mask]
-            up = (unwrap_dist - self.phase_st) * self.pitch_list[-1] / (2 * np.pi)
-            up = up[self.mask]
-        else:
-            unwrap_image = nstep_cp.recover_image_cp(unwrap_vector, self.mask, self.cam_height, self.cam_width)
-            
-            unwrap_dist, unwrap_var = nstep_cp.undistort_cp(unwrap_image, self.cam_mtx, self.cam_dist,
-                                                sigmasq_image=sigma_sq_phi)
-            self.mask = ~cp.isnan(unwrap_dist)
-            u = cp.arange(0,self.cam_width)
-            v = cp.arange(0, self.cam_height)
-            uc_grid, vc_grid = cp.meshgrid(u, v)
-            # uc = self.uc_img[self.mask]
-            # vc = self.vc_img[self.mask]
-            uc = uc_grid[self.mask]
-            vc = vc_grid[self.mask]
-            up = (unwrap_dist - self.phase_st) * self.pitch_list[-1] / (2 * cp.pi)
-            up = up[self.mask]
-            self.mask = cp.asnumpy(self.mask)
+            self.pixels = nstep.PixelSet.from_mask(~self.backend.xp.isnan(unwrap_dist))
+        with span('triangulation'):
+            # camera coordinates of valid pixels directly from their flat indices
+            uc = self.pixels.cols.astype(np.float64)
+            vc = self.pixels.rows.astype(np.float64)
+            up = (self.pixels.gather(unwrap_dist) - self.phase_st) * self.pitch_list[-1] / (2 * np.pi)
+            coords = self.backend.asnumpy(Reconstruction.coeff_coords(self.pixels.gather(self.triangulation_lut()), up))
         
-        coords = self.triangulation(uc, vc, up) #return is numpy
         return coords, uc, vc, up, unwrap_var
 
-    @staticmethod
-    def diff_funs_x(hc_11, hc_13, hc_22, hc_23, hc_33, hp_11, hp_12, hp_13,
-                    hp_14, hp_31, hp_32, hp_33, hp_34, det, x_num, uc, vc, up):
+    def coords_jacobian(self, uc, vc, up, prob_up=False):
         """
-        Sub function used to calculate x coordinate variance.
+        Partial derivatives of x, y, z coordinates w.r.t. up and the calibration parameters
+        (up, hc_11, hc_13, hc_22, hc_23, hc_33, hp_11, hp_12, hp_13, hp_14, hp_31, hp_32, hp_33, hp_34).
+        With a = hc_13 - uc*hc_33, b = hc_23 - vc*hc_33, A = hp_11 - up*hp_31, B = hp_12 - up*hp_32, C = hp_13 - up*hp_33, D = hp_14 - up*hp_34
+        the coordinates are x = hc_22*a*D/det, y = hc_11*b*D/det, z = -hc_11*hc_22*D/det with det = hc_22*(hc_11*C - a*A) - hc_11*b*B,
+        so each derivative is (d_num - coordinate * d_det)/det computed from these shared factors.
         Ref: S.Zhong, High-Speed 3D Imaging with Digital Fringe Projection Techniques, CRC Press, 2016.
         Chapter 7 :Digital Fringe Projection System Calibration, section:7.3.6
-    
-        """
-        df_dup = (det * (-hc_13 * hc_22 * hp_34 + uc * hc_22 * hc_33 * hp_34) - 
-                  x_num * (-hc_11 * hc_22 * hp_33 + hc_13 * hc_22 * hp_31 - 
-                           uc * hc_22 * hc_33 * hp_31 + 
-                           hc_11 * hc_23 * hp_32 - vc * hc_11 * hc_33 * hp_32))/det**2
-        df_dhc_11 = (- x_num * (hc_22 * hp_13 - up * hc_22 * hp_33 - 
-                                hc_23 * hp_12 + up * hc_23 * hp_32 + 
-                                vc * hc_33 * hp_12 - 
-                                vc * up * hc_33 * hp_32))/det**2
-        df_dhc_13 = (det * (-up * hc_22 * hp_34 + hc_22 * hp_14) - 
-                     x_num * (-hc_22 * hp_11 + up * hc_22 * hp_31))/det**2
-        df_dhc_22 = (det * (-up * hc_13 * hp_34 + hc_13 * hp_14 + uc * up * hc_33 * hp_34 - uc * hc_33 * hp_14) - 
-                     x_num * (hc_11 * hp_13 - 
-                              up * hc_11 * hp_33 - 
-                              hc_13 * hp_11 +
-                              up * hc_13 * hp_31 + 
-                              uc * hc_33 * hp_11 - 
-                              uc * up * hc_33 * hp_31))/det**2
-        df_dhc_23 = (- x_num * (-hc_11 * hp_12 + up * hc_11 * hp_32))/det**2
-        df_dhc_33 = (det * (uc* up * hc_22 * hp_34 - uc * hc_22 * hp_14) - 
-                     x_num * (uc * hc_22 * hp_11 - 
-                              uc* up * hc_22 * hp_31 + 
-                              vc * hc_11 * hp_12 - 
-                              vc * up * hc_11 * hp_32)) / det**2
-        df_dhp_11 = (- x_num *(-hc_13 * hc_22 + uc * hc_22 * hc_33))/det**2
-        df_dhp_12 = (- x_num * (-hc_11 * hc_23 + vc * hc_11 * hc_33))/det**2
-        df_dhp_13 = (- x_num * (hc_11 * hc_22))/det**2
-        df_dhp_14 = (det * (hc_13 * hc_22 - uc * hc_22 * hc_33))/det**2
-        df_dhp_31 = (- x_num * (up * hc_22 * hc_13 - uc * up * hc_22 * hc_33))/det**2
-        df_dhp_32 = (- x_num * (up * hc_11 * hc_23 - vc * up * hc_11 * hc_33))/det**2
-        df_dhp_33 = (- x_num * (-up * hc_11 * hc_22))/det**2
-        df_dhp_34 = (det * (-up * hc_13 * hc_22 + uc * up * hc_22 * hc_33))/det**2
-        
-        return df_dup, df_dhc_11, df_dhc_13, df_dhc_22, df_dhc_23, df_dhc_33, df_dhp_11, df_dhp_12, df_dhp_13, df_dhp_14, df_dhp_31, df_dhp_32, df_dhp_33, df_dhp_34
-
-    @staticmethod
-    def diff_funs_y(hc_11, hc_13, hc_22, hc_23, hc_33, hp_11, hp_12, hp_13,
-                    hp_14, hp_31, hp_32, hp_33, hp_34, det, y_num, uc, vc, up):
-        """
-        Subfunction used to calculate y cordinate variance
-    
-        """
-        df_dup = (det * (-hc_11 * hc_23 * hp_34 + vc * hc_11 * hc_33 * hp_34) - 
-                  y_num * (-hc_11 * hc_22 * hp_33 + 
-                           hc_13 * hc_22 * hp_31 - 
-                           uc * hc_22 * hc_33 * hp_31 + 
-                           hc_11 * hc_23 * hp_32 - 
-                           vc * hc_11 * hc_33 * hp_32))/det**2
-        df_dhc_11 = (det * (-up * hc_23 * hp_34 + hc_23 * hp_14 + vc * up * hc_33 * hp_34 - vc * hc_33 * hp_14) -
-                     y_num * (hc_22 * hp_13 - 
-                              up * hc_22 * hp_33 - 
-                              hc_23 * hp_12 + 
-                              up * hc_23 * hp_32 + 
-                              vc * hc_33 * hp_12 - 
-                              vc * up * hc_33 * hp_32))/det**2
-        df_dhc_13 = (- y_num * (-hc_22 * hp_11 + up * hc_22 * hp_31))/det**2
-        df_dhc_22 = (- y_num * (hc_11 * hp_13 - 
-                                up * hc_11 * hp_33 - 
-                                hc_13 * hp_11 + 
-                                up * hc_13 * hp_31 + 
-                                uc * hc_33 * hp_11 - 
-                                uc * up * hc_33 * hp_31))/det**2
-        df_dhc_23 = (det * (-up * hc_11 * hp_34 + hc_11 * hp_14) - y_num * (-hc_11 * hp_12 + up * hc_11 * hp_32))/det**2
-        df_dhc_33 = (det * (vc* up * hc_11 * hp_34 - vc * hc_11 * hp_14) - 
-                     y_num * (uc * hc_22 * hp_11 - 
-                              uc * up * hc_22 * hp_31 + 
-                              vc * hc_11 * hp_12 - 
-                              vc * up * hc_11 * hp_32)) / det**2
-        df_dhp_11 = (- y_num * (-hc_13 * hc_22 + uc * hc_22 * hc_33))/det**2
-        df_dhp_12 = (- y_num * (-hc_11 * hc_23 + vc * hc_11 * hc_33))/det**2
-        df_dhp_13 = (- y_num * (hc_11 * hc_22))/det**2
-        df_dhp_14 = (det * (hc_11 * hc_23 - vc * hc_11 * hc_33))/det**2
-        df_dhp_31 = (- y_num * (up * hc_13 * hc_22 - uc * up * hc_22 * hc_33))/det**2
-        df_dhp_32 = (- y_num * (up * hc_11 * hc_23 - vc * up * hc_11 * hc_33))/det**2
-        df_dhp_33 = (- y_num * (-up * hc_11 * hc_22))/det**2
-        df_dhp_34 = (det * (-up * hc_11 * hc_23 + vc * up * hc_11 * hc_33))/det**2
-        
-        return df_dup, df_dhc_11, df_dhc_13, df_dhc_22, df_dhc_23, df_dhc_33, df_dhp_11, df_dhp_12, df_dhp_13, df_dhp_14, df_dhp_31, df_dhp_32, df_dhp_33, df_dhp_34
-
-    @staticmethod
-    def diff_funs_z(hc_11, hc_13, hc_22, hc_23, hc_33, hp_11, hp_12, hp_13,
-                    hp_14, hp_31, hp_32, hp_33, hp_34, det, z_num, uc, vc, up):
-        """
-        Sub function used to calculate z coordinate variance
-    
-        """
-        df_dup = (det * (hc_11 * hc_22 * hp_34) - 
-                  z_num * (-hc_11 * hc_22 * hp_33 + 
-                           hc_22 * hc_13 * hp_31 - 
-                           uc * hc_22 * hc_33 * hp_31 + 
-                           hc_11 * hc_23 * hp_32 - 
-                           vc * hc_11 * hc_33 * hp_32))/det**2
-        df_dhc_11 = (det * (up * hc_22 * hp_34 - hc_22 * hp_14) - 
-                     z_num * (hc_22 * hp_13 - 
-                              up * hc_22 * hp_33 - 
-                              hc_23 * hp_12 + 
-                              up * hc_23 * hp_32 + 
-                              vc * hc_33 * hp_12 - vc * up * hc_33 * hp_32))/det**2
-        df_dhc_13 = (- z_num * (-hc_22 * hp_11 + up * hc_22 * hp_31))/det**2
-        df_dhc_22 = (det * (up * hc_11 * hp_34 - hc_11 * hp_14) - 
-                     z_num * (hc_11 * hp_13 - 
-                              up * hc_11 * hp_33 - 
-                              hc_13 * hp_11 + 
-                              up * hc_13 * hp_31 +
-                              uc * hc_33 * hp_11 - 
-                              uc * up * hc_33 * hp_31))/det**2
-        df_dhc_23 = (- z_num * (-hc_11 * hp_12 + up * hc_11 * hp_32))/det**2
-        df_dhc_33 = (- z_num * (uc * hc_22 * hp_11 - 
-                                uc * up * hc_22 * hp_31 + 
-                                vc * hc_11 * hp_12 - 
-                                vc * up * hc_11 * hp_32))/det**2
-        df_dhp_11 = (- z_num * (-hc_13 * hc_22 + uc * hc_22 * hc_33))/det**2
-        df_dhp_12 = (- z_num * (-hc_11 * hc_23 + vc * hc_11 * hc_33))/det**2
-        df_dhp_13 = (- z_num * (hc_11 * hc_22))/det**2
-        df_dhp_14 = (det * (-hc_11 * hc_22))/det**2
-        df_dhp_31 = (- z_num * (up * hc_22 * hc_13 - uc * up * hc_22 * hc_33))/det**2
-        df_dhp_32 = (- z_num * (up * hc_11 * hc_23 - vc * up * hc_11 * hc_33))/det**2
-        df_dhp_33 = (- z_num * (-up * hc_11 * hc_22))/det**2
-        df_dhp_34 = (det * (up * hc_11 * hc_22))/det**2
-        
-        return df_dup, df_dhc_11, df_dhc_13, df_dhc_22, df_dhc_23, df_dhc_33, df_dhp_11, df_dhp_12, df_dhp_13, df_dhp_14, df_dhp_31, df_dhp_32, df_dhp_33, df_dhp_34
-
-    def sigma_random(self, sigma_sq_phi, uc, vc, up):
-        """
-        Function to calculate variance of x,y,z coordinates
+        Parameters
+        ----------
+        uc: np.ndarray/cp.ndarray.
+            Camera x coordinate of pixels.
+        vc: np.ndarray/cp.ndarray.
+            Camera y coordinate of pixels.
+        up: np.ndarray/cp.ndarray.
+            Projector coordinate of pixels.
+        prob_up: bool.
+                 If true only derivatives w.r.t. up are computed.
+        Returns
+        -------
+        jacobian: np.ndarray/cp.ndarray.
+                  3 x 14 x N array of derivatives, 3 x N array of derivatives w.r.t. up if prob_up is true.
         """
-        
-        sigma_sq_up = sigma_sq_phi * self.pitch_list[-1]**2 / (4 * np.pi**2)
-        
+        xp = self.backend.xp
         hc_11 = self.cam_h_mtx[0, 0]
-        sigmasq_hc_11 = self.cam_h_mtx_std[0, 0]**2
         hc_13 = self.cam_h_mtx[0, 2]
-        sigmasq_hc_13 = self.cam_h_mtx_std[0, 2]**2
-        
         hc_22 = self.cam_h_mtx[1, 1]
-        sigmasq_hc_22 = self.cam_h_mtx_std[1, 1]**2
         hc_23 = self.cam_h_mtx[1, 2]
-        sigmasq_hc_23 = self.cam_h_mtx_std[1, 2]**2
-        
         hc_33 = self.cam_h_mtx[2, 2]
-        sigmasq_hc_33 = self.cam_h_mtx_std[2, 2]**2
-        
         hp_11 = self.proj_h_mtx[0, 0]
-        sigmasq_hp_11 = self.proj_h_mtx_std[0, 0]**2
         hp_12 = self.proj_h_mtx[0, 1]
-        sigmasq_hp_12 = self.proj_h_mtx_std[0, 1]**2
         hp_13 = self.proj_h_mtx[0, 2]
-        sigmasq_hp_13 = self.proj_h_mtx_std[0, 2]**2
         hp_14 = self.proj_h_mtx[0, 3]
-        sigmasq_hp_14 = self.proj_h_mtx_std[0, 3]**2
-        
         hp_31 = self.proj_h_mtx[2, 0]
-        sigmasq_hp_31 = self.proj_h_mtx_std[2, 0]**2
         hp_32 = self.proj_h_mtx[2, 1]
-        sigmasq_hp_32 = self.proj_h_mtx_std[2, 1]**2
         hp_33 = self.proj_h_mtx[2, 2]
-        sigmasq_hp_33 = self.proj_h_mtx_std[2, 2]**2
         hp_34 = self.proj_h_mtx[2, 3]
-        sigmasq_hp_34 = self.proj_h_mtx_std[2, 3]**2
-        
-        det = (hc_11 * hc_22 * hp_13 - 
-               up * hc_11 * hc_22 * hp_33 - 
-               hc_13 * hc_22 * hp_11 + 
-               up * hc_13 *hc_22 * hp_31 + 
-               uc * hc_22 * hc_33 * hp_11 - 
-               uc * up * hc_22 * hc_33 * hp_31 - 
-               hc_11 * hc_23 * hp_12 + 
-               up * hc_11 * hc_23 * hp_32 + 
-               vc * hc_11 * hc_33 * hp_12 - 
-               vc * up * hc_11 * hc_33 * hp_32)
-               
-        
-        x_num = (-up * hc_13 * hc_22 * hp_34 + 
-                 hc_13 * hc_22 * hp_14 + 
-                 uc * up * hc_22 * hc_33 * hp_34 - 
-                 uc * hc_22 * hc_33 * hp_14)
-        df_dup_x, df_dhc_11_x, df_dhc_13_x, df_dhc_22_x, df_dhc_23_x, df_dhc_33_x, df_dhp_11_x, df_dhp_12_x, df_dhp_13_x, df_dhp_14_x, df_dhp_31_x, df_dhp_32_x, df_dhp_33_x, df_dhp_34_x = Reconstruction.diff_funs_x(hc_11, hc_13, hc_22, hc_23, hc_33, hp_11, hp_12, hp_13, hp_14, hp_31, hp_32, hp_33, hp_34, det, x_num, uc, vc, up)
-        
-        
-        y_num = (-up * hc_11 * hc_23 * hp_34 + 
-                 hc_11 * hc_23 * hp_14 + 
-                 vc * up * hc_11 * hc_33 * hp_34 - 
-                 vc * hc_11 * hc_33 * hp_14)
-        #y_num = (-hc_11 * (hc_23 - hc_33)*(up * hp_34 - hp_14))
-        df_dup_y, df_dhc_11_y, df_dhc_13_y, df_dhc_22_y, df_dhc_23_y, df_dhc_33_y, df_dhp_11_y, df_dhp_12_y, df_dhp_13_y, df_dhp_14_y, df_dhp_31_y, df_dhp_32_y, df_dhp_33_y, df_dhp_34_y = Reconstruction.diff_funs_y(hc_11, hc_13, hc_22, hc_23, hc_33, hp_11, hp_12, hp_13, hp_14, hp_31, hp_32, hp_33, hp_34, det, y_num, uc, vc, up)
-        
-        z_num = up * hc_11 * hc_22 * hp_34 - hc_11 * hc_22 * hp_14 
-        df_dup_z, df_dhc_11_z, df_dhc_13_z, df_dhc_22_z, df_dhc_23_z, df_dhc_33_z, df_dhp_11_z, df_dhp_12_z, df_dhp_13_z, df_dhp_14_z, df_dhp_31_z, df_dhp_32_z, df_dhp_33_z, df_dhp_34_z = Reconstruction.diff_funs_z(hc_11, hc_13, hc_22, hc_23, hc_33, hp_11, hp_12, hp_13, hp_14, hp_31, hp_32, hp_33, hp_34, det, z_num, uc, vc, up)
-        if self.prob_up:
-            sigmasq_x = (df_dup_x**2 * sigma_sq_up)
-            sigmasq_y = (df_dup_y**2 * sigma_sq_up)
-            sigmasq_z = df_dup_z**2 * sigma_sq_up
-            derv_x = df_dup_x
-            derv_y = df_dup_y
-            derv_z = df_dup_z
+        a = hc_13 - uc * hc_33
+        b = hc_23 - vc * hc_33
+        A = hp_11 - up * hp_31
+        B = hp_12 - up * hp_32
+        C = hp_13 - up * hp_33
+        D = hp_14 - up * hp_34
+        hc_22a = hc_22 * a
+        hc_11b = hc_11 * b
+        hc_11_22 = hc_11 * hc_22
+        inv_det = 1 / (hc_22 * (hc_11 * C - a * A) - hc_11b * B)
+        coords = (hc_22a * D * inv_det, hc_11b * D * inv_det, -hc_11_22 * D * inv_det)
+        ddet_dup = hc_22a * hp_31 - hc_11_22 * hp_33 + hc_11b * hp_32
+        dnum_dup = (-hc_22a * hp_34, -hc_11b * hp_34, hc_11_22 * hp_34)
+        if prob_up:
+            jacobian = xp.empty((3, len(up)))
+            for i in range(3):
+                jacobian[i] = (dnum_dup[i] - coords[i] * ddet_dup) * inv_det
+            return jacobian
+        # derivatives of det and numerators (x, y, z), 0 where the parameter does not appear
+        ddet = [ddet_dup, hc_22 * C - b * B, -hc_22 * A, hc_11 * C - a * A, -hc_11 * B, uc * hc_22 * A + vc * hc_11 * B,
+                -hc_22a, -hc_11b, hc_11_22, 0, up * hc_22a, up * hc_11b, -up * hc_11_22, 0]
+        dnum = [dnum_dup,
+                (0, b * D, -hc_22 * D),
+                (hc_22 * D, 0, 0),
+                (a * D, 0, -hc_11 * D),
+                (0, hc_11 * D, 0),
+                (-uc * hc_22 * D, -vc * hc_11 * D, 0),
+                (0, 0, 0), (0, 0, 0), (0, 0, 0),
+                (hc_22a, hc_11b, -hc_11_22),
+                (0, 0, 0), (0, 0, 0), (0, 0, 0),
+                (-up * hc_22a, -up * hc_11b, up * hc_11_22)]
+        jacobian = xp.empty((3, 14, len(up)))
+        for j in range(14):
+            for i in range(3):
+                jacobian[i, j] = (dnum[j][i] - coords[i] * ddet[j]) * inv_det
+        return jacobian
+
+    def sigma_random(self, sigma_sq_phi, uc, vc, up, derivative=True, dtype=np.float64, chunk_size=None):
+        """
+        Function to calculate variance of x,y,z coordinates.
+        Parameters
+        ----------
+        sigma_sq_phi: np.ndarray/cp.ndarray.
+                      Phase variance of pixels.
+        uc: np.ndarray/cp.ndarray.
+            Camera x coordinate of pixels.
+        vc: np.ndarray/cp.ndarray.
+            Camera y coordinate of pixels.
+        up: np.ndarray/cp.ndarray.
+            Projector coordinate of pixels.
+        derivative: bool.
+                    If false the derivatives are not returned (None) and not kept in memory.
+        dtype: np.dtype.
+               Type of returned arrays, computation is always in float64.
+        chunk_size: int.
+                    Number of pixels processed at a time. Default 2**14, reduced to fit max_memory if given.
+        Returns
+        -------
+        sigmasq_x, sigmasq_y, sigmasq_z: np.ndarray.
+                                         Variance of x, y, z coordinates.
+        derv_x, derv_y, derv_z: np.ndarray.
+                                Derivatives of x, y, z coordinates, N array w.r.t. up if prob_up else 14 x N array.
+        """
+        xp = self.backend.xp
+        n_pixels = len(up)
+        n_param = 1 if self.prob_up else 14
+        if chunk_size is None:
+            # chunks of temporaries fitting in cache
+            chunk_size = 2**14
+            if self.max_memory is not None:
+                chunk_size = max(1, min(chunk_size, self.max_memory // (2 * 3 * n_param * 8)))
+        sigma_sq_up = sigma_sq_phi * self.pitch_list[-1]**2 / (4 * np.pi**2)
+        # variance of calibration parameters in the order of coords_jacobian
+        param_var = xp.stack([self.cam_h_mtx_std[0, 0], self.cam_h_mtx_std[0, 2], self.cam_h_mtx_std[1, 1],
+                              self.cam_h_mtx_std[1, 2], self.cam_h_mtx_std[2, 2],
+                              self.proj_h_mtx_std[0, 0], self.proj_h_mtx_std[0, 1], self.proj_h_mtx_std[0, 2], 
+                              self.proj_h_mtx_std[0, 3], self.proj_h_mtx_std[2, 0], self.proj_h_mtx_std[2, 1],
+                              self.proj_h_mtx_std[2, 2], self.proj_h_mtx_std[2, 3]])**2
+        sigmasq = xp.empty((3, n_pixels), dtype=dtype)
+        if derivative:
+            derv = xp.empty((3, n_pixels) if self.prob_up else (3, 14, n_pixels), dtype=dtype)
         else:
-            sigmasq_x = ((df_dup_x**2 * sigma_sq_up) + (df_dhc_11_x**2 * sigmasq_hc_11) + 
-                         (df_dhc_13_x**2 * sigmasq_hc_13) + (df_dhc_22_x**2 * sigmasq_hc_22) + 
-                         (df_dhc_23_x**2 * sigmasq_hc_23) + (df_dhc_33_x**2 * sigmasq_hc_33) +
-                         (df_dhp_11_x**2 * sigmasq_hp_11) + (df_dhp_12_x**2 * sigmasq_hp_12) + 
-                         (df_dhp_13_x**2 * sigmasq_hp_13) + (df_dhp_14_x**2 * sigmasq_hp_14) + 
-                         (df_dhp_31_x**2 * sigmasq_hp_31) + (df_dhp_32_x**2 * sigmasq_hp_32) + 
-                         (df_dhp_33_x**2 * sigmasq_hp_33) + (df_dhp_34_x**2 * sigmasq_hp_34))
-            sigmasq_y = ((df_dup_y**2 * sigma_sq_up) + (df_dhc_11_y**2 * sigmasq_hc_11) + 
-                         (df_dhc_13_y**2 * sigmasq_hc_13) + (df_dhc_22_y**2 * sigmasq_hc_22) + 
-                         (df_dhc_23_y**2 * sigmasq_hc_23) + (df_dhc_33_y**2 * sigmasq_hc_33) +
-                         (df_dhp_11_y**2 * sigmasq_hp_11) + (df_dhp_12_y**2 * sigmasq_hp_12) + 
-                         (df_dhp_13_y**2 * sigmasq_hp_13) + (df_dhp_14_y**2 * sigmasq_hp_14) + 
-                         (df_dhp_31_y**2 * sigmasq_hp_31) + (df_dhp_32_y**2 * sigmasq_hp_32) + 
-                         (df_dhp_33_y**2 * sigmasq_hp_33) + (df_dhp_34_y**2 * sigmasq_hp_34))
-            sigmasq_z = ((df_dup_z**2 * sigma_sq_up) + (df_dhc_11_z**2 * sigmasq_hc_11) + 
-                         (df_dhc_13_z**2 * sigmasq_hc_13) + (df_dhc_22_z**2 * sigmasq_hc_22) + 
-                         (df_dhc_23_z**2 * sigmasq_hc_23) + (df_dhc_33_z**2 * sigmasq_hc_33) +
-                         (df_dhp_11_z**2 * sigmasq_hp_11) + (df_dhp_12_z**2 * sigmasq_hp_12) + 
-                         (df_dhp_13_z**2 * sigmasq_hp_13) + (df_dhp_14_z**2 * sigmasq_hp_14) + 
-                         (df_dhp_31_z**2 * sigmasq_hp_31) + (df_dhp_32_z**2 * sigmasq_hp_32) + 
-                         (df_dhp_33_z**2 * sigmasq_hp_33) + (df_dhp_34_z**2 * sigmasq_hp_34))
-            
-            derv_x = np.stack((df_dup_x, df_dhc_11_x, df_dhc_13_x, df_dhc_22_x, df_dhc_23_x, df_dhc_33_x, df_dhp_11_x, df_dhp_12_x, df_dhp_13_x, df_dhp_14_x, df_dhp_31_x, df_dhp_32_x, df_dhp_33_x, df_dhp_34_x))
-            derv_y = np.stack((df_dup_y, df_dhc_11_y, df_dhc_13_y, df_dhc_22_y, df_dhc_23_y, df_dhc_33_y, df_dhp_11_y, df_dhp_12_y, df_dhp_13_y, df_dhp_14_y, df_dhp_31_y, df_dhp_32_y, df_dhp_33_y, df_dhp_34_y))
-            derv_z = np.stack((df_dup_z, df_dhc_11_z, df_dhc_13_z, df_dhc_22_z, df_dhc_23_z, df_dhc_33_z, df_dhp_11_z, df_dhp_12_z, df_dhp_13_z, df_dhp_14_z, df_dhp_31_z, df_dhp_32_z, df_dhp_33_z, df_dhp_34_z))
-        if self.processing == 'gpu':
-            sigmasq_x = cp.asnumpy(sigmasq_x)
-            sigmasq_y = cp.asnumpy(sigmasq_y)
-            sigmasq_z = cp.asnumpy(sigmasq_z)
-            derv_x = cp.asnumpy(derv_x)
-            derv_y = cp.asnumpy(derv_y)
-            derv_z = cp.asnumpy(derv_z)
-            
-        return sigmasq_x, sigmasq_y, sigmasq_z, derv_x, derv_y, derv_z    
-        
+            derv = None
+        for start in range(0, n_pixels, chunk_size):
+            stop = min(start + chunk_size, n_pixels)
+            jacobian = self.coords_jacobian(uc[start:stop], vc[start:stop], up[start:stop], self.prob_up)
+            if self.prob_up:
+                sigmasq[:, start:stop] = jacobian**2 * sigma_sq_up[start:stop]
+            else:
+                sigmasq[:, start:stop] = (jacobian[:, 0]**2 * sigma_sq_up[start:stop] + 
+                                          xp.einsum('ijk,j->ik', jacobian[:, 1:]**2, param_var))
+            if derivative:
+                derv[..., start:stop] = jacobian
+        sigmasq = self.backend.asnumpy(sigmasq)
+        if derivative:
+            derv = self.backend.asnumpy(derv)
+        if derivative:
+            derv_x, derv_y, derv_z = derv
+        else:
+            derv_x = derv_y = derv_z = None
+        return sigmasq[0], sigmasq[1], sigmasq[2], derv_x, derv_y, derv_z
+
     # This will be optional once instant display is setup
     def cloud_save(self):
-        
-        xyz = list(map(tuple, self.coords)) 
-        color = list(map(tuple, self.inte_rgb))
-        if self.temp:
-            temperature_vector = np.array(self.temperature_vector, dtype=[('temperature', 'f4')])
-        else:
-            temperature_vector = [None]
-        
+        """
+        Function to save point cloud with color, standard deviation, temperature and quality of each point as binary ply.
+        """
         if self.probability:
-            xyz_sigma = list(map(tuple, self.cordi_sigma))
-            xyz_quality = np.array(self.quality_vector, dtype=[('quality', 'f4')])
+            xyz_sigma = self.cordi_sigma
+            xyz_quality = self.quality_vector
         else:
-            xyz_sigma = [None]
-            xyz_quality = [None]
-            
-        PlyData(
-            [
-                PlyElement.describe(np.array(xyz, dtype=[('x', 'f4'), ('y', 'f4'), ('z', 'f4')]), 'points'),
-                PlyElement.describe(np.array(color, dtype=[('r', 'f4'), ('g', 'f4'), ('b', 'f4')]), 'color'),
-                PlyElement.describe(np.array(xyz_sigma, dtype=[('dx', 'f4'), ('dy', 'f4'), ('dz', 'f4')]), 'std'),
-                PlyElement.describe(np.array(temperature_vector, dtype=[('temperature', 'f4')]), 'temperature'),
-                PlyElement.describe(np.array(xyz_quality, dtype=[('quality', 'f4')]), 'quality'),
-            ]).write(os.path.join(self.object_path, 'obj.ply'))
+            xyz_sigma = None
+            xyz_quality = None
+        temperature_vector = self.temperature_vector if self.temp else None
+        with span('save'):
+            write_ply(os.path.join(self.object_path, 'obj.ply'), self.coords, color=self.inte_rgb, sigma=xyz_sigma,
+                      temperature=temperature_vector, quality=xyz_quality)
         print("\n Point cloud saved at %s"% (os.path.join(self.object_path, 'obj.ply')))
         return
     
@@ -566,20 +504,21 @@ class Reconstruction:
         inte_img = inte_rgb_image[self.mask] / np.nanmax(inte_rgb_image[self.mask])
         inte_rgb = np.stack((inte_img, inte_img, inte_img), axis=-1)
         if self.probability:
-            sigma_sq_low_phi_vect = sigmasq_phi_dist[self.mask]
-            sigmasq_x, sigmasq_y, sigmasq_z, derv_x, derv_y, derv_z = self.sigma_random(sigma_sq_low_phi_vect, uc, vc, up)
-            sigma_x = np.sqrt(sigmasq_x)
-            sigma_y = np.sqrt(sigmasq_y)
-            sigma_z = np.sqrt(sigmasq_z)
-            cordi_sigma = np.vstack((sigma_x, sigma_y, sigma_z)).T
-            quality_vector = quality[self.mask]
+            with span('sigma'):
+                sigma_sq_low_phi_vect = self.pixels.gather(sigmasq_phi_dist)
+                sigmasq_x, sigmasq_y, sigmasq_z, _, _, _ = self.sigma_random(sigma_sq_low_phi_vect, uc, vc, up, derivative=False)
+                sigma_x = np.sqrt(sigmasq_x)
+                sigma_y = np.sqrt(sigmasq_y)
+                sigma_z = np.sqrt(sigmasq_z)
+                cordi_sigma = np.vstack((sigma_x, sigma_y, sigma_z)).T
+                quality_vector = self.pixels.gather(quality)
         else:
             cordi_sigma = None
             quality_vector = None
             sigma_sq_low_phi_vect = None
         
         if self.temp:
-            temperature_vector = temperature_image[self.mask]
+            temperature_vector = self.pixels.gather(temperature_image)
         else:
             temperature_vector = [None]
         self.coords = coords
@@ -607,108 +546,118 @@ class Reconstruction:
                    Color (texture/ intensity) at each point.
     
         """
-        if self.data_type == 'tiff':
-            if os.path.exists(os.path.join(self.object_path, 'capt_000_000000.tiff')):
-                img_path = sorted(glob.glob(os.path.join(self.object_path, 'capt_*')), key=lambda x:int(os.path.basename(x)[-11:-5]))
-                images_arr = np.array([cv2.imread(file, 0) for file in img_path])- self.dark_bias
-                
-                
-            else:
-                print("ERROR:Data path does not exist!")
-                return
-            if self.temp:
-                if not os.path.exists(os.path.join(self.object_path, 'temperature.tiff')):
-                    print("ERROR: Temperature data path %s does not exist"% (os.path.join(self.object_path, 'temperature.tiff')))
+        with self.tracer.scan(self.object_path, backend=self.backend, type_unwrap=self.type_unwrap,
+                              N_list=list(self.N_list), pitch_list=list(self.pitch_list), probability=self.probability,
+                              tiled=self.max_memory is not None):
+            return self._obj_reconst()
+
+    def _obj_reconst(self):
+        """
+        Pipeline of obj_reconst_wrapper, stages are recorded as spans of the scan trace.
+        """
+        tiled = (self.max_memory is not None) and (self.type_unwrap == 'multifreq') and (self.backend.xp is np)
+        with span('load'):
+            if self.data_type == 'tiff':
+                if os.path.exists(os.path.join(self.object_path, 'capt_000_000000.tiff')):
+                    img_path = sorted(glob.glob(os.path.join(self.object_path, 'capt_*')), key=lambda x:int(os.path.basename(x)[-11:-5]))
+                    # tiled processing subtracts dark bias band by band
+                    loader = CaptureLoader(dtype=np.uint8) if tiled else CaptureLoader(self.dark_bias)
+                    images_arr = loader.load(img_path)
+                    loader.report()
+                    loader.close()
                 else:
-                    temperature_image = np.load(os.path.join(self.object_path, 'temperature.tiff'))
-            else:
-                temperature_image = None
-        elif self.data_type == 'npy':
-            if os.path.exists(os.path.join(self.object_path, 'capt_000_000000.npy')):
-                images_arr = np.load(os.path.join(self.object_path, 'capt_000_000000.npy')).astype(np.float64) - self.dark_bias
-                
-            else:
-                print("ERROR:Data path does not exist!")
-                images_arr = None
-            if self.temp:
-                if not os.path.exists(os.path.join(self.object_path, 'temperature.npy')):
-                    print("ERROR: Temperature data path %s does not exist"% (os.path.join(self.object_path, 'temperature.npy')))
+                    print("ERROR:Data path does not exist!")
+                    return
+                if self.temp:
+                    if not os.path.exists(os.path.join(self.object_path, 'temperature.tiff')):
+                        print("ERROR: Temperature data path %s does not exist"% (os.path.join(self.object_path, 'temperature.tiff')))
+                    else:
+                        temperature_image = np.load(os.path.join(self.object_path, 'temperature.tiff'))
+                else:
+                    temperature_image = None
+            elif (self.data_type == 'npy') or (self.data_type == 'archive'):
+                if (self.data_type == 'archive') and os.path.exists(os.path.join(self.object_path, SCAN_ARCHIVE)):
+                    # first scan of the archive, opened as memory map
+                    archive = ScanArchive(os.path.join(self.object_path, SCAN_ARCHIVE))
+                    source = archive.open(archive.poses[0])
+                elif (self.data_type == 'npy') and os.path.exists(os.path.join(self.object_path, 'capt_000_000000.npy')):
+                    source = os.path.join(self.object_path, 'capt_000_000000.npy')
                 else:
-                    temperature_image = np.load(os.path.join(self.object_path, 'temperature.npy'))
+                    source = None
+                if source is None:
+                    print("ERROR:Data path does not exist!")
+                    images_arr = None
+                elif tiled:
+                    images_arr = np.load(source, mmap_mode='r') if isinstance(source, str) else source
+                else:
+                    loader = CaptureLoader(self.dark_bias)
+                    images_arr = loader.load(source)
+                    loader.report()
+                    loader.close()
+                if self.temp:
+                    if not os.path.exists(os.path.join(self.object_path, 'temperature.npy')):
+                        print("ERROR: Temperature data path %s does not exist"% (os.path.join(self.object_path, 'temperature.npy')))
+                    else:
+                        temperature_image = np.load(os.path.join(self.object_path, 'temperature.npy'))
+                else:
+                    temperature_image = None
             else:
-                temperature_image = None
-        else:
-            print("ERROR: data type is not supported, must be '.tiff' or '.npy'.")
-            images_arr = None
-            
+                print("ERROR: data type is not supported, must be '.tiff', '.npy' or 'archive'.")
+                images_arr = None
+
         if self.type_unwrap == 'multifreq':
-            if self.processing == 'cpu':
-                modulation_vector, orig_img, phase_map, mask = nstep.phase_cal(images_arr,
-                                                                               self.limit, 
-                                                                               self.N_list,
-                                                                               False)
-                self.mask = mask
-                phase_map[0][phase_map[0] < EPSILON] = phase_map[0][phase_map[0] < EPSILON] + 2 * np.pi
-                unwrap_vector, k_arr, mask = nstep.multifreq_unwrap(self.pitch_list,
-                                                              phase_map,
-                                                              self.kernel,
-                                                              self.fringe_direc,
-                                                              self.mask,
-                                                              self.cam_width,
-                                                              self.cam_height)
-                orig_img = orig_img[-1] 
-                self.mask = mask
+            if tiled:
+                # row bands fuse phase_cal, unwrap, filt and sigma
+                with span('unwrap'):
+                    orig_img, unwrap_vector, k_arr, mask, sigmasq_phi_arr = nstep.phase_unwrap_tiled(images_arr,
+                                                                                                     self.limit,
+                                                                                                     self.N_list,
+                                                                                                     self.pitch_list,
+                                                                                                     self.kernel,
+                                                                                                     self.fringe_direc,
+                                                                                                     self.cam_width,
+                                                                                                     self.cam_height,
+                                                                                                     self.max_memory,
+                                                                                                     dark_bias=self.dark_bias,
+                                                                                                     phase_fix=EPSILON,
+                                                                                                     model=self.model if self.probability else None)
+                self.pixels = nstep.PixelSet.from_mask(mask)
                 if self.probability:
-                    cov_arr_l,_ = nstep.pred_var_fn(images_arr[-(self.N_list[-2]+self.N_list[-1]): -self.N_list[-1]], self.model)
-                    
-                    sigma_sq_phi_l = nstep.var_func(images_arr[-(self.N_list[-2]+self.N_list[-1]): -self.N_list[-1]],
-                                                  self.mask,
-                                                  self.N_list[-2],
-                                                  cov_arr_l)
-                    cov_arr_h,_ = nstep.pred_var_fn(images_arr[-self.N_list[-1]:], self.model)
-                    sigma_sq_phi = nstep.var_func(images_arr[-self.N_list[-1]:],
-                                                  self.mask,
-                                                  self.N_list[-1],
-                                                  cov_arr_h)
+                    sigma_sq_phi_l, sigma_sq_phi = sigmasq_phi_arr
                     sigma_sq_delta_phi = ((self.pitch_list[-2]/self.pitch_list[-1])**2 * sigma_sq_phi_l) + sigma_sq_phi
                     quality = np.pi/np.sqrt(sigma_sq_delta_phi)
-                    
                 else:
                     sigma_sq_phi = None
                     quality = None
-            elif self.processing == 'gpu':
-                images_arr_cp = cp.asarray(images_arr)
-                modulation_vector, orig_img, phase_map, mask = nstep_cp.phase_cal_cp(images_arr_cp,
-                                                                                     self.limit,
-                                                                                     self.N_list,
-                                                                                     False)
-                phase_map[0][phase_map[0] < EPSILON] = phase_map[0][phase_map[0] < EPSILON] + 2 * np.pi
-                self.mask = mask
-                unwrap_vector, k_arr, mask = nstep_cp.multifreq_unwrap_cp(self.pitch_list,
-                                                                    phase_map,
-                                                                    self.kernel,
-                                                                    self.fringe_direc,
-                                                                    self.mask,
-                                                                    self.cam_width,
-                                                                    self.cam_height)
-                orig_img = cp.asnumpy(orig_img[-1])
-                self.mask = mask
+            else:
+                with span('phase_cal'):
+                    images_arr = self.backend.asarray(images_arr)
+                    modulation_vector, orig_img, phase_map, mask = nstep.phase_cal(images_arr,
+                                                                                   self.limit,
+                                                                                   self.N_list,
+                                                                                   False)
+                with span('unwrap'):
+                    phase_map[0][phase_map[0] < EPSILON] = phase_map[0][phase_map[0] < EPSILON] + 2 * np.pi
+                    unwrap_vector, k_arr, self.pixels = nstep.multifreq_unwrap(self.pitch_list,
+                                                                               phase_map,
+                                                                               self.kernel,
+                                                                               self.fringe_direc,
+                                                                               nstep.PixelSet.from_mask(mask),
+                                                                               self.cam_width,
+                                                                               self.cam_height)
+                orig_img = self.backend.asnumpy(orig_img[-1])
                 if self.probability:
-                    
-                    cov_arr_l,_ = nstep_cp.pred_var_fn(images_arr_cp[-(self.N_list[-2]+self.N_list[-1]): -self.N_list[-1]], self.model)
-                    
-                    sigma_sq_phi_l = nstep_cp.var_func(images_arr_cp[-(self.N_list[-2]+self.N_list[-1]): -self.N_list[-1]],
-                                                  self.mask,
-                                                  self.N_list[-2],
-                                                  cov_arr_l)
-                    cov_arr_h,_ = nstep_cp.pred_var_fn(images_arr_cp[-self.N_list[-1]:], self.model)
-                    sigma_sq_phi = nstep_cp.var_func(images_arr_cp[-self.N_list[-1]:],
-                                                  self.mask,
-                                                  self.N_list[-1],
-                                                  cov_arr_h)
-                    sigma_sq_delta_phi = ((self.pitch_list[-2]/self.pitch_list[-1])**2 * sigma_sq_phi_l) + sigma_sq_phi
-                    quality = np.pi/np.sqrt(sigma_sq_delta_phi)
-                    quality = cp.asnumpy(quality)
+                    with span('sigma'):
+                        sigma_sq_phi_l = nstep.var_func(images_arr[-(self.N_list[-2]+self.N_list[-1]): -self.N_list[-1]],
+                                                      self.pixels,
+                                                      self.N_list[-2],
+                                                      self.model)
+                        sigma_sq_phi = nstep.var_func(images_arr[-self.N_list[-1]:],
+                                                      self.pixels,
+                                                      self.N_list[-1],
+                                                      self.model)
+                        sigma_sq_delta_phi = ((self.pitch_list[-2]/self.pitch_list[-1])**2 * sigma_sq_phi_l) + sigma_sq_phi
+                        quality = self.backend.asnumpy(np.pi/self.backend.xp.sqrt(sigma_sq_delta_phi))
                 else:
                     sigma_sq_phi = None
                     quality = None
@@ -717,10 +666,12 @@ class Reconstruction:
             eq_wav123 = self.pitch_list[0] * eq_wav12 / (self.pitch_list[0] - eq_wav12)
             self.pitch_list = np.insert(self.pitch_list, 0, eq_wav123)
             self.pitch_list = np.insert(self.pitch_list, 2, eq_wav12)
+            images_arr = self.backend.asarray(images_arr)
             modulation_vector, orig_img, phase_map, mask = nstep.phase_cal(images_arr, 
                                                                            self.limit, 
                                                                            self.N_list,
                                                                            False)
+            orig_img = self.backend.asnumpy(orig_img)
             phase_wav12 = np.mod(phase_map[0] - phase_map[1], 2 * np.pi)
             phase_wav123 = np.mod(phase_wav12 - phase_map[2], 2 * np.pi)
             phase_wav123[phase_wav123 > TAU] = phase_wav123[phase_wav123 > TAU] - 2 * np.pi
@@ -733,7 +684,7 @@ class Reconstruction:
                                                       mask,
                                                       self.cam_width,
                                                       self.cam_height)
-            self.mask = mask
+            self.pixels = nstep.PixelSet.from_mask(mask)
             
         if os.path.exists(os.path.join(self.object_path, 'white.tiff')):
             inte_img = cv2.imread(os.path.join(self.object_path, 'white.tiff'))
@@ -748,6 +699,44 @@ class Reconstruction:
         
         return obj_cordi, obj_color, cordi_sigma
     
+def write_ply(path, coords, color=None, sigma=None, temperature=None, quality=None):
+    """
+    Function to write point cloud as binary little endian ply with a single interleaved vertex element.
+    The vertex array is assembled column wise from the input arrays and written in one block.
+    Parameters
+    ----------
+    path: str.
+          Path of ply file.
+    coords: np.ndarray/cp.ndarray.
+            N x 3 array of x, y, z coordinates.
+    color: np.ndarray.
+           N x 3 array of r, g, b color of each point.
+    sigma: np.ndarray.
+           N x 3 array of standard deviation dx, dy, dz of each point.
+    temperature: np.ndarray.
+                 Temperature of each point.
+    quality: np.ndarray.
+             Quality of each point.
+    Returns
+    -------
+    vertex: np.ndarray.
+            Structured vertex array written to file.
+    """
+    columns = [(('x', 'y', 'z'), coords), (('r', 'g', 'b'), color), (('dx', 'dy', 'dz'), sigma),
+               (('temperature',), temperature), (('quality',), quality)]
+    columns = [(names, to_numpy(values).reshape(len(coords), len(names))) for names, values in columns if values is not None]
+    vertex = np.empty(len(coords), dtype=[(name, '<f4') for names, _ in columns for name in names])
+    for names, values in columns:
+        for i, name in enumerate(names):
+            vertex[name] = values[:, i]
+    header = ['ply', 'format binary_little_endian 1.0', 'element vertex %d' % len(vertex)]
+    header += ['property float %s' % name for name in vertex.dtype.names]
+    header += ['end_header']
+    with open(path, 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode('ascii'))
+        f.write(memoryview(vertex).cast('B'))
+    return vertex
+
 def undistort_point(xc_yc, camera_dist):
     r_sq = xc_yc[0]**2 + xc_yc[1]**2
     undist_point = xc_yc * (1 + camera_dist[0, 0] * r_sq + camera_dist[0, 1] * r_sq**2)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 11:20:37 2026
+
+@author: kl001
+
+Single file scan archive. All poses/scans of a session are stored as raw frame blocks in one file together with
+an index of poses (acquisition index, frame offset, shape, dtype, levels, N, pitch and frame timestamps), so that
+any pose can be opened as a zero-copy memory map without directory scans.
+
+File layout:
+    [0:64)         fixed header: magic, version, index offset and index length (little endian uint64)
+    [64:...)       frame blocks of each pose, each block aligned to 4096 bytes
+    [index offset] json index of poses, rewritten after the last frame block whenever a pose is finished
+"""
+import os
+import json
+import struct
+import numpy as np
+
+MAGIC = b'PFSCAN\x00\x01'
+VERSION = 1
+HEADER_SIZE = 64
+ALIGNMENT = 4096
+SCAN_ARCHIVE = 'scan_archive.pfs'
+
+
+def _read_header(f):
+    f.seek(0)
+    magic, version, index_offset, index_len = struct.unpack('<8sQQQ', f.read(32))
+    if magic != MAGIC:
+        raise IOError("Not a scan archive")
+    f.seek(index_offset)
+    index = json.loads(f.read(index_len).decode('utf-8'))
+    return version, index_offset, index
+
+def _write_index(f, index_offset, index):
+    f.seek(index_offset)
+    f.truncate()
+    index_bytes = json.dumps(index).encode('utf-8')
+    f.write(index_bytes)
+    f.seek(0)
+    f.write(struct.pack('<8sQQQ', MAGIC, VERSION, index_offset, len(index_bytes)).ljust(HEADER_SIZE, b'\x00'))
+    f.flush()
+
+
+class ScanArchiveWriter:
+    """
+    Writer of a scan archive. Frames of a pose are appended as they are captured, the index is rewritten when a pose
+    is finished so that the archive is readable after every pose. An existing archive is opened for appending.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._pose = None
+        if os.path.exists(path):
+            self._file = open(path, 'r+b')
+            _, _, self.index = _read_header(self._file)
+        else:
+            self._file = open(path, 'w+b')
+            self.index = {'poses': []}
+            _write_index(self._file, HEADER_SIZE, self.index)
+
+    def begin_pose(self, acquisition_index, frame_shape, dtype=np.uint8, **info):
+        """
+        Function to start a new pose.
+        Parameters
+        ----------
+        acquisition_index: int.
+                           Index of pose (acquisition). An existing pose with the same index is replaced.
+        frame_shape: tuple.
+                     Shape of each frame.
+        dtype: np.dtype.
+               Type of frames.
+        info: dict.
+              Additional json serializable pose information e.g. levels, N, pitch.
+        """
+        if self._pose is not None:
+            self.end_pose()
+        # frames are written after the current index, which stays valid until the pose is finished
+        offset = -(-self._file.seek(0, 2) // ALIGNMENT) * ALIGNMENT
+        self._pose = dict(info, acquisition_index=int(acquisition_index), offset=offset, n_frames=0,
+                          shape=[int(i) for i in frame_shape], dtype=np.dtype(dtype).str, timestamps=[])
+        self._file.seek(offset)
+
+    def add_frame(self, frame, timestamp=None):
+        """
+        Function to append one frame to the current pose.
+        """
+        frame = np.ascontiguousarray(frame, dtype=np.dtype(self._pose['dtype']))
+        if list(frame.shape) != self._pose['shape']:
+            print("ERROR: frame shape %s does not match pose frame shape %s" % (frame.shape, self._pose['shape']))
+            return False
+        self._file.write(memoryview(frame).cast('B'))
+        self._pose['n_frames'] += 1
+        self._pose['timestamps'].append(timestamp)
+        return True
+
+    def add_frames(self, frames, timestamps=None):
+        result = True
+        for i, frame in enumerate(frames):
+            result &= self.add_frame(frame, None if timestamps is None else timestamps[i])
+        return result
+
+    def end_pose(self):
+        """
+        Function to finish current pose and rewrite the index.
+        """
+        if self._pose is None:
+            return
+        pose = self._pose
+        self._pose = None
+        self.index['poses'] = [p for p in self.index['poses'] if p['acquisition_index'] != pose['acquisition_index']]
+        self.index['poses'].append(pose)
+        _write_index(self._file, self._file.tell(), self.index)
+
+    def close(self):
+        self.end_pose()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ScanArchive:
+    """
+    Reader of a scan archive. Poses are opened as read only memory maps.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.version, _, self.index = _read_header(f)
+        self._poses = {p['acquisition_index']: p for p in self.index['poses']}
+
+    @property
+    def poses(self):
+        """
+        Sorted acquisition indices of poses.
+        """
+        return sorted(self._poses)
+
+    def __len__(self):
+        return len(self._poses)
+
+    def __contains__(self, acquisition_index):
+        return acquisition_index in self._poses
+
+    def info(self, acquisition_index):
+        """
+        Index entry of pose (offset, n_frames, shape, dtype, timestamps and capture information).
+        """
+        return self._poses[acquisition_index]
+
+    def open(self, acquisition_index):
+        """
+        Function to open the frames of a pose.
+        Parameters
+        ----------
+        acquisition_index: int.
+                           Index of pose.
+        Returns
+        -------
+        frames: np.memmap.
+                Read only n_frames x frame shape memory map.
+        """
+        pose = self._poses[acquisition_index]
+        return np.memmap(self.path, dtype=np.dtype(pose['dtype']), mode='r', offset=pose['offset'],
+                         shape=(pose['n_frames'],) + tuple(pose['shape']))
@@ -0,0 +1,1096 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 18:12:40 2026
+
+@author: kl001
+
+Simulated camera and projector for running the acquisition code (gspy, lcpy, image_acquisation) without hardware,
+e.g. to load test frames/s and scan latency on CI.
+
+SimulatedCamera behaves like a PySpin camera: nodemaps with the nodes used by gspy, free run at the configured
+frame rate, software trigger and hardware trigger (Line0) from the projector, a stream buffer of
+StreamBufferCountManual frames handled as StreamBufferHandlingMode, incomplete frames at a given rate and
+SpinnakerException on GetNextImage timeout. Frames are taken from a given image stack (e.g. a fringe_simulator
+render) in pattern order.
+
+SimulatedDLPC350 behaves like the pyusb device of a DLPC350: it assembles the 64 byte packets written by
+lcpy.dlpc350.command, executes the command (status, pattern configuration, exposure and frame period, trigger out,
+validation, image and pattern LUT mailboxes, pattern display start/stop) and queues the reply packets read from
+endpoint 0x81. A started pattern sequence drives the hardware trigger of the connected camera, one trigger per
+pattern every frame period.
+
+simulated_hardware installs both as the PySpin and usb.core modules seen by the acquisition code:
+
+    camera = SimulatedCamera(images=images)
+    projector = SimulatedDLPC350()
+    with simulated_hardware(camera, projector, preview_frames=20):
+        result, system, cam_list, num_cameras = gspy.sysScan()
+        cam = cam_list[0]
+        cam.Init()
+        lcr = lcpy.dlpc350(usb.core.find(idVendor=0x0451, idProduct=0x6401))
+        image_acquisation.proj_cam_acquire_images(cam, lcr, ...)
+"""
+import array
+import collections
+import sys
+import types
+from contextlib import contextmanager
+from time import perf_counter, sleep
+import numpy as np
+import cv2
+from lazy_modules import LazyModule
+
+# image status of an incomplete frame
+IMAGE_STATUS_INCOMPLETE = 3
+# DLPC350 USB ids
+DLPC350_VENDOR_ID = 0x0451
+DLPC350_PRODUCT_ID = 0x6401
+# reply flag bit of a failed command
+REPLY_ERROR = 0x20
+
+
+class SpinnakerException(Exception):
+    """
+    Exception raised by the simulated PySpin camera.
+    """
+    pass
+
+
+class USBError(IOError):
+    """
+    Exception raised by the simulated usb device.
+    """
+    pass
+
+# =====================================================================================================================
+# PySpin nodes
+# =====================================================================================================================
+
+
+class _Node:
+    """
+    Node of a simulated nodemap.
+    """
+    def __init__(self, name, description='', writable=True):
+        self.name = name
+        self.description = description
+        self.writable = writable
+
+    def GetName(self):
+        return self.name
+
+    def GetDisplayName(self):
+        return self.name
+
+    def GetDescription(self):
+        return self.description
+
+    def _check_writable(self):
+        if not self.writable:
+            raise SpinnakerException('Spinnaker: Node %s is not writable. [-1010]' % self.name)
+
+
+class _ValueNode(_Node):
+    """
+    Integer, float, boolean or string node.
+    """
+    def __init__(self, name, value, minimum=None, maximum=None, unit='', description='', writable=True):
+        super().__init__(name, description, writable)
+        self.value = value
+        self.minimum = minimum
+        self.maximum = maximum
+        self.unit = unit
+
+    def GetValue(self):
+        return self.value
+
+    def SetValue(self, value):
+        self._check_writable()
+        if ((self.minimum is not None) and (value < self.minimum)) or ((self.maximum is not None) and (value > self.maximum)):
+            raise SpinnakerException('Spinnaker: Value %s of node %s is out of range [%s, %s]. [-1009]'
+                                     % (value, self.name, self.minimum, self.maximum))
+        self.value = type(self.value)(value)
+
+    def GetMin(self):
+        return self.minimum
+
+    def GetMax(self):
+        return self.maximum
+
+    def GetUnit(self):
+        return self.unit
+
+    def ToString(self):
+        return str(self.value)
+
+
+class _EnumEntry(_Node):
+    """
+    Entry of an enumeration node.
+    """
+    def __init__(self, name, value):
+        super().__init__(name, writable=False)
+        self.value = value
+
+    def GetSymbolic(self):
+        return self.name
+
+    def GetValue(self):
+        return self.value
+
+
+class _EnumNode(_Node):
+    """
+    Enumeration node, entry values are the entry positions.
+    """
+    def __init__(self, name, entries, current, description='', writable=True):
+        super().__init__(name, description, writable)
+        self.entries = [_EnumEntry(entry, i) for i, entry in enumerate(entries)]
+        self.value = entries.index(current)
+
+    @property
+    def symbolic(self):
+        return self.entries[self.value].name
+
+    def GetIntValue(self):
+        return self.value
+
+    def SetIntValue(self, value):
+        self._check_writable()
+        if not 0 <= value < len(self.entries):
+            raise SpinnakerException('Spinnaker: Invalid entry %s of node %s. [-1009]' % (value, self.name))
+        self.value = value
+
+    def GetEntry(self, value):
+        return self.entries[value]
+
+    def GetEntries(self):
+        return list(self.entries)
+
+    def GetEntryByName(self, name):
+        for entry in self.entries:
+            if entry.name == name:
+                return entry
+        return None
+
+    def GetCurrentEntry(self):
+        return self.entries[self.value]
+
+    def ToString(self):
+        return self.symbolic
+
+
+class _CategoryNode(_Node):
+    """
+    Category node listing feature nodes.
+    """
+    def __init__(self, name, features):
+        super().__init__(name, writable=False)
+        self.features = features
+
+    def GetFeatures(self):
+        return list(self.features)
+
+
+class _Command:
+    """
+    Command node, e.g. TriggerSoftware.
+    """
+    def __init__(self, function):
+        self.function = function
+
+    def Execute(self):
+        self.function()
+
+
+class _NodeMap:
+    """
+    Simulated INodeMap.
+    """
+    def __init__(self, nodes):
+        self.nodes = {node.name: node for node in nodes}
+
+    def GetNode(self, name):
+        return self.nodes.get(name)
+
+    def __getitem__(self, name):
+        return self.nodes[name]
+
+
+def _is_available(node):
+    return node is not None
+
+
+def _is_readable(node):
+    return node is not None
+
+
+def _is_writable(node):
+    return (node is not None) and node.writable
+
+
+def _pointer(node):
+    # CEnumerationPtr, CFloatPtr, ... are casts in PySpin, simulated nodes have all methods already
+    return node
+
+
+class _LibraryVersion:
+    major = 0
+    minor = 0
+    type = 0
+    build = 0
+
+
+class _CameraList(list):
+    """
+    Simulated CameraList.
+    """
+    def GetSize(self):
+        return len(self)
+
+    def GetByIndex(self, index):
+        return self[index]
+
+    def Clear(self):
+        del self[:]
+
+
+class _System:
+    """
+    Simulated PySpin.System singleton.
+    """
+    def __init__(self, cameras):
+        self.cameras = cameras
+
+    def GetLibraryVersion(self):
+        return _LibraryVersion()
+
+    def GetCameras(self):
+        return _CameraList(self.cameras)
+
+    def ReleaseInstance(self):
+        return
+
+
+def pyspin_module(cameras):
+    """
+    Function creates a module standing for PySpin with the given simulated cameras.
+    Parameters
+    ----------
+    cameras: list.
+             Simulated cameras returned by System.GetInstance().GetCameras().
+    Returns
+    -------
+    module: types.ModuleType.
+            Simulated PySpin module.
+    """
+    module = types.ModuleType('PySpin')
+    system = _System(cameras)
+    module.System = types.SimpleNamespace(GetInstance=lambda: system)
+    module.SpinnakerException = SpinnakerException
+    module.IsAvailable = _is_available
+    module.IsReadable = _is_readable
+    module.IsWritable = _is_writable
+    for name in ['CEnumerationPtr', 'CEnumEntryPtr', 'CIntegerPtr', 'CFloatPtr', 'CBooleanPtr', 'CStringPtr',
+                 'CCategoryPtr', 'CValuePtr', 'CCommandPtr']:
+        setattr(module, name, _pointer)
+    module.EVENT_TIMEOUT_INFINITE = None
+    return module
+
+# =====================================================================================================================
+# Camera
+# =====================================================================================================================
+
+
+class SimulatedImage:
+    """
+    Simulated ImagePtr returned by GetNextImage.
+    """
+    def __init__(self, array, frame_id, timestamp, status=0):
+        self.array = array
+        self.frame_id = frame_id
+        self.timestamp = timestamp
+        self.status = status
+
+    def IsIncomplete(self):
+        return self.status != 0
+
+    def GetImageStatus(self):
+        return self.status
+
+    def GetNDArray(self):
+        return self.array
+
+    def GetWidth(self):
+        return self.array.shape[1]
+
+    def GetHeight(self):
+        return self.array.shape[0]
+
+    def GetFrameID(self):
+        return self.frame_id
+
+    def GetTimeStamp(self):
+        # nanoseconds
+        return int(self.timestamp * 1e9)
+
+    def Save(self, path):
+        cv2.imwrite(path, self.array)
+
+    def Release(self):
+        return
+
+
+class SimulatedCamera:
+    """
+    Simulated PySpin camera.
+    """
+    def __init__(self,
+                 images=None,
+                 width=1920,
+                 height=1200,
+                 frame_rate=30.0,
+                 max_frame_rate=163.0,
+                 incomplete_rate=0.0,
+                 readout_time=0.0,
+                 buffer_count=10,
+                 seed=0,
+                 serial='SIM00001',
+                 model='Simulated Grasshopper3'):
+        """
+        Parameters
+        ----------
+        images: np.ndarray.
+                uint8 frames (no. of images x height x width). Frame of the k-th pattern of a projector sequence is
+                images[k % no. of images], free run and software triggered frames cycle through the stack.
+                Default is a single horizontal gradient image of width x height.
+        width: int.
+               Frame width if images is None.
+        height: int.
+                Frame height if images is None.
+        frame_rate: float.
+                    Initial AcquisitionFrameRate in Hz (free run).
+        max_frame_rate: float.
+                        Maximum frame rate of the sensor, triggers arriving earlier than 1/max_frame_rate after the
+                        previous exposure start are missed.
+        incomplete_rate: float.
+                         Probability of a frame being incomplete.
+        readout_time: float.
+                      Time in seconds between end of exposure and frame being available.
+        buffer_count: int.
+                      Initial StreamBufferCountManual.
+        seed: int.
+              Seed of incomplete frames.
+        serial: str.
+                Device serial number.
+        model: str.
+               Device model name.
+        """
+        if images is None:
+            images = np.broadcast_to(np.linspace(0, 255, width).astype(np.uint8), (1, height, width))
+        self.images = np.asarray(images)
+        if self.images.ndim == 2:
+            self.images = self.images[None]
+        height, width = self.images.shape[1:]
+        self.max_frame_rate = max_frame_rate
+        self.incomplete_rate = incomplete_rate
+        self.readout_time = readout_time
+        self.rng = np.random.default_rng(seed)
+        self.trigger_line = None
+        self.initialized = False
+        self.streaming = False
+        self.TriggerSoftware = _Command(self._software_trigger)
+        self.nodemap = _NodeMap([
+            _EnumNode('AcquisitionMode', ['Continuous', 'SingleFrame', 'MultiFrame'], 'Continuous'),
+            _ValueNode('OnBoardColorProcessEnabled', False),
+            _EnumNode('AcquisitionFrameRateAuto', ['Off', 'Continuous'], 'Continuous'),
+            _ValueNode('AcquisitionFrameRateEnabled', False),
+            _ValueNode('AcquisitionFrameRate', float(frame_rate), 1.0, float(max_frame_rate), 'Hz'),
+            _EnumNode('pgrExposureCompensationAuto', ['Off', 'Once', 'Continuous'], 'Continuous'),
+            _ValueNode('pgrExposureCompensation', 0.0, -7.6, 2.4, 'EV'),
+            _EnumNode('ExposureAuto', ['Off', 'Once', 'Continuous'], 'Continuous'),
+            _ValueNode('ExposureTime', 10000.0, 6.0, 3.2e7, 'us'),
+            _EnumNode('ExposureMode', ['Timed', 'TriggerWidth'], 'Timed'),
+            _EnumNode('GainAuto', ['Off', 'Once', 'Continuous'], 'Continuous'),
+            _ValueNode('Gain', 0.0, 0.0, 48.0, 'dB'),
+            _ValueNode('BlackLevel', 0.0, 0.0, 12.5, '%'),
+            _EnumNode('TriggerMode', ['Off', 'On'], 'Off'),
+            _EnumNode('TriggerSource', ['Software', 'Line0', 'Line2', 'Line3'], 'Software'),
+            _EnumNode('TriggerSelector', ['FrameStart', 'ExposureActive'], 'FrameStart'),
+            _EnumNode('TriggerActivation', ['RisingEdge', 'FallingEdge'], 'RisingEdge'),
+            _EnumNode('TriggerOverlap', ['Off', 'ReadOut'], 'Off'),
+            _ValueNode('TriggerDelayEnabled', False),
+            _ValueNode('TriggerDelay', 0.0, 0.0, 65520.0, 'us'),
+            _ValueNode('Width', width, writable=False),
+            _ValueNode('Height', height, writable=False),
+            _EnumNode('PixelFormat', ['Mono8', 'Mono16'], 'Mono8' if self.images.dtype == np.uint8 else 'Mono16',
+                      writable=False)])
+        self.s_node_map = _NodeMap([
+            _EnumNode('StreamBufferCountMode', ['Auto', 'Manual'], 'Manual'),
+            _ValueNode('StreamBufferCountManual', int(buffer_count), 1, 2000),
+            _EnumNode('StreamBufferHandlingMode', ['OldestFirst', 'OldestFirstOverwrite', 'NewestOnly', 'NewestFirst'],
+                      'OldestFirst')])
+        device_info = [_ValueNode('DeviceModelName', model, writable=False),
+                       _ValueNode('DeviceSerialNumber', serial, writable=False),
+                       _ValueNode('DeviceVendorName', 'Simulated', writable=False)]
+        self.nodemap_tldevice = _NodeMap(device_info + [_CategoryNode('DeviceInformation', device_info)])
+        # log of each acquisition (BeginAcquisition to EndAcquisition)
+        self.acquisitions = []
+        self._log = None
+        self._reset_stream()
+
+    def connect(self, trigger_line):
+        """
+        Function connects the Line0 trigger input to a trigger source, e.g. a SimulatedDLPC350.
+        """
+        self.trigger_line = trigger_line
+        return
+
+    # PySpin camera interface
+    def Init(self):
+        self.initialized = True
+
+    def DeInit(self):
+        if self.streaming:
+            self.EndAcquisition()
+        self.initialized = False
+
+    def IsInitialized(self):
+        return self.initialized
+
+    def IsStreaming(self):
+        return self.streaming
+
+    def GetNodeMap(self):
+        return self.nodemap
+
+    def GetTLDeviceNodeMap(self):
+        return self.nodemap_tldevice
+
+    def GetTLStreamNodeMap(self):
+        return self.s_node_map
+
+    def BeginAcquisition(self):
+        if not self.initialized:
+            raise SpinnakerException('Spinnaker: Camera is not initialized. [-1002]')
+        if self.streaming:
+            raise SpinnakerException('Spinnaker: Stream has been already started. [-1002]')
+        self._reset_stream()
+        self.streaming = True
+        self._begin = perf_counter()
+        self._last_exposure_start = -np.inf
+        self._buffer_count = self.s_node_map['StreamBufferCountManual'].value
+        self._handling = self.s_node_map['StreamBufferHandlingMode'].symbolic
+        self._free_run = self.nodemap['TriggerMode'].symbolic == 'Off'
+        self._source = self.nodemap['TriggerSource'].symbolic
+        self._width_exposure = self.nodemap['ExposureMode'].symbolic == 'TriggerWidth'
+        # ready and delivery times of complete frames
+        self._log = {'trigger': 'Off' if self._free_run else self._source,
+                     'frames': 0,
+                     'incomplete': 0,
+                     'lost': 0,
+                     'missed_triggers': 0,
+                     'ready_times': [],
+                     'delivery_times': []}
+        self.acquisitions.append(self._log)
+
+    def EndAcquisition(self):
+        if not self.streaming:
+            raise SpinnakerException('Spinnaker: Stream has not been started. [-1002]')
+        self.streaming = False
+        self._reset_stream()
+
+    def GetNextImage(self, grabTimeout=None):
+        """
+        Next frame of the stream buffer, waits for it up to grabTimeout milliseconds (None waits forever).
+        """
+        if not self.streaming:
+            raise SpinnakerException('Spinnaker: Stream has not been started. [-1002]')
+        now = perf_counter()
+        deadline = now + grabTimeout / 1000 if grabTimeout is not None else np.inf
+        while True:
+            self._harvest(now)
+            if self._buffer:
+                frame = self._buffer.pop() if self._handling == 'NewestFirst' else self._buffer.popleft()
+                self._log['frames'] += 1
+                if not frame.status:
+                    self._log['ready_times'].append(frame.timestamp)
+                    self._log['delivery_times'].append(perf_counter())
+                return frame
+            if now >= deadline:
+                raise SpinnakerException('Spinnaker: Failed waiting for EventData on NEW_BUFFER_DATA event. [-1011]')
+            ready = self._next_ready()
+            # without a known trigger, poll for one (software trigger from another thread)
+            wake = min(ready if ready is not None else now + 0.005, deadline)
+            if wake > now:
+                sleep(wake - now)
+            now = perf_counter()
+
+    # triggers and frames
+    def _reset_stream(self):
+        self._buffer = collections.deque()
+        self._software_triggers = collections.deque()
+        self._free_run_index = 0
+        self._line_sequence = None
+        self._line_index = 0
+        self._frame_id = 0
+
+    def _software_trigger(self):
+        if self.streaming and (not self._free_run) and (self._source == 'Software'):
+            self._software_triggers.append(perf_counter())
+        return
+
+    def _exposure_time(self):
+        return self.nodemap['ExposureTime'].value / 1e6
+
+    def _next_trigger(self):
+        """
+        Next trigger of the stream: (time, exposure in s, pattern index) or None if no trigger is known yet.
+        """
+        if self._free_run:
+            exposure = self._exposure_time()
+            if self.nodemap['AcquisitionFrameRateEnabled'].value:
+                period = 1 / self.nodemap['AcquisitionFrameRate'].value
+            else:
+                period = 1 / self.max_frame_rate
+            period = max(period, exposure + self.readout_time)
+            return self._begin + self._free_run_index * period, exposure, self._free_run_index
+        if self._source == 'Software':
+            if not self._software_triggers:
+                return None
+            return self._software_triggers[0], self._exposure_time(), self._frame_id
+        if (self._source == 'Line0') and (self.trigger_line is not None):
+            sequence = self.trigger_line.trigger_sequence()
+            if sequence != self._line_sequence:
+                # new pattern sequence
+                self._line_sequence = sequence
+                self._line_index = 0
+            while True:
+                trigger = self.trigger_line.trigger_time(self._line_index)
+                if trigger is None:
+                    return None
+                time, width = trigger
+                if time >= self._begin:
+                    break
+                # triggered before BeginAcquisition
+                self._line_index += 1
+            exposure = width if self._width_exposure else self._exposure_time()
+            return time, exposure, self._line_index
+        return None
+
+    def _consume_trigger(self):
+        if self._free_run:
+            self._free_run_index += 1
+        elif self._source == 'Software':
+            self._software_triggers.popleft()
+        else:
+            self._line_index += 1
+        return
+
+    def _next_ready(self):
+        trigger = self._next_trigger()
+        if trigger is None:
+            return None
+        time, exposure, _ = trigger
+        return time + exposure + self.readout_time
+
+    def _harvest(self, now):
+        """
+        Moves frames of all triggers read out before now into the stream buffer.
+        """
+        while True:
+            trigger = self._next_trigger()
+            if trigger is None:
+                return
+            time, exposure, index = trigger
+            ready = time + exposure + self.readout_time
+            if ready > now:
+                return
+            self._consume_trigger()
+            if time < self._last_exposure_start + 1 / self.max_frame_rate:
+                self._log['missed_triggers'] += 1
+                continue
+            self._last_exposure_start = time
+            status = 0
+            if self.incomplete_rate and (self.rng.random() < self.incomplete_rate):
+                status = IMAGE_STATUS_INCOMPLETE
+                self._log['incomplete'] += 1
+            frame = SimulatedImage(self.images[index % len(self.images)], self._frame_id, ready, status)
+            self._frame_id += 1
+            if self._handling == 'NewestOnly':
+                self._log['lost'] += len(self._buffer)
+                self._buffer.clear()
+            elif len(self._buffer) >= self._buffer_count:
+                self._log['lost'] += 1
+                if self._handling == 'OldestFirst':
+                    # buffers full, new frame is dropped
+                    continue
+                elif self._handling == 'NewestFirst':
+                    self._buffer.pop()
+                else:
+                    self._buffer.popleft()
+            self._buffer.append(frame)
+
+    def statistics(self, trigger=None):
+        """
+        Function sums the frame counters of acquisitions.
+        Parameters
+        ----------
+        trigger: str.
+                 Only acquisitions with this trigger ('Off' for free run, 'Software', 'Line0'), default is all.
+        Returns
+        -------
+        statistics: dict.
+                    Number of acquisitions, frames delivered, incomplete frames, frames lost in the stream buffer
+                    and missed triggers.
+        """
+        logs = [log for log in self.acquisitions if (trigger is None) or (log['trigger'] == trigger)]
+        statistics = {'acquisitions': len(logs)}
+        for key in ['frames', 'incomplete', 'lost', 'missed_triggers']:
+            statistics[key] = sum(log[key] for log in logs)
+        return statistics
+
+# =====================================================================================================================
+# Projector
+# =====================================================================================================================
+
+
+class SimulatedDLPC350:
+    """
+    Simulated pyusb device of a DLPC350 projector controller.
+    """
+    idVendor = DLPC350_VENDOR_ID
+    idProduct = DLPC350_PRODUCT_ID
+    PACKET_SIZE = 64
+    IMAGE_LUT_SIZE = 64
+    PATTERN_LUT_SIZE = 128
+
+    def __init__(self,
+                 num_flash_images=40,
+                 image_load_time=20000,
+                 validation_time=0.01,
+                 command_latency=0.0):
+        """
+        Parameters
+        ----------
+        num_flash_images: int.
+                          Number of images on flash.
+        image_load_time: int.
+                         Loading time of a 24 bit flash image in microseconds.
+        validation_time: float.
+                         Time in seconds the controller is busy validating the pattern sequence.
+        command_latency: float.
+                         Time in seconds between the last packet of a command and its reply being available.
+        """
+        self.num_flash_images = num_flash_images
+        self.image_load_time = image_load_time
+        self.validation_time = validation_time
+        self.command_latency = command_latency
+        self.configured = False
+        # registers
+        self.mode = 1  # pattern
+        self.source = 3  # flash
+        self.trigger_mode = 1
+        self.trig_out1 = [0, 187, 187]
+        self.exposure_period = 27084
+        self.frame_period = 33334
+        self.num_lut_entries = 1
+        self.do_repeat = 1
+        self.num_pats_for_trig_out2 = 1
+        self.num_images = 1
+        self.image_lut = bytearray(self.IMAGE_LUT_SIZE)
+        self.pattern_lut = bytearray(3 * self.PATTERN_LUT_SIZE)
+        self.image_lut_length = 0
+        self.pattern_lut_length = 0
+        self.mailbox = 0
+        self.mailbox_address = 0
+        self.loading_image = 0
+        self.validated = False
+        self.validation_status = 0
+        self.validation_done = 0.0
+        # pattern sequence
+        self.running = False
+        self.sequence = 0
+        self.sequence_start = None
+        self.sequence_stop = None
+        self._sequence_length = 1
+        self._sequence_repeat = False
+        self._sequence_frame_period = 0.0
+        self._sequence_exposure = 0.0
+        # transport
+        self._request = None
+        self._replies = collections.deque()
+        self.commands = collections.Counter()
+        self.packets_written = 0
+        self.packets_read = 0
+        self.errors = 0
+        self.unacknowledged_errors = 0
+
+    # pyusb device interface
+    def set_configuration(self):
+        self.configured = True
+
+    def reset(self):
+        self._request = None
+        self._replies.clear()
+
+    def write(self, endpoint, data, timeout=None):
+        """
+        Function receives one packet of a command.
+        """
+        packet = bytes(data)
+        if len(packet) > self.PACKET_SIZE:
+            raise USBError('[Errno 75] Overflow, packet of %d bytes' % len(packet))
+        self.packets_written += 1
+        if self._request is None:
+            flags, sequence_byte, length_lsb, length_msb = packet[:4]
+            length = length_msb * 256 + length_lsb
+            # request: flags, sequence byte, expected bytes (subcommands + data), bytes received
+            self._request = [flags, sequence_byte, length, bytearray(packet[4:4 + length])]
+        else:
+            self._request[3].extend(packet[:self._request[2] - len(self._request[3])])
+        if len(self._request[3]) >= self._request[2]:
+            flags, sequence_byte, _, payload = self._request
+            self._request = None
+            self._execute(flags, sequence_byte, payload)
+        return len(packet)
+
+    def read(self, endpoint, size, timeout=None):
+        """
+        Function returns the next reply packet, raises USBError if there is no reply.
+        """
+        if not self._replies:
+            raise USBError('[Errno 110] Operation timed out')
+        ready, packet = self._replies.popleft()
+        wait = ready - perf_counter()
+        if wait > 0:
+            sleep(wait)
+        self.packets_read += 1
+        return array.array('B', packet[:size])
+
+    # hardware trigger output
+    def trigger_sequence(self):
+        """
+        Number of the current pattern sequence, increased by each start.
+        """
+        return self.sequence
+
+    def trigger_time(self, index):
+        """
+        Trigger of the index-th pattern of the current sequence.
+        Returns
+        -------
+        trigger: tuple.
+                 (start time, trigger width in s), None if the pattern is not (yet) displayed.
+        """
+        if self.sequence_start is None:
+            return None
+        if (not self._sequence_repeat) and (index >= self._sequence_length):
+            return None
+        time = self.sequence_start + index * self._sequence_frame_period
+        if (self.sequence_stop is not None) and (time >= self.sequence_stop):
+            return None
+        return time, self._sequence_exposure
+
+    # commands
+    def _execute(self, flags, sequence_byte, payload):
+        command = payload[1] * 256 + payload[0]
+        data = bytes(payload[2:])
+        read = bool(flags & 0x80)
+        self.commands[command] += 1
+        handler = self._handlers().get(command)
+        reply = b''
+        error = handler is None
+        if handler is not None:
+            try:
+                reply = handler(read, data)
+            except (IndexError, ValueError):
+                error = True
+        if error:
+            self.errors += 1
+            reply = b''
+        if not flags & 0x40:
+            # host did not request a reply, the failure would go unnoticed by the driver
+            if error:
+                self.unacknowledged_errors += 1
+                print('WARNING: simulated DLPC350 command 0x%04x failed without reply requested' % command)
+            return
+        reply_flags = (flags & 0xc0) | (REPLY_ERROR if error else 0)
+        self._queue_reply(bytes([reply_flags, sequence_byte, len(reply) % 256, len(reply) // 256]) + (reply or b''))
+        return
+
+    def _queue_reply(self, message):
+        ready = perf_counter() + self.command_latency
+        for i in range(0, max(len(message), 1), self.PACKET_SIZE):
+            packet = message[i:i + self.PACKET_SIZE]
+            self._replies.append((ready, packet + bytes(self.PACKET_SIZE - len(packet))))
+        return
+
+    def _handlers(self):
+        return {0x1a0c: self._main_status,
+                0x1a42: self._num_flash_images,
+                0x1a3a: self._image_loading_time,
+                0x1a1b: self._register('mode', 1),
+                0x1a22: self._register('source', 1),
+                0x1a31: self._pattern_config,
+                0x1a23: self._register('trigger_mode', 1),
+                0x1a1d: self._trig_out1,
+                0x1a29: self._exposure_frame_period,
+                0x1a1a: self._validate,
+                0x1a33: self._open_mailbox,
+                0x1a32: self._mailbox_address,
+                0x1a34: self._mailbox_data,
+                0x1a24: self._pattern_display}
+
+    def _register(self, name, size):
+        def handler(read, data):
+            if read:
+                return getattr(self, name).to_bytes(size, 'little')
+            setattr(self, name, int.from_bytes(data[:size], 'little'))
+            self.validated = False
+            return b''
+        return handler
+
+    def _main_status(self, read, data):
+        # bit0 DMD parked, bit1 sequencer running, bit2 frame buffer frozen, bit3 gamma correction enabled
+        self._update_sequence()
+        return bytes([(0x02 if self.running else 0x00) | 0x08])
+
+    def _num_flash_images(self, read, data):
+        return bytes([self.num_flash_images])
+
+    def _image_loading_time(self, read, data):
+        if not read:
+            # starting image index, number of images
+            if data[0] >= self.num_flash_images:
+                raise ValueError('image index out of range')
+            self.loading_image = data[0]
+            return b''
+        # 18667 ticks per millisecond
+        return int(self.image_load_time * 18.667).to_bytes(4, 'little')
+
+    def _pattern_config(self, read, data):
+        if read:
+            return bytes([self.num_lut_entries - 1, self.do_repeat, self.num_pats_for_trig_out2 - 1,
+                          self.num_images - 1])
+        self.num_lut_entries = (data[0] & 0x7f) + 1
+        self.do_repeat = data[1] & 0x01
+        self.num_pats_for_trig_out2 = data[2] + 1
+        self.num_images = (data[3] & 0x3f) + 1
+        self.validated = False
+        return b''
+
+    def _trig_out1(self, read, data):
+        if read:
+            return bytes(self.trig_out1)
+        self.trig_out1 = list(data[:3])
+        self.validated = False
+        return b''
+
+    def _exposure_frame_period(self, read, data):
+        if read:
+            return self.exposure_period.to_bytes(4, 'little') + self.frame_period.to_bytes(4, 'little')
+        self.exposure_period = int.from_bytes(data[0:4], 'little')
+        self.frame_period = int.from_bytes(data[4:8], 'little')
+        self.validated = False
+        return b''
+
+    def _validate(self, read, data):
+        if not read:
+            status = 0
+            if (self.exposure_period > self.frame_period) or \
+                    ((self.exposure_period != self.frame_period) and (self.frame_period - self.exposure_period < 230)):
+                status |= 0x01
+            if (self.num_lut_entries > self.pattern_lut_length) or (self.num_images > self.image_lut_length):
+                status |= 0x02
+            self.validation_status = status
+            self.validation_done = perf_counter() + self.validation_time
+            self.validated = status == 0
+            return b''
+        if perf_counter() < self.validation_done:
+            return bytes([0x80 | self.validation_status])
+        return bytes([self.validation_status])
+
+    def _open_mailbox(self, read, data):
+        if read:
+            return bytes([self.mailbox])
+        if data[0] > 3:
+            raise ValueError('invalid mailbox')
+        self.mailbox = data[0]
+        self.mailbox_address = 0
+        return b''
+
+    def _mailbox_address(self, read, data):
+        if read:
+            return bytes([self.mailbox_address])
+        self.mailbox_address = data[0]
+        return b''
+
+    def _mailbox_data(self, read, data):
+        if self.mailbox == 1:
+            lut, entry_size, name = self.image_lut, 1, 'image_lut_length'
+        elif self.mailbox == 2:
+            lut, entry_size, name = self.pattern_lut, 3, 'pattern_lut_length'
+        else:
+            raise ValueError('no mailbox is open')
+        start = entry_size * self.mailbox_address
+        if read:
+            return bytes(lut[start:entry_size * getattr(self, name)])
+        end = start + len(data)
+        if end > len(lut):
+            raise ValueError('mailbox overflow')
+        lut[start:end] = data
+        setattr(self, name, max(getattr(self, name), -(-end // entry_size)))
+        self.validated = False
+        return b''
+
+    def _pattern_display(self, read, data):
+        if read:
+            self._update_sequence()
+            return bytes([2 if self.running else 0])
+        action = data[0]
+        if action == 2:
+            if not self.validated:
+                raise ValueError('pattern sequence is not validated')
+            self.sequence += 1
+            self.running = True
+            self.sequence_start = perf_counter()
+            self.sequence_stop = None
+            self._sequence_length = self.num_lut_entries
+            self._sequence_repeat = bool(self.do_repeat)
+            self._sequence_frame_period = self.frame_period / 1e6
+            self._sequence_exposure = self.exposure_period / 1e6
+        elif action in (0, 1):
+            if self.running:
+                self.sequence_stop = perf_counter()
+            self.running = False
+        else:
+            raise ValueError('invalid action')
+        return b''
+
+    def _update_sequence(self):
+        if self.running and (not self._sequence_repeat) and (self.sequence_start is not None):
+            end = self.sequence_start + self._sequence_length * self._sequence_frame_period
+            if perf_counter() >= end:
+                self.running = False
+        return
+
+    def statistics(self):
+        """
+        Command and packet counters since the device was created.
+        """
+        return {'commands': sum(self.commands.values()),
+                'packets_written': self.packets_written,
+                'packets_read': self.packets_read,
+                'errors': self.errors,
+                'unacknowledged_errors': self.unacknowledged_errors,
+                'command_counts': {hex(command): count for command, count in self.commands.items()}}
+
+# =====================================================================================================================
+# Installation
+# =====================================================================================================================
+
+
+def usb_modules(devices):
+    """
+    Function creates modules standing for usb and usb.core with the given simulated usb devices.
+    Returns
+    -------
+    usb: types.ModuleType.
+         Simulated usb module, usb.core.find returns a device matching idVendor and idProduct.
+    core: types.ModuleType.
+          Simulated usb.core module.
+    """
+    usb = types.ModuleType('usb')
+    core = types.ModuleType('usb.core')
+
+    def find(find_all=False, idVendor=None, idProduct=None, **kwargs):
+        found = [device for device in devices if ((idVendor is None) or (device.idVendor == idVendor)) and
+                 ((idProduct is None) or (device.idProduct == idProduct))]
+        if find_all:
+            return iter(found)
+        return found[0] if found else None
+    core.find = find
+    core.USBError = USBError
+    usb.core = core
+    return usb, core
+
+
+class _HeadlessDisplay:
+    """
+    Stand in of cv2 windows for preview loops: frames are counted, 'q' is pressed after a given number of frames.
+    """
+    def __init__(self, frames):
+        self.frames = frames
+        self.shown = 0
+
+    def imshow(self, name, image):
+        self.shown += 1
+
+    def waitKey(self, delay=0):
+        if self.shown >= self.frames:
+            self.shown = 0
+            return ord('q')
+        return -1
+
+    def destroyAllWindows(self):
+        return
+
+
+def _reset_lazy_modules(names):
+    """
+    Function drops the loaded module of LazyModule placeholders of names in imported modules, so the modules now in
+    sys.modules are used on next access.
+    """
+    for module in list(sys.modules.values()):
+        for value in list(getattr(module, '__dict__', {}).values()):
+            if isinstance(value, LazyModule) and value.__name__ in names:
+                value.__dict__['_module'] = None
+    return
+
+
+@contextmanager
+def simulated_hardware(camera=None, projector=None, preview_frames=None):
+    """
+    Context in which PySpin and usb.core are the simulated camera and projector, for gspy, lcpy and
+    image_acquisation as well as for code importing them in the context.
+    Parameters
+    ----------
+    camera: SimulatedCamera.
+            Camera returned by PySpin.System.GetInstance().GetCameras(), default is a new SimulatedCamera.
+    projector: SimulatedDLPC350.
+               Device returned by usb.core.find, default is a new SimulatedDLPC350. Its pattern sequence triggers
+               the camera.
+    preview_frames: int.
+                    If given, cv2 preview windows are replaced by a counter pressing 'q' after this number of frames,
+                    so the preview loops (proj_cam_preview, gspy.acquire_images) run headless.
+    Yields
+    ------
+    camera, projector:
+            Simulated devices.
+    """
+    camera = camera if camera is not None else SimulatedCamera()
+    projector = projector if projector is not None else SimulatedDLPC350()
+    camera.connect(projector)
+    usb, core = usb_modules([projector])
+    modules = {'PySpin': pyspin_module([camera]), 'usb': usb, 'usb.core': core}
+    saved = {name: sys.modules.get(name) for name in modules}
+    sys.modules.update(modules)
+    _reset_lazy_modules(modules)
+    display = {}
+    if preview_frames is not None:
+        headless = _HeadlessDisplay(preview_frames)
+        display = {name: getattr(cv2, name) for name in ['imshow', 'waitKey', 'destroyAllWindows']}
+        for name in display:
+            setattr(cv2, name, getattr(headless, name))
+    try:
+        yield camera, projector
+    finally:
+        for name, function in display.items():
+            setattr(cv2, name, function)
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+        _reset_lazy_modules(modules)
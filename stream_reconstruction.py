@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 16:58:13 2026
+
+@author: kl001
+
+Streaming multi frequency reconstruction of frames as they are captured. The wrapped phase of a level only needs
+the N frames of that level, so each level is processed (level_process) as soon as its last frame arrives and
+temporal unwrapping is chained level by level. When the last frame of a scan arrives only the last unwrapping step,
+median filter correction, phase variance and triangulation are left, instead of saving and reloading the scan.
+Results are the same as Reconstruction.obj_reconst_wrapper for the same frames.
+
+    reconst = Reconstruction(..., data_type='npy', object_path=savedir)
+    stream = StreamingReconstruction(reconst)
+    image_acquisation.run_proj_cam_capt(..., frame_consumer=stream.add_frame)
+    obj_cordi, obj_color, cordi_sigma = stream.result()
+"""
+import queue
+import threading
+from time import perf_counter
+import numpy as np
+import nstep_fringe as nstep
+from reconstruction import EPSILON
+from instrumentation import span
+
+
+class StreamingReconstruction:
+    """
+    Frame consumer reconstructing each multi frequency scan level by level on a worker thread.
+    """
+    def __init__(self, reconst, threaded=True):
+        """
+        Parameters
+        ----------
+        reconst: Reconstruction.
+                 Configured reconstruction (multifreq, vertical or horizontal fringes). Its calibration, dark bias,
+                 noise model, probability, save_ply and tracer settings are used.
+        threaded: bool.
+                  If True frames are processed on a worker thread so add_frame returns immediately, otherwise
+                  add_frame processes the frame before returning.
+        """
+        if reconst.type_unwrap != 'multifreq':
+            print("ERROR: streaming reconstruction requires 'multifreq' unwrapping")
+        if reconst.temp:
+            print('WARNING: temperature is not integrated in streaming reconstruction')
+        self.reconst = reconst
+        self.backend = reconst.backend
+        self.N_list = list(reconst.N_list)
+        # index of first frame of each level and of the next scan
+        self.level_start = np.cumsum([0] + self.N_list)
+        self.frames_per_scan = int(self.level_start[-1])
+        self.results = []
+        self.latency = []
+        self._count = 0
+        self._processed_index = 0
+        self._last_frame_time = None
+        self._done = threading.Condition()
+        self._processed = 0
+        self._error = None
+        self._scan = None
+        self._queue = None
+        self._worker = None
+        # undistortion map and triangulation table are built before the first scan
+        nstep.undistort_map(reconst.cam_mtx, reconst.cam_dist, (reconst.cam_height, reconst.cam_width), self.backend)
+        reconst.triangulation_lut()
+        if threaded:
+            self._queue = queue.Queue()
+            self._worker = threading.Thread(target=self._run, daemon=True)
+            self._worker.start()
+
+    def __call__(self, frame):
+        self.add_frame(frame)
+
+    def add_frame(self, frame):
+        """
+        Function to hand a captured frame (camera image array) to the reconstruction. Frames must arrive in
+        the order of the pattern sequence, consecutive scans follow each other.
+        """
+        self._last_frame_time = perf_counter()
+        self._count += 1
+        if self._queue is not None:
+            self._queue.put((frame, self._last_frame_time))
+        else:
+            self._process(frame, self._last_frame_time)
+        return
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self._process(*item)
+            except Exception as ex:
+                # reported by result, later frames are dropped
+                self._error = ex
+            with self._done:
+                self._processed += 1
+                self._done.notify_all()
+
+    def _process(self, frame, frame_time):
+        try:
+            self._process_frame(frame, frame_time)
+        except BaseException as ex:
+            # the traced scan ends with the error, later spans do not go to it
+            self._exit_scan(ex)
+            raise
+        return
+
+    def _process_frame(self, frame, frame_time):
+        index = self._processed_index
+        self._processed_index += 1
+        i = index % self.frames_per_scan
+        if self._error is not None:
+            return
+        if i == 0:
+            self._start_scan()
+        level = int(np.searchsorted(self.level_start, i, side='right') - 1)
+        j = int(i - self.level_start[level])
+        n = self.N_list[level]
+        with span('load'):
+            image = self.backend.asarray(frame).astype(np.float64)
+            image -= self._dark_bias
+        if level == 0:
+            # mask of valid pixels needs all frames of the first level
+            self._first_level[j] = image
+            if j == n - 1:
+                with span('phase_cal'):
+                    mask = self.backend.xp.max(self._first_level, axis=0) > self.reconst.limit
+                    self._pixels = nstep.PixelSet.from_mask(mask)
+                    level_vectors = self._pixels.gather(self._first_level)
+                    sin_deck, cos_deck, modulation, average = nstep.level_process(level_vectors[None], n)
+                self._first_level = None
+                self._level(level, level_vectors, sin_deck[0], cos_deck[0], modulation[0], average[0])
+        else:
+            with span('phase_cal'):
+                vector = self._pixels.gather(image)
+                self._accumulate(level, j, vector)
+            if j == n - 1:
+                self._level(level, self._level_vectors, *self._level_decks())
+                if level == len(self.N_list) - 1:
+                    self._finish_scan(frame_time)
+        return
+
+    def _start_scan(self):
+        reconst = self.reconst
+        self._dark_bias = self.backend.asarray(reconst.dark_bias)
+        self._first_level = self.backend.xp.empty((self.N_list[0], reconst.cam_height, reconst.cam_width))
+        self._pixels = None
+        self._absolute_ph = None
+        self._sigma_sq = []
+        self._scan = reconst.tracer.scan(reconst.object_path, backend=self.backend, type_unwrap=reconst.type_unwrap,
+                                         N_list=self.N_list, pitch_list=list(reconst.pitch_list),
+                                         probability=reconst.probability, streaming=True)
+        self._scan.__enter__()
+
+    def _exit_scan(self, ex=None):
+        scan, self._scan = self._scan, None
+        if scan is not None:
+            scan.__exit__(type(ex) if ex is not None else None, ex, ex.__traceback__ if ex is not None else None)
+        return
+
+    def _accumulate(self, level, j, vector):
+        """
+        Adds a frame of a level to its sine, cosine and intensity sums, in the order of nstep.level_process.
+        """
+        xp = self.backend.xp
+        sin_delta, cos_delta = nstep.level_deltas(self.N_list[level])
+        if j == 0:
+            self._level_vectors = xp.empty((self.N_list[level], len(vector)))
+            self._sin_deck = vector * sin_delta[0]
+            self._cos_deck = vector * cos_delta[0]
+            self._sum_deck = vector.copy()
+            self._temp = xp.empty_like(vector)
+        else:
+            self._sin_deck += xp.multiply(vector, sin_delta[j], out=self._temp)
+            self._cos_deck += xp.multiply(vector, cos_delta[j], out=self._temp)
+            self._sum_deck += vector
+        self._level_vectors[j] = vector
+        return
+
+    def _level_decks(self):
+        n = self._level_vectors.shape[0]
+        modulation = 2 * self.backend.xp.sqrt(self._sin_deck ** 2 + self._cos_deck ** 2) / n
+        return self._sin_deck, self._cos_deck, modulation, self._sum_deck / n
+
+    def _level(self, level, level_vectors, sin_deck, cos_deck, modulation, average):
+        """
+        Wrapped phase of a completed level and unwrapping up to it.
+        """
+        reconst = self.reconst
+        xp = self.backend.xp
+        with span('phase_cal'):
+            phase = -xp.arctan2(sin_deck, cos_deck)
+        if level == 0:
+            phase[phase < EPSILON] = phase[phase < EPSILON] + 2 * np.pi
+            self._absolute_ph = phase
+        elif level < len(self.N_list) - 1:
+            with span('unwrap'):
+                self._absolute_ph, _ = nstep.multi_kunwrap(reconst.pitch_list[level - 1:level + 1],
+                                                           [self._absolute_ph, phase])
+        else:
+            self._white = self._pixels.scatter(modulation + average)
+            self._last_phase = phase
+        if reconst.probability and (level == len(self.N_list) - 2):
+            # variance of the second last level while the last level is captured
+            with span('sigma'):
+                self._sigma_sq.append(self._var_func(level_vectors, self.N_list[level]))
+        elif reconst.probability and (level == len(self.N_list) - 1):
+            self._last_vectors = level_vectors
+        return
+
+    def _var_func(self, level_vectors, n):
+        """
+        nstep.var_func of a level given as vectors of valid pixels.
+        """
+        vector_pixels = nstep.PixelSet(self.backend.xp.arange(level_vectors.shape[-1], dtype=np.int32),
+                                       (1, level_vectors.shape[-1]))
+        return nstep.var_func(level_vectors[:, None, :], vector_pixels, n, self.reconst.model)[0]
+
+    def _finish_scan(self, frame_time):
+        reconst = self.reconst
+        xp = self.backend.xp
+        with span('unwrap'):
+            # last step of the chain, median filter correction and valid pixels as in multifreq_unwrap
+            unwrap_vector, _, unwrap_pixels = nstep.multifreq_unwrap(reconst.pitch_list[-2:],
+                                                                     [self._absolute_ph, self._last_phase],
+                                                                     reconst.kernel,
+                                                                     reconst.fringe_direc,
+                                                                     self._pixels,
+                                                                     reconst.cam_width,
+                                                                     reconst.cam_height)
+        reconst.pixels = unwrap_pixels
+        if reconst.probability:
+            with span('sigma'):
+                valid = xp.isin(self._pixels.flat_idx, unwrap_pixels.flat_idx, assume_unique=True)
+                sigma_sq_phi_l = unwrap_pixels.scatter(self._sigma_sq[0][valid])
+                sigma_sq_phi = unwrap_pixels.scatter(self._var_func(self._last_vectors[:, valid], self.N_list[-1]))
+                sigma_sq_delta_phi = ((reconst.pitch_list[-2]/reconst.pitch_list[-1])**2 * sigma_sq_phi_l) + sigma_sq_phi
+                quality = self.backend.asnumpy(np.pi/xp.sqrt(sigma_sq_delta_phi))
+        else:
+            sigma_sq_phi = None
+            quality = None
+        orig_img = self.backend.asnumpy(self._white)
+        result = reconst.complete_recon(unwrap_vector, orig_img, None, sigma_sq_phi, quality)
+        self._exit_scan()
+        self.results.append(result)
+        self.latency.append(perf_counter() - frame_time)
+        print('\n Scan %d reconstructed %.1f ms after its last frame' % (len(self.results) - 1, 1e3 * self.latency[-1]))
+        self._level_vectors = None
+        self._last_vectors = None
+        self._sigma_sq = []
+        return
+
+    def result(self, timeout=None):
+        """
+        Function waits until all frames handed over are processed.
+        Parameters
+        ----------
+        timeout: float.
+                 Maximum waiting time in seconds, None waits until done.
+        Returns
+        -------
+        obj_cordi, obj_color, cordi_sigma:
+                 Result of the last complete scan as returned by Reconstruction.obj_reconst_wrapper, None if no scan
+                 is complete. Results of all scans are in results.
+        """
+        if self._queue is not None:
+            with self._done:
+                if not self._done.wait_for(lambda: self._processed >= self._count, timeout):
+                    print('WARNING: %d frames are not processed yet' % (self._count - self._processed))
+        if self._error is not None:
+            print('ERROR: streaming reconstruction failed: %s' % self._error)
+            return None
+        if self._processed_index % self.frames_per_scan != 0:
+            print('WARNING: last scan is incomplete, %d of %d frames' % (self._processed_index % self.frames_per_scan,
+                                                                         self.frames_per_scan))
+        return self.results[-1] if self.results else None
+
+    def close(self):
+        """
+        Function stops the worker thread after processing the frames handed over.
+        """
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
+        return